@@ -1,23 +1,65 @@
+''' The LILAC tool suite web app.
+
+    from app import create_app
+    app = create_app()
+
+Extensions are created here unbound and attached to every app create_app
+makes.  Importing the package and creating the app stay cheap: the data
+modules bind pandas and numpy with app.lazy.lazy_import, so they are only
+imported when a view first uses them, and the slow, rarely needed
+libraries (moviepy for non-PCM audio, the headless pipeline, Flask-Session
+backends) are imported by the functions that use them.  The database
+tables are made by the migrations in ui/migrations (flask db upgrade).
+'''
+
 import os
-import numpy as np
 from flask import Flask
 from config import Config
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from flask_bootstrap import Bootstrap
-from flask_session import Session
-
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-bootstrap = Bootstrap(app)
-Session(app)
-db.init_app(app)
-
-from app.lenasampler import bp as lenasampler_bp
-from app.eyegazecleaner import bp as eyegazecleaner_bp
-app.register_blueprint(lenasampler_bp, url_prefix='/lenasampler')
-app.register_blueprint(eyegazecleaner_bp, url_prefix='/eyegazecleaner')
-
-from app import routes, models
\ No newline at end of file
+
+db = SQLAlchemy()
+# flask db upgrade creates and updates the tables, from any folder
+migrate = Migrate(directory=os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations"))
+bootstrap = Bootstrap()
+
+
+def create_app(config=Config):
+    ''' A new app with its extensions and blueprints; the database tables
+        are created and updated by the migrations (flask db upgrade)
+
+        :params config: class or object with the settings as upper case
+                        attributes (see config.Config), or a dict of the
+                        ones differing from config.Config
+    '''
+    app = Flask(__name__)
+    if isinstance(config, dict):
+        app.config.from_object(Config)
+        app.config.from_mapping(config)
+    else:
+        app.config.from_object(config)
+    db.init_app(app)
+    migrate.init_app(app, db)
+    bootstrap.init_app(app)
+    if app.config["SESSION_TYPE"] == "blob":
+        from app.sessions import init_blob_sessions
+        init_blob_sessions(app)
+    else:
+        from flask_session import Session
+        Session(app)
+
+    if app.config["METRICS_ENABLED"]:
+        from app.metrics import init_metrics
+        init_metrics(app)
+
+    from app.routes import bp as main_bp
+    from app.lenasampler import bp as lenasampler_bp
+    from app.eyegazecleaner import bp as eyegazecleaner_bp
+    app.register_blueprint(main_bp)
+    app.register_blueprint(lenasampler_bp, url_prefix='/lenasampler')
+    app.register_blueprint(eyegazecleaner_bp, url_prefix='/eyegazecleaner')
+
+    from app import models
+    return app
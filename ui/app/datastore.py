@@ -0,0 +1,346 @@
+''' Columnar on-disk storage for uploaded tables.
+
+Every upload gets a dataset directory keyed by a random id.  A dataset holds
+one or more named tables; each column of a table is a .npy file (text: the
+UTF-8 bytes of its values plus their offsets) that is opened memory-mapped,
+so reading a handful of rows or columns does not touch the rest of the table.  Derived views (filtered rows, sampled rows) are
+stored as row-index arrays next to the tables instead of copies of the rows.
+
+    <DATASET_DIR>/<dataset_id>/<table>/meta.json
+    <DATASET_DIR>/<dataset_id>/<table>/<column position>.npy
+    <DATASET_DIR>/<dataset_id>/<table>/<column position>.<part>.npy
+    <DATASET_DIR>/<dataset_id>/views/<view>.npy
+
+The root is the DATASET_DIR of the current app unless one is given.
+Values computed from a dataset can be memoized in a DatasetCache of the
+app (dataset_cache), whose entries of a dataset go when it is deleted.
+'''
+
+import os
+import json
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+from flask import current_app, has_app_context
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+def dataset_path(dataset_id, root=None):
+    if root is None:
+        root = current_app.config["DATASET_DIR"]
+    return os.path.join(root, dataset_id)
+
+
+def dataset_exists(dataset_id, root=None):
+    if not dataset_id:
+        return False
+    return os.path.isdir(dataset_path(dataset_id, root))
+
+
+def create_dataset(df, table="records", root=None):
+    ''' Store df as the first table of a new dataset, return its id
+    '''
+    dataset_id = uuid.uuid4().hex
+    os.makedirs(dataset_path(dataset_id, root))
+    write_table(dataset_id, table, df, root=root)
+    return dataset_id
+
+
+def delete_dataset(dataset_id, root=None):
+    if dataset_id:
+        shutil.rmtree(dataset_path(dataset_id, root), ignore_errors=True)
+        if has_app_context():
+            for cache in current_app.extensions.get("dataset_caches",
+                                                    {}).values():
+                cache.clear(dataset_id)
+
+
+class DatasetCache(object):
+    ''' Least recently used values computed from datasets, by
+        (dataset_id, version, key).  version identifies the state of the
+        tables the value was computed from (see table_version); values of
+        other versions of a dataset are dropped when a new one is stored.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, dataset_id, version, key, compute):
+        ''' The cached value, or the one compute() returns, stored
+        '''
+        entry_key = (dataset_id, version, key)
+        with self.lock:
+            if entry_key in self.entries:
+                self.entries.move_to_end(entry_key)
+                return self.entries[entry_key]
+        value = compute()
+        with self.lock:
+            for old in [k for k in self.entries
+                        if (k[0] == dataset_id) and (k[1] != version)]:
+                del self.entries[old]
+            self.entries[entry_key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self, dataset_id=None):
+        with self.lock:
+            if dataset_id is None:
+                self.entries.clear()
+                return
+            for old in [k for k in self.entries if k[0] == dataset_id]:
+                del self.entries[old]
+
+
+def dataset_cache(name, maxsize):
+    ''' The DatasetCache name of the current app, made with maxsize entries
+        the first time
+    '''
+    caches = current_app.extensions.setdefault("dataset_caches", {})
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches.setdefault(name, DatasetCache(maxsize))
+    return cache
+
+
+def _encode_column(series):
+    ''' Turn a pandas column into (kind, arrays) that np.save can write
+        without pickling, so every file can be memory-mapped back.
+    '''
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        categories = np.asarray(series.cat.categories.astype(str), dtype=str)
+        if categories.dtype.itemsize == 0:
+            categories = categories.astype("U1")
+        return "category", {"": series.cat.codes.values,
+                            ".categories": categories}
+    values = series.values
+    if values.dtype.kind in "biufcmM":
+        return "numeric", {"": values}
+    # strings / mixed objects: the UTF-8 bytes of all the values one after
+    # the other, where each value starts, and a null mask.  Unlike fixed
+    # width unicode, one long value does not widen every row.
+    isnull = series.isnull().values
+    encoded = [s.encode("utf-8")
+               for s in series.where(~isnull, "").astype(str)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    arrays = {"": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+              ".offsets": offsets}
+    if isnull.any():
+        arrays[".null"] = isnull
+    return "utf8", arrays
+
+
+def _decode_utf8(path, rows=None):
+    offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+    if offsets[-1] == 0:
+        # empty strings only (an empty file cannot be memory-mapped)
+        n = len(offsets) - 1 if rows is None else len(rows)
+        return np.full(n, "", dtype=object)
+    data = np.load(path + ".npy", mmap_mode="r")
+    if rows is None:
+        data = data.tobytes()
+        starts = offsets[:-1].tolist()
+        ends = offsets[1:].tolist()
+    else:
+        starts = offsets[rows].tolist()
+        ends = offsets[rows + 1].tolist()
+    values = np.empty(len(starts), dtype=object)
+    values[:] = [bytes(data[s:e]).decode("utf-8")
+                 for s, e in zip(starts, ends)]
+    return values
+
+
+def _decode_column(kind, path, rows=None):
+    if kind == "utf8":
+        values = _decode_utf8(path, rows)
+    else:
+        values = np.load(path + ".npy", mmap_mode="r")
+        if rows is not None:
+            values = values[rows]
+    if kind == "category":
+        categories = np.load(path + ".categories.npy")
+        return pd.Categorical.from_codes(np.asarray(values), categories)
+    if kind in ("utf8", "string"):
+        # "string": fixed width unicode, as tables were stored before
+        values = np.asarray(values).astype(object)
+        if os.path.exists(path + ".null.npy"):
+            isnull = np.load(path + ".null.npy", mmap_mode="r")
+            if rows is not None:
+                isnull = isnull[rows]
+            values[np.asarray(isnull)] = np.nan
+        return values
+    return np.asarray(values)
+
+
+def write_table(dataset_id, table, df, root=None):
+    ''' Write (or overwrite) a table of the dataset column by column
+    '''
+    table_dir = os.path.join(dataset_path(dataset_id, root), table)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    os.makedirs(table_dir)
+    kinds = []
+    for i, col in enumerate(df.columns):
+        kind, arrays = _encode_column(df[col])
+        for suffix, arr in arrays.items():
+            np.save(os.path.join(table_dir, "%s%s.npy"%(i, suffix)), arr)
+        kinds.append(kind)
+    meta = {"columns": [str(c) for c in df.columns],
+            "kinds": kinds,
+            "dtypes": [str(df[col].dtype) for col in df.columns],
+            "length": len(df)}
+    with open(os.path.join(table_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def add_columns(dataset_id, table, df, root=None):
+    ''' Append (or replace) columns of an existing table, df must be
+        aligned with the table rows.
+    '''
+    table_dir = os.path.join(dataset_path(dataset_id, root), table)
+    meta = read_table_meta(dataset_id, table, root=root)
+    assert len(df) == meta["length"], \
+        "New columns must have the same length as table %s"%table
+    for col in df.columns:
+        kind, arrays = _encode_column(df[col])
+        if str(col) in meta["columns"]:
+            i = meta["columns"].index(str(col))
+            for suffix in [".null", ".categories", ".offsets"]:
+                stale = os.path.join(table_dir, "%s%s.npy"%(i, suffix))
+                if os.path.exists(stale):
+                    os.remove(stale)
+            meta["kinds"][i] = kind
+            meta["dtypes"][i] = str(df[col].dtype)
+        else:
+            i = len(meta["columns"])
+            meta["columns"].append(str(col))
+            meta["kinds"].append(kind)
+            meta["dtypes"].append(str(df[col].dtype))
+        for suffix, arr in arrays.items():
+            np.save(os.path.join(table_dir, "%s%s.npy"%(i, suffix)), arr)
+    with open(os.path.join(table_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def has_table(dataset_id, table, root=None):
+    if not dataset_id:
+        return False
+    return os.path.exists(os.path.join(dataset_path(dataset_id, root),
+                                       table, "meta.json"))
+
+
+def read_table_meta(dataset_id, table, root=None):
+    ''' columns, kinds, pandas dtypes and length of a table
+    '''
+    table_dir = os.path.join(dataset_path(dataset_id, root), table)
+    with open(os.path.join(table_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if "dtypes" not in meta:
+        # tables stored before the dtypes were kept: the numeric ones are
+        # in the .npy headers, which is all that is read here
+        meta["dtypes"] = [
+            str(np.load(os.path.join(table_dir, "%s.npy"%i),
+                        mmap_mode="r").dtype) if kind == "numeric"
+            else ("category" if kind == "category" else "object")
+            for i, kind in enumerate(meta["kinds"])]
+    return meta
+
+
+def numeric_columns(meta):
+    ''' Columns of the table meta holding numbers or booleans (not dates)
+    '''
+    return [col for col, dtype in zip(meta["columns"], meta["dtypes"])
+            if pd.api.types.pandas_dtype(dtype).kind in "biufc"]
+
+
+def table_version(dataset_id, table, root=None):
+    ''' (mtime, size) of the table's meta.json, which changes whenever the
+        table is written or gets columns; None if there is no such table
+    '''
+    try:
+        st = os.stat(os.path.join(dataset_path(dataset_id, root), table,
+                                  "meta.json"))
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def table_columns(dataset_id, table, root=None):
+    if not has_table(dataset_id, table, root):
+        return []
+    return read_table_meta(dataset_id, table, root)["columns"]
+
+
+def table_length(dataset_id, table, root=None):
+    if not has_table(dataset_id, table, root):
+        return 0
+    return read_table_meta(dataset_id, table, root)["length"]
+
+
+def read_column(dataset_id, table, column, root=None):
+    ''' Return a single column as a (memory-mapped when possible) array
+    '''
+    meta = read_table_meta(dataset_id, table, root)
+    i = meta["columns"].index(column)
+    path = os.path.join(dataset_path(dataset_id, root), table, str(i))
+    if meta["kinds"][i] == "numeric":
+        return np.load(path + ".npy", mmap_mode="r")
+    return _decode_column(meta["kinds"][i], path)
+
+
+def read_table(dataset_id, table, columns=None, rows=None,
+               root=None):
+    ''' Load a table (or some of its columns / rows) as a DataFrame.
+
+        :params rows: array of row positions; the returned frame is indexed
+                      by these positions so views can be derived from it.
+    '''
+    if not has_table(dataset_id, table, root):
+        return pd.DataFrame()
+    meta = read_table_meta(dataset_id, table, root)
+    if columns is None:
+        columns = meta["columns"]
+    if rows is not None:
+        rows = np.asarray(rows, dtype=np.int64)
+        index = pd.Index(rows)
+    else:
+        index = pd.RangeIndex(meta["length"])
+    data = {}
+    for col in columns:
+        i = meta["columns"].index(col)
+        path = os.path.join(dataset_path(dataset_id, root), table, str(i))
+        data[col] = _decode_column(meta["kinds"][i], path, rows)
+    return pd.DataFrame(data, index=index, columns=columns)
+
+
+def write_view(dataset_id, name, rows, root=None):
+    ''' Store a derived view of a table as an array of row positions
+    '''
+    view_dir = os.path.join(dataset_path(dataset_id, root), "views")
+    os.makedirs(view_dir, exist_ok=True)
+    np.save(os.path.join(view_dir, "%s.npy"%name),
+            np.asarray(rows, dtype=np.int64))
+
+
+def read_view(dataset_id, name, root=None):
+    ''' Row positions of a stored view, None if it has not been created
+    '''
+    if not dataset_id:
+        return None
+    path = os.path.join(dataset_path(dataset_id, root), "views", "%s.npy"%name)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def delete_view(dataset_id, name, root=None):
+    if not dataset_id:
+        return
+    path = os.path.join(dataset_path(dataset_id, root), "views", "%s.npy"%name)
+    if os.path.exists(path):
+        os.remove(path)
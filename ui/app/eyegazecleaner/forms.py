@@ -2,7 +2,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField, BooleanField, \
                     IntegerField, MultipleFileField
 from flask_wtf.file import FileField, FileAllowed
-from app import app
+from config import Config
 from app.eyegazecleaner.utils import rearrange_codes
 
 
@@ -30,22 +30,22 @@ class BatchInput(FlaskForm):
                           default="milisecond")
     expected_num_trials = IntegerField("How many trials are you expecting?")
     begin_code = StringField("Which code is the begining code?",
-                        default=app.config["BEGIN_CODE"])
+                        default=Config.BEGIN_CODE)
     end_code = StringField("Which code is the end code?",
-                        default=app.config["END_CODE"])
+                        default=Config.END_CODE)
     eligible_codes = StringField("Enter eligible codes, seperate by ,",
-                        default=",".join(app.config["DEFAULT_CODES"]))
+                        default=",".join(Config.DEFAULT_CODES))
     submit = SubmitField('Upload and run batch quality check')
 
 
 class QualityCheckInput(FlaskForm):
     expected_num_trials = IntegerField("How many trials are you expecting")
     begin_code = SelectField("Which code is the begining code?",
-                        default=app.config["BEGIN_CODE"], choices=[])
+                        default=Config.BEGIN_CODE, choices=[])
     end_code = SelectField("Which code is the end code?",
-                        default=app.config["END_CODE"], choices=[])
+                        default=Config.END_CODE, choices=[])
     eligible_codes = StringField("Enter eligible codes, seperate by ,",
-                        default=",".join(app.config["DEFAULT_CODES"]))
+                        default=",".join(Config.DEFAULT_CODES))
     submit = SubmitField('Run Quality Check')
     
     def __init__(self, codes=[], expected_num_trials=0, *args, **kwargs):
@@ -2,16 +2,28 @@ import os
 import uuid
 import traceback
 import tempfile
-import pandas as pd
 from glob import glob
 from io import BytesIO
 from werkzeug.utils import secure_filename
 from flask import redirect, render_template, url_for, request, session, \
-                  send_file, Response
-from app import app
+                  send_file, Response, jsonify, abort, current_app, \
+                  stream_with_context
 from app.eyegazecleaner import bp
+from app.lazy import lazy_import
+from app.jobs import submit_job, get_job_state, get_job_result, delete_job, \
+                     FINISHED_STATUSES
+from app.datastore import create_dataset, delete_dataset, has_table, \
+                          write_table
+from app.tables import parse_table_query, query_table, table_csv_chunks, \
+                       table_page_json
 from app.eyegazecleaner.forms import *
-from app.eyegazecleaner.utils import *
+from app.eyegazecleaner.utils import read_data, batch_input_job, \
+    update_status_df, check_eligible_codes_match, \
+    check_trial_begin_and_end_are_paired, \
+    check_non_begining_nor_end_code_has_on_off_set, get_trial_summary, \
+    run_trial_summary_comparison_two, highlight_compare_two_discrepancy
+
+pd = lazy_import("pandas")
 
 
 @bp.route('/input', methods=['GET', 'POST'])
@@ -110,8 +122,26 @@ def batch_input():
         if expected_num_trials is not None:
             setattr(getattr(form, "expected_num_trials"), "data", expected_num_trials)
 
+    # files are loaded and checked by a background job; the page polls it
+    # and reloads itself, the results are merged into the session here
+    job_id = session.get("batch_input_job")
+    job = get_job_state(job_id)
+    if (job is not None) and (job["status"] in FINISHED_STATUSES):
+        session.pop("batch_input_job")
+        if job["status"] != "done":
+            delete_job(job_id)
+            return render_template("error.html", 
+                message=job["error"] or "Batch input was cancelled.")
+        file_session, new_status_records = get_job_result(job_id)
+        delete_job(job_id)
+        session.update(file_session)
+        status_records.extend(new_status_records)
+        session["eyegazecleaner_records"] = status_records
+        job = None
+
     if form.validate_on_submit():
         folder_path = form.folder_path.data
+        fns = []
         if os.path.exists(folder_path):
             fns = glob(os.path.join(folder_path, "*csv"))
             fns.extend(glob(os.path.join(folder_path, "*xlsx")))
@@ -122,74 +152,16 @@ def batch_input():
         session["batch_eligible_codes"] = form.eligible_codes.data
         session["batch_expected_num_trials"] = form.expected_num_trials.data
         if fns:
-            for fn in fns:
-                filename = os.path.basename(fn)
-                original_timestamp_unit = form.original_timestamp_unit.data
-                target_timestamp_unit = form.target_timestamp_unit.data
-                file_id = str(uuid.uuid4())
-                session["%s_filename"%file_id] = filename 
-                session["%s_original_timestamp_unit"%file_id] = original_timestamp_unit
-                session["%s_target_timestamp_unit"%file_id] = target_timestamp_unit
-                session["%s_begin_code"%file_id] = form.begin_code.data
-                session["%s_end_code"%file_id] = form.end_code.data
-                session["%s_eligible_codes"%file_id] = form.eligible_codes.data
-                session["%s_expected_num_trials"%file_id] = form.expected_num_trials.data
-                try:
-                    dft, error_message = read_data(filename, fn, 
-                                                original_timestamp_unit,
-                                                target_timestamp_unit) 
-                    if error_message:
-                        return render_template("error.html", 
-                                            message=error_message)
-                    dft = dft.reset_index(drop=True)
-                    columns = list(dft.columns)
-                    records = dft.to_dict("records")
-                    session['%s_columns'%file_id] = columns
-                    session['%s_records'%file_id] = records
-                except Exception as e:
-                    status_records.append({"Filename":filename, 
-                        "Original timestamp Unit":original_timestamp_unit, 
-                        "Target timestamp Unit":target_timestamp_unit, 
-                        "Quality": "Data Loading Failed",
-                        "Run Quality Check": "Not Available",
-                        "View":  "Not Available", 
-                        "Trial Level Summary": "Not Available",
-                        "Delete": "Not Available",
-                        "ID": file_id }) 
-                    session["eyegazecleaner_records"] = status_records
-                    traceback.print_exc()
-                    continue
-
-                # run quality check automatically
-                try:
-                    overall_quality = \
-                        run_quality_check(dft, file_id, session,
-                                      eligible_codes=form.eligible_codes.data, 
-                                      expected_num_trials=form.expected_num_trials.data,
-                                      begin_code=form.begin_code.data, 
-                                      end_code=form.end_code.data)
-                    status_records.append({"Filename":filename, 
-                        "Original timestamp Unit":original_timestamp_unit, 
-                        "Target timestamp Unit":target_timestamp_unit, 
-                        "Quality": overall_quality,
-                        "Run Quality Check": "<a href='%seyegazecleaner/quality_check/%s'>check</a>"%(request.host_url, file_id),
-                        "View": "<a href='%seyegazecleaner/view_data/%s'>view</a>"%(request.host_url, file_id), 
-                        "Trial Level Summary": "<a href='%seyegazecleaner/trial_summary/%s'>summary</a>"%(request.host_url, file_id), 
-                        "Delete": "<a href='%seyegazecleaner/delete/%s'>delete</a>"%(request.host_url, file_id),
-                        "ID": file_id }) 
-                    session["eyegazecleaner_records"] = status_records
-                except Exception as e:
-                    status_records.append({"Filename":filename, 
-                        "Original timestamp Unit":original_timestamp_unit, 
-                        "Target timestamp Unit":target_timestamp_unit, 
-                        "Quality": "Quality check run with errors",
-                        "Run Quality Check": "<a href='%seyegazecleaner/quality_check/%s'>check</a>"%(request.host_url, file_id),
-                        "View": "<a href='%seyegazecleaner/view_data/%s'>view</a>"%(request.host_url, file_id), 
-                        "Trial Level Summary": "<a href='%seyegazecleaner/trial_summary/%s'>summary</a>"%(request.host_url, file_id), 
-                        "Delete": "<a href='%seyegazecleaner/delete/%s'>delete</a>"%(request.host_url, file_id),
-                        "ID": file_id })  
-                    session["eyegazecleaner_records"] = status_records
-                    traceback.print_exc()
+            session["batch_input_job"] = submit_job(
+                "EyegazeCleaner batch input", batch_input_job, fns,
+                original_timestamp_unit=form.original_timestamp_unit.data,
+                target_timestamp_unit=form.target_timestamp_unit.data,
+                begin_code=form.begin_code.data,
+                end_code=form.end_code.data,
+                eligible_codes=form.eligible_codes.data,
+                expected_num_trials=form.expected_num_trials.data,
+                host_url=request.host_url)
+            return redirect(url_for("eyegazecleaner.batch_input"))
 
     status_df = pd.DataFrame.from_dict(status_records)
     status_df = status_df.reset_index()
@@ -197,6 +169,7 @@ def batch_input():
     status_columns = status_df.columns
     return render_template("eyegazecleaner/batch_input.html",
                             form=form,
+                            job=job,
                             columns=status_columns,
                             records=status_records)
 
@@ -208,6 +181,7 @@ def delete(file_id):
     status_df = status_df[status_df["ID"] != file_id]
     status_records = status_df.to_dict("records")
     session["eyegazecleaner_records"] = status_records
+    delete_dataset(session.pop("%s_dataset_id"%file_id, None))
     return redirect(url_for("eyegazecleaner.input"))
 
 
@@ -219,10 +193,10 @@ def quality_check(file_id, auto_check=0):
     if file_id:
         records = session.get('%s_records'%file_id, [])
         dft = pd.DataFrame.from_dict(records)
-        codes = list(dft[app.config["CODE_COL"]].value_counts().index)
+        codes = list(dft[current_app.config["CODE_COL"]].value_counts().index)
         # count default begin code
-        b_counts = list(dft[app.config["CODE_COL"]].values)\
-                            .count(app.config["BEGIN_CODE"]) 
+        b_counts = list(dft[current_app.config["CODE_COL"]].values)\
+                            .count(current_app.config["BEGIN_CODE"]) 
         form = QualityCheckInput(codes=codes, expected_num_trials=b_counts)
 
         if request.method == "GET":
@@ -323,19 +297,19 @@ def quality_check(file_id, auto_check=0):
 @bp.route('/trial_summary/<file_id>', methods=['GET'])
 def trial_summary(file_id=None):
     if file_id:
+        filename = session.get("%s_filename"%file_id, "Unknown")
         summary_records = session.get("%s_summary_records"%file_id, None)
-        summary_columns = session.get("%s_summary_records"%file_id, None)
+        summary_columns = session.get("%s_summary_columns"%file_id, None)
         if summary_records is None:
-            filename = session.get("%s_filename"%file_id, "Unknown")
             records = session.get('%s_records'%file_id, [])
-            begin_code = session.get('%s_begin_code'%file_id, app.config["BEGIN_CODE"])
-            end_code = session.get('%s_end_code'%file_id, app.config["END_CODE"])
+            begin_code = session.get('%s_begin_code'%file_id, current_app.config["BEGIN_CODE"])
+            end_code = session.get('%s_end_code'%file_id, current_app.config["END_CODE"])
             df = pd.DataFrame.from_dict(records)
             summary_df = get_trial_summary(df, 
-                        code_col=app.config["CODE_COL"],
+                        code_col=current_app.config["CODE_COL"],
                         begin_code=begin_code,
                         end_code=end_code)
-            summary_columns = summary_df.columns
+            summary_columns = list(summary_df.columns)
             summary_records = summary_df.to_dict("records")
             session["%s_summary_records"%file_id] = summary_records
             session["%s_summary_columns"%file_id] = summary_columns
@@ -344,7 +318,9 @@ def trial_summary(file_id=None):
                                 filename=filename,
                                 file_id=file_id,
                                 columns=summary_columns,
-                                records=summary_records)
+                                table_url=url_for("eyegazecleaner.table", 
+                                                  file_id=file_id, 
+                                                  name="summary_records"))
     else:
         return render_template("error.html", 
                 message="Please initiate this page from the EyegazeClenaer's "\
@@ -356,22 +332,68 @@ def trial_summary(file_id=None):
 def view_data(file_id=None):
     if file_id:
         filename = session.get("%s_filename"%file_id, "Unknown")
-        records = session.get('%s_records'%file_id, [])
         columns = session.get('%s_columns'%file_id, [])
         return render_template("eyegazecleaner/view_data.html",
                                 title="Input Coding Data",
                                 filename=filename,
                                 file_id=file_id,
                                 columns=columns,
-                                records=records)
+                                table_url=url_for("eyegazecleaner.table", 
+                                                  file_id=file_id, 
+                                                  name="records"))
     else:
         return render_template("error.html", 
                 message="Please initiate this page from the EyegazeClenaer's "\
                     "Input page's table entry: %s/eyegazecleaner/input"%(request.host_url))
     
 
+def file_table(file_id, name):
+    ''' Dataset id of the file whose table name (its records or trial
+        summary) is stored; the session records are stored the first time,
+        later pages only read the rows they show.  None if there are none.
+    '''
+    dataset_id = session.get("%s_dataset_id"%file_id)
+    if dataset_id and has_table(dataset_id, name):
+        return dataset_id
+    records = session.get("%s_%s"%(file_id, name))
+    if records is None:
+        return None
+    df = pd.DataFrame.from_dict(records)
+    if dataset_id:
+        write_table(dataset_id, name, df)
+    else:
+        dataset_id = create_dataset(df, table=name)
+        session["%s_dataset_id"%file_id] = dataset_id
+    return dataset_id
+
+
+@bp.route('/table/<file_id>/<name>', methods=['GET'])
+def table(file_id, name):
+    ''' A page of the input records or the trial summary of a file as json
+        (or all of the selected rows as csv with format=csv)
+    '''
+    if name not in ("records", "summary_records"):
+        abort(404)
+    dataset_id = file_table(file_id, name)
+    try:
+        query = parse_table_query(request.args)
+        if request.args.get("format") == "csv":
+            return Response(stream_with_context(table_csv_chunks(dataset_id,
+                                name, **query)), headers={
+                'Content-Type': 'text/csv',
+                'Content-Disposition': 'attachment; filename=%s_%s.csv;'\
+                                       %(file_id, name)
+            })
+        total, filtered, page = query_table(dataset_id, name, **query)
+    except (KeyError, ValueError) as e:
+        abort(400, str(e))
+    return jsonify(table_page_json(total, filtered, page, query["offset"]))
+
+
 @bp.route("/reset_session", methods=["GET", "POST"])
 def reset_session():
+    for key in [key for key in session.keys() if key.endswith("_dataset_id")]:
+        delete_dataset(session[key])
     session.clear()
     return render_template("eyegazecleaner/reset_session.html") 
 
@@ -423,10 +445,10 @@ def compare_two():
         coder2_timestsamp_unit = session.get("%s_target_timestamp_unit"%coder2_id)
         if coder1_timestsamp_unit == "milisecond":
             timestamp_unit = "milisecond"
-            diff_threshold = app.config["DISCRENPANCY_THRESHOLD_MILISECOND"]
+            diff_threshold = current_app.config["DISCRENPANCY_THRESHOLD_MILISECOND"]
         else:
             timestamp_unit = "frame"
-            diff_threshold = app.config["DISCRENPANCY_THRESHOLD_FRAME"]
+            diff_threshold = current_app.config["DISCRENPANCY_THRESHOLD_FRAME"]
         session["compare_two_threshold_%s_%s"%(coder1_id, coder2_id)] \
             = diff_threshold
 
@@ -440,9 +462,9 @@ def compare_two():
             if not len(coder1_summary_records):
                 records = session.get('%s_records'%coder1_id, [])
                 begin_code = session.get('%s_begin_code'%coder1_id, 
-                                            app.config["BEGIN_CODE"])
+                                            current_app.config["BEGIN_CODE"])
                 end_code = session.get('%s_end_code'%coder1_id,
-                                            app.config["END_CODE"])
+                                            current_app.config["END_CODE"])
                 df = pd.DataFrame.from_dict(records)
                 coder1_summary_df = get_trial_summary(df, 
                             begin_code=begin_code,
@@ -453,9 +475,9 @@ def compare_two():
             if not len(coder2_summary_records):
                 records = session.get('%s_records'%coder2_id, [])
                 begin_code = session.get('%s_begin_code'%coder2_id, 
-                                            app.config["BEGIN_CODE"])
+                                            current_app.config["BEGIN_CODE"])
                 end_code = session.get('%s_end_code'%coder2_id, 
-                                        app.config["END_CODE"])
+                                        current_app.config["END_CODE"])
                 df = pd.DataFrame.from_dict(records)
                 coder2_summary_df = get_trial_summary(df, 
                             begin_code=begin_code,
@@ -476,7 +498,7 @@ def compare_two():
     else:
         records = columns = []
         timestamp_unit = "milisecond"
-        diff_threshold = app.config["DISCRENPANCY_THRESHOLD_MILISECOND"]
+        diff_threshold = current_app.config["DISCRENPANCY_THRESHOLD_MILISECOND"]
         diff_col_indices = []
         coder1_id = None
         coder2_id = None
@@ -501,7 +523,7 @@ def export_compare_two(coder1_id=None, coder2_id=None):
         # format it
         threshold= session.get("compare_two_threshold_%s_%s"\
                                %(coder1_id, coder2_id),
-                               app.config["DISCRENPANCY_THRESHOLD_MILISECOND"])
+                               current_app.config["DISCRENPANCY_THRESHOLD_MILISECOND"])
         df = highlight_compare_two_discrepancy(df, threshold)
         buffer = BytesIO()
         df.to_excel(buffer, sheet_name = "ComparisonResult", index=False)
@@ -1,12 +1,24 @@
+import os
+import uuid
 import traceback
-import numpy as np
-import pandas as pd
-from app import app
+from flask import current_app
+from config import Config
+from app.metrics import timed
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+class DataLoadingError(Exception):
+    ''' A coding file of a batch that cannot be opened at all; the batch
+        stops and the message is shown.
+    '''
 
 
 def convert_milisecond_to_frame(df, scale=0.03, file_type="raw_coding_file",
-    onset_col=app.config["ONSET_COL"],
-    offset_col=app.config["OFFSET_COL"]):
+    onset_col=Config.ONSET_COL,
+    offset_col=Config.OFFSET_COL):
     ''' 30 frame in 1000 miliseconds; 1 miliseconds = 0.03 frame.
 
     Note that we are rounding the results not just taking the integer portion
@@ -19,15 +31,15 @@ def convert_milisecond_to_frame(df, scale=0.03, file_type="raw_coding_file",
     else:
         # trial summary file
         for col in df.columns:
-            if col != app.config["TRIAL_ID_COL"]:
+            if col != current_app.config["TRIAL_ID_COL"]:
                 df[col] = round(df[col] * scale)
                 df[col] = df[col].astype(int)
     return df
 
 
 def convert_frame_to_milisecond(df, scale=100/3, file_type="raw_coding_file",
-    onset_col=app.config["ONSET_COL"],
-    offset_col=app.config["OFFSET_COL"]):
+    onset_col=Config.ONSET_COL,
+    offset_col=Config.OFFSET_COL):
     ''' 30 frame in 1000 miliseconds; 1 frame = 1000/30 miliseconds.
 
     Note that we are rounding the results not just taking the integer portion
@@ -40,17 +52,18 @@ def convert_frame_to_milisecond(df, scale=100/3, file_type="raw_coding_file",
     else:
         # trial summary file
         for col in df.columns:
-            if col != app.config["TRIAL_ID_COL"]:
+            if col != current_app.config["TRIAL_ID_COL"]:
                 df[col] = round(df[col] * scale)
                 df[col] = df[col].astype(int)
     return df
 
 
+@timed("eyegazecleaner.read_data")
 def read_data(fn, filepath, original_timestamp_unit,
     target_timestamp_unit,
-    onset_col=app.config["ONSET_COL"],
-    offset_col=app.config["OFFSET_COL"],
-    code_col=app.config["CODE_COL"]):
+    onset_col=Config.ONSET_COL,
+    offset_col=Config.OFFSET_COL,
+    code_col=Config.CODE_COL):
     '''read csv/excel files'''
     error_message = ""
     if fn.endswith("csv"):
@@ -87,8 +100,8 @@ def check_eligible_codes_match(codes, eligible_codes):
     return set(codes).issubset(set(eligible_codes))
 
 
-def check_trial_begin_and_end_are_paired(df, code_col=app.config["CODE_COL"],
-    begining_code=app.config["BEGIN_CODE"], ending_code=app.config["END_CODE"]):
+def check_trial_begin_and_end_are_paired(df, code_col=Config.CODE_COL,
+    begining_code=Config.BEGIN_CODE, ending_code=Config.END_CODE):
     dft = df[df[code_col].isin([begining_code, ending_code])]
     codes = list(dft[code_col].values)
     code_stack = []
@@ -112,8 +125,8 @@ def check_trial_begin_and_end_are_paired(df, code_col=app.config["CODE_COL"],
 
 
 def check_non_begining_nor_end_code_has_on_off_set(df, 
-    code_col=app.config["CODE_COL"],
-    begining_code=app.config["BEGIN_CODE"], ending_code=app.config["END_CODE"]):
+    code_col=Config.CODE_COL,
+    begining_code=Config.BEGIN_CODE, ending_code=Config.END_CODE):
 
     dft = df[(df[code_col] != begining_code) & (df[code_col] != ending_code)]
     no_onset_value_rows = dft[dft["onset"] == 0]
@@ -134,10 +147,11 @@ def update_status_df(file_id, column, value, session,
     session[records_key] = status_records
 
 
+@timed("eyegazecleaner.run_quality_check")
 def run_quality_check(dft, file_id, session,
                       eligible_codes, expected_num_trials,
                       begin_code, end_code,
-                      code_col=app.config["CODE_COL"]):
+                      code_col=Config.CODE_COL):
     codes = list(dft[code_col].value_counts().index)
     eligible_codes_okay = check_eligible_codes_match(codes, 
         eligible_codes)
@@ -168,8 +182,8 @@ def run_quality_check(dft, file_id, session,
     return overall_quality
 
 
-def rearrange_codes(codes, default_begin_code=app.config["BEGIN_CODE"], 
-    default_end_code=app.config["END_CODE"]):
+def rearrange_codes(codes, default_begin_code=Config.BEGIN_CODE, 
+    default_end_code=Config.END_CODE):
     codes = sorted(codes)
     if default_end_code in codes:
         codes.remove(default_end_code)
@@ -180,8 +194,8 @@ def rearrange_codes(codes, default_begin_code=app.config["BEGIN_CODE"],
     return codes
 
 
-def assign_trial_id(df, code_col=app.config["CODE_COL"], 
-                    begin_code=app.config["BEGIN_CODE"]):
+def assign_trial_id(df, code_col=Config.CODE_COL, 
+                    begin_code=Config.BEGIN_CODE):
     codes = df[code_col].values
     trial_ids = []
     trial_id = 0
@@ -189,18 +203,19 @@ def assign_trial_id(df, code_col=app.config["CODE_COL"],
         if c == begin_code:
             trial_id += 1
         trial_ids.append(trial_id)
-    df[app.config["TRIAL_ID_COL"]] = trial_ids
+    df[current_app.config["TRIAL_ID_COL"]] = trial_ids
     return df
 
 
-def get_trial_summary(df, code_col=app.config["CODE_COL"],
-                      begin_code=app.config["BEGIN_CODE"],
-                      end_code=app.config["END_CODE"],
-                      onset_col=app.config["ONSET_COL"],
-                      offset_col=app.config["OFFSET_COL"],
-                      code_meaning_dict = app.config["CODE_MEANING_DICT"]):
+@timed("eyegazecleaner.get_trial_summary")
+def get_trial_summary(df, code_col=Config.CODE_COL,
+                      begin_code=Config.BEGIN_CODE,
+                      end_code=Config.END_CODE,
+                      onset_col=Config.ONSET_COL,
+                      offset_col=Config.OFFSET_COL,
+                      code_meaning_dict = Config.CODE_MEANING_DICT):
     
-    trial_id_col = app.config["TRIAL_ID_COL"]
+    trial_id_col = current_app.config["TRIAL_ID_COL"]
     df = assign_trial_id(df, code_col, begin_code)
     grped = df.groupby(trial_id_col)
     eligible_codes = list(df[code_col].value_counts().index)
@@ -242,6 +257,7 @@ def get_trial_summary(df, code_col=app.config["CODE_COL"],
     return summary_df
 
 
+@timed("eyegazecleaner.run_trial_summary_comparison_two")
 def run_trial_summary_comparison_two(records1, unit1, records2, unit2):
     df1 = pd.DataFrame.from_dict(records1)
     df2 = pd.DataFrame.from_dict(records2)
@@ -249,15 +265,15 @@ def run_trial_summary_comparison_two(records1, unit1, records2, unit2):
     if unit1 != unit2:  # convert coder2 to use the same unit as coder1
         if (unit1 == "frame") \
                 and (unit2 == "milisecond"):
-                df2 = convert_milisecond_to_frame(df2, filetype="trial_summary")
+                df2 = convert_milisecond_to_frame(df2, file_type="trial_summary")
         else:
-            df2 = convert_frame_to_milisecond(df2, filetype="trial_summary") 
+            df2 = convert_frame_to_milisecond(df2, file_type="trial_summary") 
 
     dft = df1.join(df2, lsuffix='.1', rsuffix='.2')
     ordered_cols = []
     for c in df1.columns:
-        if c == app.config["TRIAL_ID_COL"]:
-            dft[app.config["TRIAL_ID_COL"]] = dft["%s.1"%c]
+        if c == current_app.config["TRIAL_ID_COL"]:
+            dft[current_app.config["TRIAL_ID_COL"]] = dft["%s.1"%c]
             ordered_cols.append(c)
         else:
             if c == "attention.entire.trial":
@@ -288,8 +304,9 @@ def highlight_compare_two_discrepancy_trialid(x, l, color="red"):
     return np.where(x.isin(l), f"background-color: {color};", None)
 
 
+@timed("eyegazecleaner.highlight_compare_two_discrepancy")
 def highlight_compare_two_discrepancy(df, threshold, 
-                                      trial_id_col=app.config["TRIAL_ID_COL"]):
+                                      trial_id_col=Config.TRIAL_ID_COL):
     diff_cols = [c for c in df.columns if c.endswith(".diff")]
     df["has_discrepancy"] = df.apply(has_discrepancy, 
                                     args=(diff_cols, threshold),
@@ -300,4 +317,73 @@ def highlight_compare_two_discrepancy(df, threshold,
                         threshold=threshold, subset=diff_cols)\
                   .apply(highlight_compare_two_discrepancy_trialid, 
                         l=has_discrepancy_trial_ids, subset=trial_id_col)
-    return df
\ No newline at end of file
+    return df
+
+def batch_input_job(job, fns, original_timestamp_unit, target_timestamp_unit,
+                    begin_code, end_code, eligible_codes, expected_num_trials,
+                    host_url):
+    ''' Background job: load and quality check a folder of coding files.
+
+        A job cannot write to the user's session, so the per file session
+        values and the status table rows are returned to be merged into it.
+    '''
+    session = {}
+    status_records = []
+    for i, fn in enumerate(fns):
+        job.progress(i, len(fns), message=os.path.basename(fn))
+        filename = os.path.basename(fn)
+        file_id = str(uuid.uuid4())
+        session["%s_filename"%file_id] = filename 
+        session["%s_original_timestamp_unit"%file_id] = original_timestamp_unit
+        session["%s_target_timestamp_unit"%file_id] = target_timestamp_unit
+        session["%s_begin_code"%file_id] = begin_code
+        session["%s_end_code"%file_id] = end_code
+        session["%s_eligible_codes"%file_id] = eligible_codes
+        session["%s_expected_num_trials"%file_id] = expected_num_trials
+        try:
+            dft, error_message = read_data(filename, fn, 
+                                        original_timestamp_unit,
+                                        target_timestamp_unit) 
+            if error_message:
+                raise DataLoadingError(error_message)
+            dft = dft.reset_index(drop=True)
+            columns = list(dft.columns)
+            records = dft.to_dict("records")
+            session['%s_columns'%file_id] = columns
+            session['%s_records'%file_id] = records
+        except DataLoadingError:
+            raise
+        except Exception as e:
+            status_records.append({"Filename":filename, 
+                "Original timestamp Unit":original_timestamp_unit, 
+                "Target timestamp Unit":target_timestamp_unit, 
+                "Quality": "Data Loading Failed",
+                "Run Quality Check": "Not Available",
+                "View":  "Not Available", 
+                "Trial Level Summary": "Not Available",
+                "Delete": "Not Available",
+                "ID": file_id }) 
+            traceback.print_exc()
+            continue
+
+        # run quality check automatically
+        try:
+            quality = run_quality_check(dft, file_id, session,
+                                eligible_codes=eligible_codes, 
+                                expected_num_trials=expected_num_trials,
+                                begin_code=begin_code, 
+                                end_code=end_code)
+        except Exception as e:
+            quality = "Quality check run with errors"
+            traceback.print_exc()
+        status_records.append({"Filename":filename, 
+            "Original timestamp Unit":original_timestamp_unit, 
+            "Target timestamp Unit":target_timestamp_unit, 
+            "Quality": quality,
+            "Run Quality Check": "<a href='%seyegazecleaner/quality_check/%s'>check</a>"%(host_url, file_id),
+            "View": "<a href='%seyegazecleaner/view_data/%s'>view</a>"%(host_url, file_id), 
+            "Trial Level Summary": "<a href='%seyegazecleaner/trial_summary/%s'>summary</a>"%(host_url, file_id), 
+            "Delete": "<a href='%seyegazecleaner/delete/%s'>delete</a>"%(host_url, file_id),
+            "ID": file_id }) 
+    job.progress(len(fns), len(fns))
+    return session, status_records
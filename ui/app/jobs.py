@@ -0,0 +1,229 @@
+''' Background jobs for operations that are too slow for a request.
+
+A job is a function run in a thread pool inside the context of the app
+that submitted it.  Its state
+(status, done/total counts, timings, error) is persisted as json in
+<JOB_DIR>/<job_id>/state.json so any worker process can report on it, and
+its return value is pickled next to it.  Jobs can also leave files (e.g. a
+zip archive) in their directory to be downloaded when finished.  A job
+submitted during a request belongs to that session: the job views only
+report on, cancel and serve the jobs of the session asking (job_owner).
+
+    job_id = submit_job("Quality check", func, arg1, arg2)
+    ...
+    def func(job, arg1, arg2):
+        for i, x in enumerate(items):
+            job.progress(i, len(items))   # raises JobCancelled if cancelled
+            ...
+        return result
+'''
+
+import os
+import json
+import time
+import uuid
+import pickle
+import shutil
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, session, has_request_context
+
+
+# created by the first job, with the JOB_WORKERS of its app
+_executor = None
+_executor_lock = threading.Lock()
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def job_path(job_id, *paths, root=None):
+    if root is None:
+        root = current_app.config["JOB_DIR"]
+    return os.path.join(root, os.path.basename(job_id), *paths)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config["JOB_WORKERS"])
+    return _executor
+
+
+def _write_state(job_id, state):
+    path = job_path(job_id, "state.json")
+    tmp = "%s.%s.tmp"%(path, threading.get_ident())
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _read_state(job_id):
+    try:
+        with open(job_path(job_id, "state.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def session_job_owner(create=False):
+    ''' Id the jobs of the current session are submitted with, None if
+        the session has not submitted any (and create is False)
+    '''
+    if create and ("job_owner" not in session):
+        session["job_owner"] = uuid.uuid4().hex
+    return session.get("job_owner")
+
+
+def is_job_owner(state):
+    ''' Whether the job of state was submitted by the current session
+    '''
+    owner = state.get("owner")
+    return (owner is not None) and (owner == session_job_owner())
+
+
+class Job(object):
+    ''' Handle passed to a running job function to report progress
+    '''
+    def __init__(self, job_id, name, owner=None):
+        self.id = job_id
+        self.state = {"id": job_id, "name": name, "owner": owner,
+                      "status": "queued",
+                      "done": 0, "total": None, "message": "",
+                      "created": time.time(), "started": None,
+                      "finished": None, "error": None, "result_file": None}
+        self._last_saved = 0
+
+    def save(self, force=True):
+        now = time.time()
+        if force or (now - self._last_saved > 0.5):
+            _write_state(self.id, self.state)
+            self._last_saved = now
+
+    def is_cancelled(self):
+        return os.path.exists(job_path(self.id, "cancel"))
+
+    def progress(self, done, total=None, message=None):
+        ''' Record progress, raise JobCancelled if cancellation was asked
+        '''
+        self.state["done"] = done
+        if total is not None:
+            self.state["total"] = total
+        if message is not None:
+            self.state["message"] = message
+        self.save(force=False)
+        if self.is_cancelled():
+            raise JobCancelled()
+
+    def result_path(self, filename):
+        ''' Path of a downloadable result file of this job
+        '''
+        self.state["result_file"] = os.path.basename(filename)
+        return job_path(self.id, self.state["result_file"])
+
+
+def _run_job(app, job, func, args, kwargs):
+    with app.app_context():
+        job.state["status"] = "running"
+        job.state["started"] = time.time()
+        job.save()
+        try:
+            result = func(job, *args, **kwargs)
+            with open(job_path(job.id, "result.pkl"), "wb") as f:
+                pickle.dump(result, f)
+            job.state["status"] = "done"
+            if job.state["total"] is not None:
+                job.state["done"] = job.state["total"]
+        except JobCancelled:
+            job.state["status"] = "cancelled"
+        except Exception:
+            job.state["status"] = "failed"
+            job.state["error"] = traceback.format_exc()
+            traceback.print_exc()
+        job.state["finished"] = time.time()
+        job.save()
+
+
+def submit_job(name, func, *args, **kwargs):
+    ''' Run func(job, *args, **kwargs) in the background, return the job id;
+        during a request the job belongs to its session
+    '''
+    prune_jobs()
+    job_id = uuid.uuid4().hex
+    os.makedirs(job_path(job_id))
+    owner = session_job_owner(create=True) if has_request_context() else None
+    job = Job(job_id, name, owner=owner)
+    job.save()
+    _get_executor().submit(_run_job, current_app._get_current_object(), job, func,
+                     args, kwargs)
+    return job_id
+
+
+def get_job_state(job_id):
+    ''' Job state with throughput (items/s) and eta (s), None if unknown
+    '''
+    if not job_id:
+        return None
+    state = _read_state(job_id)
+    if state is None:
+        return None
+    started = state.get("started")
+    end = state.get("finished") or time.time()
+    state["elapsed"] = (end - started) if started else 0
+    state["throughput"] = None
+    state["eta"] = None
+    if state["elapsed"] > 0 and state["done"]:
+        state["throughput"] = state["done"] / state["elapsed"]
+        if state["total"] and state["status"] not in FINISHED_STATUSES:
+            state["eta"] = (state["total"] - state["done"]) \
+                           / state["throughput"]
+    return state
+
+
+def get_job_result(job_id):
+    with open(job_path(job_id, "result.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def get_job_result_file(job_id):
+    state = get_job_state(job_id)
+    if (state is None) or (state["status"] != "done") \
+            or not state["result_file"]:
+        return None
+    return job_path(job_id, state["result_file"])
+
+
+def cancel_job(job_id):
+    if _read_state(job_id) is None:
+        return False
+    open(job_path(job_id, "cancel"), "w").close()
+    return True
+
+
+def delete_job(job_id):
+    if job_id:
+        shutil.rmtree(job_path(job_id), ignore_errors=True)
+
+
+def prune_jobs(max_age=None, root=None):
+    ''' Remove finished jobs older than max_age, by default the
+        PERMANENT_SESSION_LIFETIME of the current app
+    '''
+    if max_age is None:
+        max_age = current_app.permanent_session_lifetime
+    if root is None:
+        root = current_app.config["JOB_DIR"]
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age.total_seconds()
+    for job_id in os.listdir(root):
+        state = _read_state(job_id)
+        if (state is not None) and (state["status"] in FINISHED_STATUSES) \
+                and (state["finished"] or 0) < cutoff:
+            delete_job(job_id)
@@ -0,0 +1,32 @@
+''' Slow libraries imported when they are first used.
+
+    np = lazy_import("numpy")       # at module level, instead of
+                                    # import numpy as np
+
+The data modules bind pandas and numpy this way, so the app and its views
+can import them at module level while creating the app stays cheap.
+'''
+
+import importlib
+
+
+class LazyModule(object):
+    ''' Stand-in for a module, importing it on the first attribute access
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only called for names the stand-in does not have itself
+        if self._module is None:
+            # the import lock makes this safe from several threads
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module %r>"%self._name
+
+
+def lazy_import(name):
+    return LazyModule(name)
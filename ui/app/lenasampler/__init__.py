@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('lenasampler', __name__)
 
-from app.lenasampler import routes
\ No newline at end of file
+from app.lenasampler import routes, cli
\ No newline at end of file
@@ -0,0 +1,191 @@
+''' Minimal RIFF/WAVE header reader and PCM segment slicer.
+
+Only the fmt and data chunks are parsed; nothing is decoded, so probing a
+16-hour recording costs a couple of small reads instead of an ffmpeg run.
+Segments of PCM files are cut by copying the sample bytes between computed
+offsets into a new container, so they are bit-identical to the source; the
+same bytes can also be read a range at a time to stream a segment without
+writing it.
+'''
+
+import os
+import struct
+from collections import namedtuple
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+WavInfo = namedtuple("WavInfo", ["format_tag", "channels", "sample_rate",
+                                 "bits_per_sample", "block_align",
+                                 "data_offset", "data_size", "fmt_chunk"])
+
+
+def read_wav_header(fn):
+    ''' Parse the header of a RIFF/RF64 WAVE file.
+
+        Raises ValueError if fn is not a WAVE file or has no fmt/data chunk.
+        data_size is clipped to what is actually on disk, so files whose
+        header was never finalized by the recorder still probe correctly.
+    '''
+    file_size = os.path.getsize(fn)
+    with open(fn, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] not in (b"RIFF", b"RF64") \
+                or riff[8:12] != b"WAVE":
+            raise ValueError("%s is not a RIFF/WAVE file"%fn)
+        is_rf64 = riff[:4] == b"RF64"
+        rf64_data_size = None
+        fmt = None
+        fmt_chunk = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            chunk_start = f.tell()
+            if chunk_id == b"ds64" and is_rf64:
+                rf64_data_size = struct.unpack("<QQ", f.read(16))[1]
+            elif chunk_id == b"fmt ":
+                fmt_chunk = f.read(chunk_size)
+                fmt = struct.unpack("<HHIIHH", fmt_chunk[:16])
+            elif chunk_id == b"data":
+                if fmt is None:
+                    break
+                if is_rf64 and chunk_size == 0xFFFFFFFF \
+                        and rf64_data_size is not None:
+                    chunk_size = rf64_data_size
+                data_size = min(chunk_size, file_size - chunk_start)
+                format_tag, channels, sample_rate, _, block_align, \
+                    bits_per_sample = fmt
+                if format_tag == WAVE_FORMAT_EXTENSIBLE \
+                        and len(fmt_chunk) >= 26:
+                    # the real format is the first 2 bytes of the sub format
+                    format_tag = struct.unpack("<H", fmt_chunk[24:26])[0]
+                return WavInfo(format_tag, channels, sample_rate,
+                               bits_per_sample, block_align,
+                               chunk_start, data_size, fmt_chunk)
+            # chunks are word aligned
+            f.seek(chunk_start + chunk_size + (chunk_size & 1))
+    raise ValueError("%s has no fmt/data chunk"%fn)
+
+
+def is_pcm(info):
+    ''' Uncompressed linear samples, the only layout we can slice by bytes
+    '''
+    return info.format_tag in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT) \
+        and info.block_align > 0 and info.sample_rate > 0
+
+
+def wav_num_frames(info):
+    return info.data_size // info.block_align
+
+
+def wav_duration(info):
+    ''' Exact duration in seconds, to the sample
+    '''
+    return wav_num_frames(info) / info.sample_rate
+
+
+def segment_frame_range(info, start, duration):
+    ''' (first frame, number of frames) of a segment given in seconds,
+        clipped to the frames available in the file
+    '''
+    total_frames = wav_num_frames(info)
+    start_frame = min(max(int(round(start * info.sample_rate)), 0),
+                      total_frames)
+    num_frames = max(int(round(duration * info.sample_rate)), 0)
+    return start_frame, min(num_frames, total_frames - start_frame)
+
+
+def build_wav_header(info, num_frames):
+    ''' RIFF header for num_frames frames in the sample format of info; the
+        source fmt chunk is copied verbatim so the layout is unchanged
+    '''
+    fmt_chunk = info.fmt_chunk + b"\x00" * (len(info.fmt_chunk) & 1)
+    data_size = num_frames * info.block_align
+    riff_size = 4 + (8 + len(fmt_chunk)) + (8 + data_size + (data_size & 1))
+    if riff_size > 0xFFFFFFFF:
+        raise ValueError("Segment too large for a RIFF container")
+    return b"".join([b"RIFF", struct.pack("<I", riff_size), b"WAVE",
+                     b"fmt ", struct.pack("<I", len(info.fmt_chunk)), fmt_chunk,
+                     b"data", struct.pack("<I", data_size)])
+
+
+def copy_wav_segment(src, info, start_frame, num_frames, out,
+                     buffer=None):
+    ''' Write a complete wav file holding frames
+        [start_frame, start_frame + num_frames) of the open source file src
+        to the writable binary file out.  The sample bytes are copied as is.
+
+        :params buffer: reusable bytearray for the copy
+    '''
+    if buffer is None:
+        buffer = bytearray(1 << 20)
+    view = memoryview(buffer)
+    out.write(build_wav_header(info, num_frames))
+    src.seek(info.data_offset + start_frame * info.block_align)
+    remaining = num_frames * info.block_align
+    while remaining > 0:
+        n = src.readinto(view[:min(remaining, len(buffer))])
+        if not n:
+            break
+        out.write(view[:n])
+        remaining -= n
+    if remaining > 0:  # truncated source file, keep the header honest
+        out.write(b"\x00" * remaining)
+    if (num_frames * info.block_align) & 1:
+        out.write(b"\x00")
+
+
+def wav_segment_size(info, num_frames):
+    ''' Size in bytes of the wav file copy_wav_segment writes
+    '''
+    data_size = num_frames * info.block_align
+    return len(build_wav_header(info, num_frames)) + data_size \
+           + (data_size & 1)
+
+
+def read_wav_segment(src, info, start_frame, num_frames, first=0, last=None,
+                     buffer_size=1 << 20):
+    ''' Bytes [first, last) of the wav file copy_wav_segment would write,
+        without writing it: the header is built in memory and the samples
+        are read from their offset in the open source file src, chunk by
+        chunk.  Generator of bytes.
+    '''
+    header = build_wav_header(info, num_frames)
+    data_size = num_frames * info.block_align
+    size = len(header) + data_size + (data_size & 1)
+    last = size if last is None else min(last, size)
+    if first < len(header):
+        yield header[first:last]
+        first = len(header)
+    # offsets into the sample data from here on
+    first -= len(header)
+    last -= len(header)
+    src.seek(info.data_offset + start_frame * info.block_align + first)
+    while first < min(last, data_size):
+        data = src.read(min(min(last, data_size) - first, buffer_size))
+        if not data:  # truncated source file, keep the header honest
+            break
+        first += len(data)
+        yield data
+    if first < last:
+        yield b"\x00" * (last - first)
+
+
+def extract_wav_segments(fn, segments, info=None, buffer_size=1 << 20):
+    ''' Cut several segments out of one PCM wav file, opening it once.
+
+        :params segments: iterable of (start seconds, duration seconds, outfn)
+    '''
+    if info is None:
+        info = read_wav_header(fn)
+    buffer = bytearray(buffer_size)
+    with open(fn, "rb") as src:
+        for start, duration, outfn in segments:
+            start_frame, num_frames = segment_frame_range(info, start, duration)
+            with open(outfn, "wb") as out:
+                copy_wav_segment(src, info, start_frame, num_frames, out,
+                                 buffer=buffer)
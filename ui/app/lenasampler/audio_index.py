@@ -0,0 +1,122 @@
+''' Index of the files in audio directories, shared by all sessions.
+
+Directories are listed with os.scandir and the entries kept in the app
+database.  A directory is only listed again when its mtime changed (a file
+was added, removed or renamed), and then only entries whose size, mtime or
+kind changed are written back.  Entries LENASampler does not use (AppleDouble
+"._" files, non-wav files, sub directories) are kept as skipped, with the
+reason, so the quality report can list them.
+'''
+
+import os
+import time
+from collections import OrderedDict
+from app import db
+from app.models import AudioDirectory, AudioDirectoryEntry
+from app.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# a scan within this long after the last directory change may have missed
+# a change made in the same mtime tick, such scans are not trusted
+RACY_SCAN_NS = 2 * 10**9
+
+ENTRY_COLUMNS = ["name", "size", "mtime_ns", "status", "its_file", "idprefix"]
+
+# per process copy of recently used directory indexes, so a trusted
+# directory costs a single stat(): {path: (mtime_ns, scanned_ns, frame)}
+_recent = OrderedDict()
+RECENT_SIZE = 64
+
+
+def classify_entry(entry):
+    ''' (status, its_file, idprefix) of an os.DirEntry
+    '''
+    name = entry.name
+    if name.startswith("._"):
+        return "appledouble", None, None
+    if entry.is_dir():
+        return "directory", None, None
+    if not name.endswith("wav"):
+        return "not_wav", None, None
+    # M001_20210311_135447_010263_2.wav -> M001, 20210311_135447_010263_2.its
+    idprefix, _, rest = name.partition("_")
+    return "wav", rest.replace(".wav", ".its"), idprefix
+
+
+def refresh_audio_index(audio_dir):
+    ''' Bring the index of audio_dir up to date, return its entries as a
+        DataFrame (ENTRY_COLUMNS) sorted by name
+    '''
+    path = os.path.abspath(audio_dir)
+    dir_mtime_ns = os.stat(path).st_mtime_ns
+    if path in _recent:
+        mtime_ns, scanned_ns, frame = _recent[path]
+        if (mtime_ns == dir_mtime_ns) \
+                and (scanned_ns - dir_mtime_ns > RACY_SCAN_NS):
+            _recent.move_to_end(path)
+            return frame
+    directory = AudioDirectory.query.get(path)
+    entries = {entry.name: entry for entry in
+               AudioDirectoryEntry.query.filter_by(directory=path)}
+    if (directory is not None) and (directory.mtime_ns == dir_mtime_ns) \
+            and (directory.scanned_ns - dir_mtime_ns > RACY_SCAN_NS):
+        return _remember(path, directory.mtime_ns, directory.scanned_ns,
+                         _entries_frame(entries.values()))
+
+    scanned_ns = time.time_ns()
+    seen = set()
+    with os.scandir(path) as it:
+        for dir_entry in it:
+            seen.add(dir_entry.name)
+            status, its_file, idprefix = classify_entry(dir_entry)
+            try:
+                stat = dir_entry.stat()
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                status, size, mtime_ns = "unreadable", None, None
+            row = entries.get(dir_entry.name)
+            if (row is not None) and (row.size == size) \
+                    and (row.mtime_ns == mtime_ns) and (row.status == status):
+                continue
+            if row is None:
+                row = AudioDirectoryEntry(directory=path, name=dir_entry.name)
+                db.session.add(row)
+                entries[dir_entry.name] = row
+            row.size = size
+            row.mtime_ns = mtime_ns
+            row.status = status
+            row.its_file = its_file
+            row.idprefix = idprefix
+    for name in set(entries) - seen:
+        db.session.delete(entries.pop(name))
+    if directory is None:
+        directory = AudioDirectory(path=path)
+        db.session.add(directory)
+    directory.mtime_ns = dir_mtime_ns
+    directory.scanned_ns = scanned_ns
+    # read the rows before commit() expires them
+    frame = _entries_frame(entries.values())
+    db.session.commit()
+    return _remember(path, dir_mtime_ns, scanned_ns, frame)
+
+
+def _remember(path, mtime_ns, scanned_ns, frame):
+    _recent[path] = (mtime_ns, scanned_ns, frame)
+    _recent.move_to_end(path)
+    while len(_recent) > RECENT_SIZE:
+        _recent.popitem(last=False)
+    return frame
+
+
+def _entries_frame(entries):
+    df = pd.DataFrame([entry.to_dict() for entry in entries],
+                      columns=ENTRY_COLUMNS)
+    return df.sort_values("name").reset_index(drop=True)
+
+
+def skipped_audio_files(audio_dir):
+    ''' Entries of audio_dir that are not used, with the reason
+    '''
+    entries = refresh_audio_index(audio_dir)
+    return entries.loc[entries["status"] != "wav", ["name", "status"]]
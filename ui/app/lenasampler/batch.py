@@ -0,0 +1,269 @@
+''' Batch mode: run the LENASampler steps for many participants at once.
+
+A batch is a folder of LENA exports named <ID>_*.csv (or of <ID> sub folders
+of .its files, read in place of an export) and a root audio folder
+with one sub folder of wav files per participant ID.  Every participant goes
+through the same steps as the web flow (upload, quality check, filtering,
+sampling, export) with one shared parameter set, in its own process, and
+ends up as <output_dir>/<ID>_SampledAudioSegments.zip.  The sampled segments
+of all participants are listed in <output_dir>/batch_manifest.csv.
+'''
+
+import os
+import zlib
+import time
+import traceback
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from flask import current_app
+from config import Config
+from app import db, create_app
+from app.datastore import delete_dataset, read_table
+from app.lenasampler.filtering import filter_rows
+from app.lenasampler.features import FEATURE_COLUMNS, add_audio_features
+from app.lenasampler.sampling import draw_sample, parse_quotas
+from app.lenasampler.utils import read_lena_input, list_its_files, \
+                                  ingest_records, run_quality_check, \
+                                  load_export_rows, stream_audio_zip
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+DEFAULT_PARAMS = {
+    # its files to keep among the ones passing the quality check, None
+    # keeps them all
+    "its_files": None,
+    # {column: [min, max]} applied to the quality-checked its files, None
+    # for an open bound; like the filter page, rows without a value in
+    # DEFAULT_FILTER_NUM_COLUMNS are left out
+    "filter_ranges": {},
+    # columns the sampling ranges apply to, None for SAMPLING_CRITERIA_COLS;
+    # like the sampling page, rows without a value in them are left out
+    "sampling_criteria_cols": None,
+    # {column: [min, max]} applied before sampling, like the sampling page
+    "sampling_ranges": {},
+    "target_num_segments": 12,
+    "random_seed": 1,
+    "sampling_mode": "uniform",
+    "strata": "its",
+    "num_bins": 4,
+    "allocation": "proportional",
+    "weight_col": None,
+    # {stratum: count} or the "stratum: count" text of the sampling page
+    "quotas": {},
+}
+
+
+def find_participants(csv_dir, audio_root):
+    ''' {participant ID: (export csv or .its folder, audio folder)} of a
+        batch; the ID is the part of the csv name before the first "_", or
+        the name of a sub folder holding the .its files of the participant
+    '''
+    exports = sorted(glob(os.path.join(csv_dir, "*_*.csv")))
+    exports += sorted(path for path in glob(os.path.join(csv_dir, "*"))
+                      if os.path.isdir(path) and list_its_files(path))
+    participants = {}
+    for fn in exports:
+        pid = os.path.basename(fn).split("_")[0]
+        if pid in participants:
+            raise ValueError("More than one export for participant %s: "\
+                             "%s, %s"%(pid, participants[pid][0], fn))
+        participants[pid] = (fn, os.path.join(audio_root, pid))
+    return participants
+
+
+def participant_seed(random_seed, pid):
+    ''' Seed of one participant: stable for a given batch seed and ID, and
+        independent of which other participants are in the batch
+    '''
+    seq = np.random.SeedSequence(random_seed,
+                                 spawn_key=(zlib.crc32(pid.encode()),))
+    return int(seq.generate_state(1)[0])
+
+
+def sample_participant(dataset_id, idprefix, audio_dir, params,
+                       itsfile_col=Config.ITS_FILENAME_COL,
+                       duration_col=Config.DURATION_COL,
+                       timings=None):
+    ''' Quality check, filter and sample a stored dataset the way the web
+        pages do, return (sampled row positions, quality summary, allocation
+        report)
+
+        :params timings: optional dict, seconds spent per step are added
+    '''
+    params = dict(DEFAULT_PARAMS, **params)
+    timings = {} if timings is None else timings
+
+    t = time.time()
+    its_files = read_table(dataset_id, "its_files")
+    dft_summary, _, matched_itsfiles, _ = run_quality_check(None, audio_dir,
+        itsfile_col, duration_col, idprefix, its_files=its_files)
+    timings["quality_check"] = time.time() - t
+
+    # audio features are only measured when the batch uses them
+    used_cols = set(params["filter_ranges"]) | set(params["sampling_ranges"]) \
+        | set(params["sampling_criteria_cols"] or []) \
+        | set([params["strata"].split(":")[-1], params["weight_col"]])
+    if matched_itsfiles and used_cols & set(FEATURE_COLUMNS):
+        t = time.time()
+        add_audio_features(dataset_id, audio_dir, matched_itsfiles,
+                           itsfile_col=itsfile_col, duration_col=duration_col)
+        timings["audio_features"] = time.time() - t
+
+    t = time.time()
+    selected_itsfiles = matched_itsfiles
+    if params["its_files"] is not None:
+        selected_itsfiles = [its_file for its_file in matched_itsfiles
+                             if its_file in set(params["its_files"])]
+    filter_ranges = dict({col: (None, None) for col
+                          in current_app.config["DEFAULT_FILTER_NUM_COLUMNS"]},
+                         **params["filter_ranges"])
+    rows = filter_rows(dataset_id, selected_itsfiles,
+                       {col: tuple(bounds) for col, bounds
+                        in filter_ranges.items()})
+    sampling_cols = params["sampling_criteria_cols"]
+    if sampling_cols is None:
+        sampling_cols = current_app.config["SAMPLING_CRITERIA_COLS"]
+    sampling_ranges = dict({col: (None, None) for col in sampling_cols},
+                           **params["sampling_ranges"])
+    if sampling_ranges:
+        rows = np.intersect1d(rows, filter_rows(dataset_id, None,
+                                  {col: tuple(bounds) for col, bounds
+                                   in sampling_ranges.items()}),
+                              assume_unique=True)
+    timings["filter"] = time.time() - t
+
+    t = time.time()
+    quotas = params["quotas"]
+    if isinstance(quotas, str):
+        quotas = parse_quotas(quotas)
+    sampled_rows, report = draw_sample(dataset_id, rows,
+        params["target_num_segments"], params["random_seed"],
+        mode=params["sampling_mode"], strata=params["strata"],
+        num_bins=params["num_bins"], allocation=params["allocation"],
+        weight_col=params["weight_col"], quotas=quotas)
+    timings["sample"] = time.time() - t
+    return sampled_rows, dft_summary, report
+
+
+def export_participant(dataset_id, sampled_rows, idprefix, audio_dir,
+                       export_fn,
+                       itsfile_col=Config.ITS_FILENAME_COL,
+                       starttime_col=Config.START_TIME_COL,
+                       duration_col=Config.DURATION_COL):
+    ''' Write the zip of the sampled segments, return its metadata table
+    '''
+    df, df_ori, start_ns, its_start_ns = load_export_rows(dataset_id,
+        sampled_rows, itsfile_col, starttime_col)
+    tmp = export_fn + ".part"
+    with open(tmp, "wb") as f:
+        for chunk in stream_audio_zip(df, df_ori, audio_dir, idprefix,
+                                      itsfile_col, starttime_col,
+                                      duration_col, start_ns=start_ns,
+                                      its_start_ns=its_start_ns):
+            f.write(chunk)
+    os.replace(tmp, export_fn)
+    return df
+
+
+def run_participant(pid, csv_fn, audio_dir, output_dir, params):
+    ''' All steps for one participant, run in a worker process; returns
+        (summary dict, metadata of the sampled segments or None)
+    '''
+    summary = {"Participant": pid, "Export": csv_fn, "Audio Directory":
+               audio_dir, "Status": "done", "Sampled": 0, "Zip": "",
+               "Error": ""}
+    dataset_id = None
+    timings = {}
+    try:
+        with _worker_app.app_context():
+            if not os.path.isdir(audio_dir):
+                raise ValueError("Audio directory %s does not exist"
+                                 %audio_dir)
+            t = time.time()
+            # participants already run in parallel processes
+            dft, ingest_stats = read_lena_input(csv_fn, its_workers=1)
+            summary["Peak Memory MB"] = round(ingest_stats["peak_memory"] 
+                                              / 2**20, 1)
+            dataset_id = ingest_records(dft, pid)
+            del dft
+            timings["ingest"] = time.time() - t
+            sampled_rows, _, _ = sample_participant(dataset_id, pid,
+                                                    audio_dir, params,
+                                                    timings=timings)
+            t = time.time()
+            export_fn = os.path.join(output_dir,
+                                     "%s_SampledAudioSegments.zip"%pid)
+            df = export_participant(dataset_id, sampled_rows, pid,
+                                    audio_dir, export_fn)
+            timings["export"] = time.time() - t
+            db.session.remove()
+        summary["Sampled"] = len(df)
+        summary["Zip"] = os.path.basename(export_fn)
+        df.insert(0, "Participant", pid)
+        df.insert(1, "Zip", summary["Zip"])
+        return dict(summary, **{"%s_secs"%k: round(v, 3) 
+                                for k, v in timings.items()}), \
+               df
+    except Exception as e:
+        traceback.print_exc()
+        summary["Status"] = "failed"
+        summary["Error"] = "%s: %s"%(type(e).__name__, e)
+        return summary, None
+    finally:
+        with _worker_app.app_context():
+            delete_dataset(dataset_id)
+
+
+_worker_app = None
+
+
+def _init_worker(config):
+    # an app of its own with the parent's settings, so no database
+    # connection of the parent process is shared
+    global _worker_app
+    _worker_app = create_app(config)
+
+
+def batch_job(job, csv_dir, audio_root, output_dir, params,
+              n_workers=Config.BATCH_WORKERS):
+    ''' Background job: process every participant of a batch, spread over
+        n_workers processes.  Each participant samples with its own seed
+        derived from params["random_seed"] (see participant_seed).
+    '''
+    participants = find_participants(csv_dir, audio_root)
+    if not participants:
+        raise ValueError("No <ID>_*.csv exports found in %s"%csv_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    params = dict(DEFAULT_PARAMS, **params)
+    summaries = []
+    manifests = []
+    job.progress(0, len(participants), "Processing participants")
+    executor = ProcessPoolExecutor(max_workers=n_workers,
+                                   initializer=_init_worker,
+                                   initargs=(dict(current_app.config),))
+    try:
+        futures = [executor.submit(run_participant, pid, csv_fn, audio_dir,
+                       output_dir, dict(params, random_seed=participant_seed(
+                                            params["random_seed"], pid)))
+                   for pid, (csv_fn, audio_dir) in participants.items()]
+        for future in as_completed(futures):
+            summary, manifest = future.result()
+            summaries.append(summary)
+            if manifest is not None:
+                manifests.append(manifest)
+            job.progress(len(summaries), message="%s %s"
+                         %(summary["Participant"], summary["Status"]))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    summary = pd.DataFrame(summaries).sort_values("Participant")\
+                .reset_index(drop=True)
+    manifest = pd.concat(manifests, ignore_index=True) if manifests \
+               else pd.DataFrame()
+    summary.to_csv(os.path.join(output_dir, "batch_summary.csv"), index=False)
+    manifest.to_csv(os.path.join(output_dir, "batch_manifest.csv"),
+                    index=False)
+    manifest.to_csv(job.result_path("batch_manifest.csv"), index=False)
+    return summary
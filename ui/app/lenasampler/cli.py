@@ -0,0 +1,39 @@
+''' Command line entry points of the LENASampler, run through flask:
+
+    cd ui
+    flask lenasampler run params.yaml
+'''
+
+import sys
+import json
+import click
+from app.lenasampler import bp
+
+
+@bp.cli.command("run")
+@click.argument("param_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("--output-dir", default=None,
+              help="Overrides the output_dir of the parameter file.")
+@click.option("--workers", type=int, default=None,
+              help="Participants exported at the same time.")
+def run(param_file, output_dir, workers):
+    ''' Sample and export the participants of a YAML/JSON parameter file.
+
+        Prints one json line with the step timings per participant.
+    '''
+    # imported here, not when the app starts
+    from app.lenasampler.pipeline import load_param_file, run_pipeline
+    config = load_param_file(param_file)
+    if output_dir:
+        config["output_dir"] = output_dir
+
+    def log(summary):
+        click.echo(json.dumps(summary))
+
+    summary = run_pipeline(config, workers=workers, log=log)
+    failed = summary[summary["Status"] != "done"]
+    click.echo("%s of %s participants done, results in %s"
+               %(len(summary) - len(failed), len(summary),
+                 config["output_dir"]), err=True)
+    if len(failed):
+        sys.exit(1)
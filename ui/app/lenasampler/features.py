@@ -0,0 +1,282 @@
+''' Audio features of the LENA segments, measured in the matched recordings.
+
+Every wav file is read once, front to back, through a memory mapped numpy
+view in chunks of FEATURE_CHUNK_FRAMES frames, into statistics of short
+windows of FEATURE_WINDOW_SECS: the sum of squared samples, the peak level
+and the number of clipped frames.  A 16-hour recording is a single
+sequential pass holding one chunk in memory.  The window statistics are
+cached on disk next to the file's size and mtime, like the waveform
+envelopes:
+
+    <FEATURE_DIR>/<sha1 of the path>/<mtime_ns>_<size>_<frames>_<clip>.npy
+
+and the features of any segment are then sums and maxima over the windows
+it covers (segments are rounded out to whole windows):
+
+    RMS_dBFS       RMS level of the segment, dB relative to full scale
+    Peak_dBFS      largest absolute sample, dB relative to full scale
+    Clipping_Pct   percent of frames at or above FEATURE_CLIP_LEVEL
+    Silent_Pct     percent of windows quieter than FEATURE_SILENCE_DBFS
+
+They are stored as numeric columns of the records, so the filter and the
+sampling steps offer them like the columns of the LENA export.  Segments of
+files that are not PCM wav have no features (missing values).
+'''
+
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from config import Config
+from app.metrics import timed
+from app.datastore import has_table, read_table, read_column, \
+                          read_table_meta, add_columns
+from app.lenasampler.audio import read_wav_header, is_pcm, wav_num_frames
+from app.lenasampler.filtering import filter_rows, rebuild_column_index
+from app.lenasampler.waveform import sample_reader, _file_lock
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+FEATURE_COLUMNS = ["RMS_dBFS", "Peak_dBFS", "Clipping_Pct", "Silent_Pct"]
+# level reported for digital silence
+MIN_DBFS = -100.0
+
+
+def _dbfs(amplitude):
+    with np.errstate(divide="ignore"):
+        return np.maximum(20 * np.log10(amplitude), MIN_DBFS)
+
+
+def compute_window_stats(fn, window_frames,
+                         clip_level=Config.FEATURE_CLIP_LEVEL, info=None,
+                         chunk_frames=Config.FEATURE_CHUNK_FRAMES):
+    ''' float64 array (windows, 3) of the sum of squared samples (channels
+        averaged), the peak absolute sample and the number of clipped
+        frames of every window of window_frames frames, the last window
+        may be short
+    '''
+    if info is None:
+        info = read_wav_header(fn)
+    reader = sample_reader(fn, info) if is_pcm(info) else None
+    if reader is None:
+        raise ValueError("%s is not in a PCM format the feature "\
+                         "extraction reads"%fn)
+    frames, to_float = reader
+    # whole windows per chunk, so no window spans two chunks
+    chunk_frames = max(chunk_frames // window_frames, 1) * window_frames
+    num_windows = -(-len(frames) // window_frames)
+    stats = np.zeros((num_windows, 3), dtype=np.float64)
+    for start in range(0, len(frames), chunk_frames):
+        samples = np.abs(to_float(frames[start:start + chunk_frames]))
+        squares = (samples * samples).mean(axis=1)
+        peaks = samples.max(axis=1)
+        edges = np.arange(0, len(samples), window_frames)
+        first = start // window_frames
+        last = first + len(edges)
+        stats[first:last, 0] = np.add.reduceat(squares, edges,
+                                               dtype=np.float64)
+        stats[first:last, 1] = np.maximum.reduceat(peaks, edges)
+        stats[first:last, 2] = np.add.reduceat(peaks >= clip_level, edges,
+                                               dtype=np.int64)
+    del frames
+    return stats
+
+
+def load_window_stats(fn, window_secs=Config.FEATURE_WINDOW_SECS,
+                      clip_level=Config.FEATURE_CLIP_LEVEL, root=None):
+    ''' (cached window statistics (memory mapped), frames per window, wav
+        info) of a wav file, computed on first use and again whenever the
+        file's size or mtime changes; root defaults to the FEATURE_DIR of
+        the current app
+    '''
+    if root is None:
+        root = current_app.config["FEATURE_DIR"]
+    path = os.path.abspath(fn)
+    st = os.stat(path)
+    info = read_wav_header(path)
+    window_frames = max(int(round(window_secs * info.sample_rate)), 1)
+    folder = os.path.join(root, hashlib.sha1(path.encode()).hexdigest())
+    version = "%s_%s"%(st.st_mtime_ns, st.st_size)
+    stats_path = os.path.join(folder, "%s_%s_%s.npy"%(version, window_frames,
+                                                      clip_level))
+    with _file_lock(stats_path):
+        if not os.path.exists(stats_path):
+            stats = compute_window_stats(path, window_frames,
+                                         clip_level=clip_level, info=info)
+            os.makedirs(folder, exist_ok=True)
+            tmp = "%s.%s.tmp"%(stats_path, os.getpid())
+            with open(tmp, "wb") as f:
+                np.save(f, stats)
+            os.replace(tmp, stats_path)
+            # statistics of earlier versions of the file
+            for name in os.listdir(folder):
+                if not name.startswith(version + "_"):
+                    os.remove(os.path.join(folder, name))
+    return np.load(stats_path, mmap_mode="r"), window_frames, info
+
+
+def segment_features(fn, starts, durations,
+                     window_secs=Config.FEATURE_WINDOW_SECS,
+                     clip_level=Config.FEATURE_CLIP_LEVEL,
+                     silence_dbfs=Config.FEATURE_SILENCE_DBFS, root=None):
+    ''' DataFrame of the FEATURE_COLUMNS of segments of a wav file given by
+        their starts and durations in seconds, missing for segments outside
+        the recording
+    '''
+    stats, window_frames, info = load_window_stats(fn, window_secs,
+                                                   clip_level, root)
+    total_frames = wav_num_frames(info)
+    # segment_frame_range of every segment
+    start_frames = np.clip(np.rint(np.asarray(starts, dtype=np.float64)
+                                   * info.sample_rate), 0, total_frames)
+    end_frames = np.minimum(start_frames + np.maximum(np.rint(
+        np.asarray(durations, dtype=np.float64) * info.sample_rate), 0),
+        total_frames)
+    first = start_frames.astype(np.int64) // window_frames
+    last = -(-end_frames.astype(np.int64) // window_frames)
+    valid = last > first
+    # frames and windows covered, the last window of the file may be short
+    num_frames = np.minimum(last * window_frames, total_frames) \
+                 - first * window_frames
+    num_windows = np.maximum(last - first, 1)
+
+    window_sizes = np.minimum(np.arange(1, len(stats) + 1) * window_frames,
+                              total_frames) \
+                   - np.arange(len(stats)) * window_frames
+    silent = _dbfs(np.sqrt(stats[:, 0] / np.maximum(window_sizes, 1))) \
+             < silence_dbfs
+    sums = np.zeros((len(stats) + 1, 3))
+    sums[1:, 0] = np.cumsum(stats[:, 0])
+    sums[1:, 1] = np.cumsum(stats[:, 2])
+    sums[1:, 2] = np.cumsum(silent)
+    totals = sums[last] - sums[first]
+    # maxima over [first, last) ranges: reduceat over interleaved bounds,
+    # the reductions between two ranges are dropped
+    peaks = np.append(stats[:, 1], 0)
+    bounds = np.stack([np.minimum(first, len(stats)),
+                       np.minimum(last, len(stats))], axis=1).ravel()
+    segment_peaks = np.maximum.reduceat(peaks, bounds)[::2] \
+                    if len(bounds) else np.zeros(0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        features = pd.DataFrame({
+            "RMS_dBFS": _dbfs(np.sqrt(totals[:, 0] / num_frames)),
+            "Peak_dBFS": _dbfs(segment_peaks),
+            "Clipping_Pct": 100 * totals[:, 1] / num_frames,
+            "Silent_Pct": 100 * totals[:, 2] / num_windows})
+    features = features.round(2)
+    features.loc[~valid] = np.nan
+    return features
+
+
+def _segment_times(dataset_id, rows, itsfile_col, starttime_col):
+    ''' Starts in seconds since the start of their its file of the records
+        at row positions rows
+    '''
+    from app.lenasampler.utils import parse_start_times, its_start_times
+    if has_table(dataset_id, "start_times"):
+        start_ns = read_column(dataset_id, "start_times", "start_ns")
+        its_files = read_table(dataset_id, "its_files",
+                               columns=["its_file", "its_start_ns"])
+        its_start_ns = pd.Series(its_files["its_start_ns"].values,
+                                 index=its_files["its_file"].values)
+    else:
+        # dataset stored before start times were parsed at upload
+        records = read_table(dataset_id, "records",
+                             columns=[itsfile_col, starttime_col])
+        start_ns = parse_start_times(records[starttime_col])
+        first_rows = records.drop_duplicates(itsfile_col)
+        its_start_ns = its_start_times(first_rows[itsfile_col],
+            parse_start_times(first_rows[starttime_col]))
+    its_file_names = np.asarray(read_column(dataset_id, "records",
+                                            itsfile_col))[rows]
+    its_file_start_ns = its_start_ns.reindex(its_file_names).values
+    # whole seconds, the same starts the exported segments have
+    return (np.asarray(start_ns, dtype=np.int64)[rows]
+            - its_file_start_ns.astype(np.int64)) // 10**9
+
+
+@timed("lenasampler.audio_features")
+def audio_features(dataset_id, audio_dir, itsfiles,
+                   itsfile_col=Config.ITS_FILENAME_COL,
+                   starttime_col=Config.START_TIME_COL,
+                   duration_col=Config.DURATION_COL,
+                   n_workers=Config.FEATURE_WORKERS, progress=None):
+    ''' (DataFrame of the FEATURE_COLUMNS aligned with the records,
+        {its file: status}) of the segments of the its files itsfiles whose
+        wav files are in audio_dir; the files are read in parallel, the
+        other records have missing features.
+
+        :params progress: optional callable(done, total), once per file
+    '''
+    config = current_app.config
+    num_rows = read_table_meta(dataset_id, "records")["length"]
+    features = pd.DataFrame({col: np.full(num_rows, np.nan)
+                             for col in FEATURE_COLUMNS})
+    its_files = read_table(dataset_id, "its_files",
+                           columns=["its_file", "wav_file"])
+    wav_files = dict(zip(its_files["its_file"], its_files["wav_file"]))
+    durations = read_column(dataset_id, "records", duration_col)
+    jobs = []
+    for its_file in itsfiles:
+        rows = np.asarray(filter_rows(dataset_id, [its_file]))
+        if len(rows) and its_file in wav_files:
+            jobs.append((its_file, rows))
+    starts = _segment_times(dataset_id,
+                            np.concatenate([rows for _, rows in jobs])
+                            if jobs else np.zeros(0, np.int64),
+                            itsfile_col, starttime_col)
+
+    def run(its_file, rows, file_starts):
+        fn = os.path.join(audio_dir, wav_files[its_file])
+        try:
+            return its_file, rows, segment_features(fn, file_starts,
+                np.asarray(durations)[rows],
+                window_secs=config["FEATURE_WINDOW_SECS"],
+                clip_level=config["FEATURE_CLIP_LEVEL"],
+                silence_dbfs=config["FEATURE_SILENCE_DBFS"],
+                root=config["FEATURE_DIR"]), "ok"
+        except (OSError, ValueError) as e:
+            return its_file, rows, None, str(e)
+
+    statuses = {}
+    offsets = np.cumsum([0] + [len(rows) for _, rows in jobs])
+    # the statistics are numpy reductions over memory mapped chunks, which
+    # release the GIL, so threads read several files at once
+    with ThreadPoolExecutor(max(n_workers, 1)) as executor:
+        results = executor.map(run, [its_file for its_file, _ in jobs],
+                               [rows for _, rows in jobs],
+                               [starts[offsets[i]:offsets[i + 1]]
+                                for i in range(len(jobs))])
+        for i, (its_file, rows, file_features, status) in enumerate(results):
+            if file_features is not None:
+                features.iloc[rows] = file_features.values
+            statuses[its_file] = status
+            if progress is not None:
+                progress(i + 1, len(jobs))
+    return features, statuses
+
+
+def add_audio_features(dataset_id, audio_dir, itsfiles,
+                       itsfile_col=Config.ITS_FILENAME_COL,
+                       starttime_col=Config.START_TIME_COL,
+                       duration_col=Config.DURATION_COL, progress=None):
+    ''' Measure the audio features of the segments of the its files
+        itsfiles and store them as columns of the records, with their
+        filter indexes; returns {its file: status}
+    '''
+    features, statuses = audio_features(dataset_id, audio_dir, itsfiles,
+        itsfile_col, starttime_col, duration_col,
+        n_workers=current_app.config["FEATURE_WORKERS"], progress=progress)
+    add_columns(dataset_id, "records", features)
+    rebuild_column_index(dataset_id, FEATURE_COLUMNS)
+    return statuses
+
+
+def feature_columns(dataset_id):
+    ''' The FEATURE_COLUMNS the records of a dataset have
+    '''
+    columns = read_table_meta(dataset_id, "records")["columns"]
+    return [col for col in FEATURE_COLUMNS if col in columns]
@@ -0,0 +1,214 @@
+''' Index-backed row filtering for the quality filtering step.
+
+When a table is uploaded every filterable numeric column gets a sorted index
+(the argsort of the column and the values in that order) and the rows are
+grouped by its file.  A range predicate then costs two binary searches and
+picks its rows out of the argsort, an its file selection is a union of row
+ranges, and the predicates are combined by intersecting row sets, so no
+copy of the table is made.  Results are memoized per filter and version of
+the dataset's tables in a DatasetCache of the app (FILTER_CACHE_SIZE
+entries), so they are not reused once a column or an index has been
+written, and are dropped with the dataset.
+
+    <dataset>/filter_index/   <col>.order, <col>.sorted per indexed column,
+                              its.order (rows grouped by its file)
+    <dataset>/its_files/      its_row_start, its_row_stop into its.order
+'''
+
+from flask import current_app
+from config import Config
+from app.metrics import timed
+from app.datastore import has_table, read_table, read_table_meta, \
+                          read_column, write_table, add_columns, \
+                          table_version, dataset_cache
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+INDEX_TABLE = "filter_index"
+
+
+def _index_columns(dataset_id):
+    if not has_table(dataset_id, INDEX_TABLE):
+        return []
+    return read_table_meta(dataset_id, INDEX_TABLE)["columns"]
+
+
+def build_column_index(dataset_id, columns, table="records"):
+    ''' Add sorted indexes of the numeric columns to the dataset
+    '''
+    index = {}
+    for col in columns:
+        values = np.asarray(read_column(dataset_id, table, col),
+                            dtype=np.float64)
+        # NaN sorts last, so it is never inside a searchsorted range
+        order = np.argsort(values, kind="stable")
+        index["%s.order"%col] = order
+        index["%s.sorted"%col] = values[order]
+    index = pd.DataFrame(index)
+    if has_table(dataset_id, INDEX_TABLE):
+        add_columns(dataset_id, INDEX_TABLE, index)
+    else:
+        write_table(dataset_id, INDEX_TABLE, index)
+
+
+def rebuild_column_index(dataset_id, columns, table="records"):
+    ''' Index columns whose values were replaced, the memoized filter
+        results of the dataset are dropped with the old indexes
+    '''
+    build_column_index(dataset_id, columns, table=table)
+    filter_cache().clear(dataset_id)
+
+
+def build_its_index(dataset_id, its_files, itsfile_col, table="records"):
+    ''' Group the rows by its file; its_files is the its file table of the
+        dataset (one row per its file) and is extended with the row range
+        of every its file in the its.order index.
+    '''
+    its = pd.Categorical(read_table(dataset_id, table,
+                                    columns=[itsfile_col])[itsfile_col],
+                         categories=its_files["its_file"].values)
+    codes = its.codes
+    # rows are mostly already grouped by its file, a stable sort keeps them
+    # in file order within each group
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(its_files) + 1))
+    add_columns(dataset_id, "its_files", pd.DataFrame({
+        "its_row_start": bounds[:-1], "its_row_stop": bounds[1:]}))
+    index = pd.DataFrame({"its.order": order})
+    if has_table(dataset_id, INDEX_TABLE):
+        add_columns(dataset_id, INDEX_TABLE, index)
+    else:
+        write_table(dataset_id, INDEX_TABLE, index)
+
+
+def build_filter_index(dataset_id, its_files,
+                       itsfile_col=Config.ITS_FILENAME_COL,
+                       num_cols=Config.DEFAULT_FILTER_NUM_COLUMNS):
+    ''' Build all indexes used by filter_rows, called once per upload
+    '''
+    build_its_index(dataset_id, its_files, itsfile_col)
+    build_column_index(dataset_id, num_cols)
+
+
+def _ensure_index(dataset_id, columns):
+    ''' Indexes of datasets uploaded before a column was made filterable
+        are built on first use
+    '''
+    indexed = _index_columns(dataset_id)
+    if "its.order" not in indexed:
+        build_its_index(dataset_id, read_table(dataset_id, "its_files"),
+                        current_app.config["ITS_FILENAME_COL"])
+    missing = [col for col in columns if "%s.order"%col not in indexed]
+    if missing:
+        build_column_index(dataset_id, missing)
+
+
+def column_range(dataset_id, col):
+    ''' (min, max) of a numeric column ignoring missing values, from its
+        sorted index
+    '''
+    _ensure_index(dataset_id, [col])
+    values = read_column(dataset_id, INDEX_TABLE, "%s.sorted"%col)
+    n = np.searchsorted(values, np.inf, side="right")
+    if n == 0:
+        return None, None
+    lo, hi = values[0], values[n - 1]
+    if float(lo).is_integer() and float(hi).is_integer():
+        return int(lo), int(hi)
+    return float(lo), float(hi)
+
+
+def range_rows(dataset_id, col, minv=None, maxv=None):
+    ''' Unsorted row positions with minv <= col <= maxv
+    '''
+    values = read_column(dataset_id, INDEX_TABLE, "%s.sorted"%col)
+    lo = 0 if minv is None \
+         else np.searchsorted(values, minv, side="left")
+    hi = np.searchsorted(values, np.inf if maxv is None else maxv,
+                         side="right")
+    return read_column(dataset_id, INDEX_TABLE, "%s.order"%col)[lo:hi]
+
+
+def its_rows(dataset_id, selected_itsfiles):
+    ''' Unsorted row positions belonging to the selected its files
+    '''
+    its_files = read_table(dataset_id, "its_files",
+                           columns=["its_file", "its_row_start",
+                                    "its_row_stop"])
+    its_files = its_files[its_files["its_file"].isin(selected_itsfiles)]
+    order = read_column(dataset_id, INDEX_TABLE, "its.order")
+    if not len(its_files):
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([order[start:stop] for start, stop in
+                           zip(its_files["its_row_start"].values,
+                               its_files["its_row_stop"].values)])
+
+
+def _intersect(row_sets, num_rows):
+    ''' Sorted intersection of row position arrays; the smallest set is
+        probed against a membership mask of each of the others
+    '''
+    row_sets = sorted(row_sets, key=len)
+    rows = np.sort(row_sets[0])
+    mask = np.empty(num_rows, dtype=bool)
+    for other in row_sets[1:]:
+        if not len(rows):
+            break
+        mask[:] = False
+        mask[other] = True
+        rows = rows[mask[rows]]
+    return rows
+
+
+def filter_key(selected_itsfiles=None, ranges=None):
+    ''' Normalized, hashable form of a filter: the same selection in any
+        order, and bounds given as int or float, map to the same key
+    '''
+    its_key = None if selected_itsfiles is None \
+              else tuple(sorted(set(selected_itsfiles)))
+    range_key = tuple(sorted(
+        (col, None if minv is None else float(minv),
+              None if maxv is None else float(maxv))
+        for col, (minv, maxv) in (ranges or {}).items()))
+    return its_key, range_key
+
+
+def dataset_version(dataset_id):
+    ''' Versions of the tables filter_rows reads
+    '''
+    return tuple(table_version(dataset_id, table)
+                 for table in ("records", "its_files", INDEX_TABLE))
+
+
+def filter_cache():
+    ''' The memoized filter results of the current app
+    '''
+    return dataset_cache("filter_rows", current_app.config["FILTER_CACHE_SIZE"])
+
+
+def _filter_rows(dataset_id, its_key, range_key):
+    _ensure_index(dataset_id, [col for col, _, _ in range_key])
+    num_rows = read_table_meta(dataset_id, "records")["length"]
+    row_sets = [range_rows(dataset_id, col, minv, maxv)
+                for col, minv, maxv in range_key]
+    if its_key is not None:
+        row_sets.append(its_rows(dataset_id, its_key))
+    if not row_sets:
+        row_sets = [np.arange(num_rows)]
+    rows = _intersect(row_sets, num_rows)
+    rows.flags.writeable = False
+    return rows
+
+
+@timed("lenasampler.filter_rows")
+def filter_rows(dataset_id, selected_itsfiles=None, ranges=None):
+    ''' Sorted row positions of the records in the selected its files whose
+        columns fall in the inclusive ranges {col: (min, max)}; None means
+        no constraint.  The returned array is shared, do not modify it.
+    '''
+    its_key, range_key = filter_key(selected_itsfiles, ranges)
+    return filter_cache().get(dataset_id, dataset_version(dataset_id),
+        (its_key, range_key),
+        lambda: _filter_rows(dataset_id, its_key, range_key))
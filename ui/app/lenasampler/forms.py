@@ -1,16 +1,24 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, SelectField,\
                     SelectMultipleField, FormField, FieldList, IntegerField,\
-                    BooleanField
+                    BooleanField, TextAreaField, FloatField
 from flask_wtf.file import FileField, FileAllowed
-from wtforms.validators import DataRequired, NumberRange
-from app import app
+from wtforms.validators import DataRequired, NumberRange, Optional
+from config import Config
+from app.lenasampler.sampling import SAMPLING_MODES, ALLOCATIONS, \
+                                     strata_choices
+from app.lenasampler.features import FEATURE_COLUMNS
+from app.lenasampler.its import ITS_GRANULARITIES
 
 
 class DataInput(FlaskForm):
     fn = FileField("Upload a LENAExport csv file (must start with sampleID_, such as M001_XXX.csv)",
                     validators=[FileAllowed(['csv'],
                                  "Only csv file is accepted")])
+    its_dir = StringField("Or a folder of LENA .its files instead of the export (named by sampleID, such as M001)")
+    its_granularity = SelectField("Rows read from the .its files",
+                                  choices=ITS_GRANULARITIES,
+                                  default=str(Config.ITS_GRANULARITY))
     audio_dir = StringField("LENA Audio File Folder (contains WAV audio files, no child directory allowed)") 
     submit = SubmitField('Upload')
 
@@ -24,13 +32,25 @@ class FilterForm(FlaskForm):
         if len(itsfiles):
             self.itsfiles.choices = itsfiles
 
-for col in app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
+for col in Config.DEFAULT_FILTER_NUM_COLUMNS:
     setattr(FilterForm, "%s_min_value"%col, IntegerField("%s min value"%col))
     setattr(FilterForm, "%s_max_value"%col, IntegerField("%s max value"%col))
 
+# audio features, left empty for no constraint; the filter page removes them
+# until they have been measured
+for col in FEATURE_COLUMNS:
+    setattr(FilterForm, "%s_min_value"%col,
+            FloatField("%s min value"%col, validators=[Optional()]))
+    setattr(FilterForm, "%s_max_value"%col,
+            FloatField("%s max value"%col, validators=[Optional()]))
+
 setattr(FilterForm, "submit", SubmitField('Confirm'))
 
 
+class AudioFeaturesForm(FlaskForm):
+    measure = SubmitField("Measure audio features")
+
+
 class SamplingColsForm(FlaskForm):
     samplingcols \
         = SelectMultipleField("Which columns to be used as sampling criteria?",
@@ -45,4 +65,50 @@ class SamplingColsForm(FlaskForm):
 
 class ExportForm(FlaskForm):
     export_filename = StringField("Export as")
-    submit = SubmitField('Export')
\ No newline at end of file
+    background = BooleanField("Prepare in the background and download "\
+                              "when ready", default=True)
+    submit = SubmitField('Export')
+
+
+class BatchForm(FlaskForm):
+    csv_dir = StringField("Folder of LENAExport csv files (one per participant, named ID_XXX.csv)",
+                          validators=[DataRequired()])
+    audio_root = StringField("Audio root folder (one child folder of WAV files per participant, named by ID)",
+                             validators=[DataRequired()])
+    output_dir = StringField("Output folder (receives ID_SampledAudioSegments.zip per participant)",
+                             validators=[DataRequired()])
+    target_num_segments = IntegerField("Target number of segments per participant",
+        default=12, validators=[DataRequired(), NumberRange(min=0)])
+    random_seed = IntegerField("Sampling Seed (each participant gets its own seed derived from it)",
+        default=1, validators=[DataRequired(), NumberRange(min=0)])
+    sampling_mode = SelectField("Sampling mode", choices=SAMPLING_MODES,
+                                default="uniform")
+    strata = SelectField("Strata (stratified and quota modes)",
+        choices=strata_choices(Config.SAMPLING_CRITERIA_COLS),
+        default="its")
+    num_bins = IntegerField("Number of quantile bins", default=4,
+                            validators=[Optional(), NumberRange(min=1)])
+    allocation = SelectField("Allocation across strata (stratified mode)",
+                             choices=ALLOCATIONS, default="proportional")
+    weight_col = StringField("Weight column (weighted mode)")
+    quotas = TextAreaField("Quotas (quota mode), one 'stratum: count' per line")
+
+for col in Config.DEFAULT_FILTER_NUM_COLUMNS:
+    setattr(BatchForm, "%s_min_value"%col,
+            IntegerField("%s min value (filter)"%col, validators=[Optional()]))
+    setattr(BatchForm, "%s_max_value"%col,
+            IntegerField("%s max value (filter)"%col, validators=[Optional()]))
+
+for col in FEATURE_COLUMNS:
+    setattr(BatchForm, "%s_min_value"%col,
+            FloatField("%s min value (filter)"%col, validators=[Optional()]))
+    setattr(BatchForm, "%s_max_value"%col,
+            FloatField("%s max value (filter)"%col, validators=[Optional()]))
+
+for col in Config.SAMPLING_CRITERIA_COLS:
+    setattr(BatchForm, "sampling_%s_min_value"%col,
+            IntegerField("%s min value (sampling)"%col, validators=[Optional()]))
+    setattr(BatchForm, "sampling_%s_max_value"%col,
+            IntegerField("%s max value (sampling)"%col, validators=[Optional()]))
+
+setattr(BatchForm, "submit", SubmitField('Run batch'))
@@ -0,0 +1,232 @@
+''' Streaming reader of LENA .its files, an alternative to the LENA export.
+
+An .its file is the XML timeline of one recording day:
+
+    ITS > ... > Recording (startClockTime, startTime)
+              > Conversation | Pause (turnTaking, ...)
+                > Segment (spkr, startTime, endTime, femaleAdultWordCnt,
+                           maleAdultWordCnt, childUttCnt, ...)
+
+It is parsed with ElementTree.iterparse and every element is cleared and
+detached from its parent once it has been read, so the memory held does not
+grow with the file.  The segments are summed into rows of the columns a
+LENA export has, at one of these granularities:
+
+    "segment"        one row per segment
+    "conversation"   one row per Conversation or Pause block
+    <seconds>        bins of that many seconds from the start of each
+                     recording, 300 gives the 5 minute export
+
+Speech and sound seconds are split across the rows a segment overlaps, the
+counts go to the row the segment (CT_COUNT: the conversation) starts in.
+'''
+
+import os
+import math
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from config import Config
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# seconds of the segments of these speakers go to the export columns
+SPEAKER_COLUMNS = {
+    "MAN": "Meaningful", "FAN": "Meaningful", "CHN": "Meaningful",
+    "CXN": "Meaningful",
+    "MAF": "Distant", "FAF": "Distant", "CHF": "Distant", "CXF": "Distant",
+    "OLN": "Distant", "OLF": "Distant", "FUZ": "Distant",
+    "TVN": "TV", "TVF": "TV",
+    "NON": "Noise", "NOF": "Noise",
+    "SIL": "Silence",
+}
+SOUND_COLUMNS = ["Meaningful", "Distant", "TV", "Noise", "Silence"]
+COUNT_COLUMNS = ["AWC_COUNT", "CT_COUNT", "CV_COUNT"]
+# choices of the upload page
+ITS_GRANULARITIES = [("segment", "One row per segment"),
+                     ("conversation", "One row per conversation or pause"),
+                     ("60", "1 minute"), ("300", "5 minutes"),
+                     ("3600", "1 hour")]
+# StartTime as the LENA export writes it
+START_TIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+
+def its_seconds(value):
+    ''' Seconds of an its time offset such as "PT1234.56S"
+    '''
+    if not value:
+        return 0.0
+    return float(value.strip().lstrip("PT").rstrip("S"))
+
+
+def its_clock(value):
+    ''' Epoch seconds of an its clock time such as "2021-03-10T19:54:47Z"
+    '''
+    value = value.strip().rstrip("Z")
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def its_granularity(value):
+    ''' "segment", "conversation" or a positive number of seconds
+    '''
+    if value in ("segment", "conversation"):
+        return value
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        seconds = 0
+    if seconds <= 0:
+        raise ValueError("Unknown its granularity %r, use segment, "\
+                         "conversation or a number of seconds"%(value,))
+    return seconds
+
+
+def its_utc_offset(fn):
+    ''' Seconds from UTC to the local time of the recording, from the
+        LocalTime and UTCTime of the transfer in the header; 0 if the
+        header has none.  Stops reading at the first recording.
+    '''
+    for _, elem in ET.iterparse(fn, events=("start",)):
+        if elem.tag == "Recording":
+            break
+        if elem.get("LocalTime") and elem.get("UTCTime"):
+            return round(its_clock(elem.get("LocalTime"))
+                         - its_clock(elem.get("UTCTime")))
+    return 0
+
+
+def iter_its_segments(fn):
+    ''' Segments of an .its file in time order, read as a stream:
+        (recording number, block number, clock start, clock end (UTC epoch
+        seconds), speaker, adult words, child vocalizations, conversational
+        turns, clock start and end of the recording (end inf if the file
+        has none)).  The turns of a conversation come with its first
+        segment.
+    '''
+    parents = []
+    recording = block = 0
+    clock = offset = 0.0
+    recording_end = math.inf
+    turns = 0
+    for event, elem in ET.iterparse(fn, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "Recording":
+                recording += 1
+                clock = its_clock(elem.get("startClockTime"))
+                offset = its_seconds(elem.get("startTime"))
+                recording_end = math.inf
+                if elem.get("endTime"):
+                    recording_end = clock + its_seconds(elem.get("endTime")) \
+                                    - offset
+            elif elem.tag in ("Conversation", "Pause"):
+                block += 1
+                turns = int(float(elem.get("turnTaking") or 0))
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == "Segment":
+            words = float(elem.get("femaleAdultWordCnt") or 0) \
+                    + float(elem.get("maleAdultWordCnt") or 0)
+            yield (recording, block,
+                   clock + its_seconds(elem.get("startTime")) - offset,
+                   clock + its_seconds(elem.get("endTime")) - offset,
+                   elem.get("spkr"), words,
+                   int(float(elem.get("childUttCnt") or 0)), turns,
+                   clock, recording_end)
+            turns = 0
+        # read elements are dropped so the tree stays empty
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+
+
+def _pieces(segments, granularity):
+    ''' (row key, start, end, segment, first) of the parts of every segment
+        that fall in one row, in time order; first tells the part the
+        counts of the segment go to.  Bins start at the recording start.
+    '''
+    for i, segment in enumerate(segments):
+        recording, block, start, end = segment[:4]
+        if granularity == "segment":
+            yield i, start, end, segment, True
+        elif granularity == "conversation":
+            yield block, start, end, segment, True
+        else:
+            first = True
+            recording_start = segment[8]
+            while True:
+                bin_num = math.floor((start - recording_start) / granularity)
+                bin_end = recording_start + (bin_num + 1) * granularity
+                yield (recording, bin_num), start, min(end, bin_end), \
+                      segment, first
+                first = False
+                if end <= bin_end:
+                    break
+                start = bin_end
+
+
+def parse_its_file(fn, granularity=Config.ITS_GRANULARITY, utc_offset=None,
+                   itsfile_col=Config.ITS_FILENAME_COL,
+                   starttime_col=Config.START_TIME_COL,
+                   duration_col=Config.DURATION_COL):
+    ''' DataFrame of one .its file with the columns of a LENA export
+        (its file name, StartTime in local time, Duration_Secs, the seconds
+        of every SOUND_COLUMNS and the COUNT_COLUMNS), one row per
+        granularity unit.  A bin of N seconds starts k * N seconds after
+        its recording and lasts N seconds, the last one up to the end of
+        the recording.
+
+        :params utc_offset: seconds from UTC to local time, read from the
+                            file when None
+    '''
+    granularity = its_granularity(granularity)
+    if utc_offset is None:
+        utc_offset = its_utc_offset(fn)
+    sound_index = {col: i for i, col in enumerate(SOUND_COLUMNS)}
+    starts, ends, sounds, counts = [], [], [], []
+    key = None
+    bins = granularity not in ("segment", "conversation")
+    for piece_key, start, end, segment, first in _pieces(
+            iter_its_segments(fn), granularity):
+        if piece_key != key:
+            key = piece_key
+            if bins:
+                recording_start, recording_end = segment[8:10]
+                bin_start = recording_start + key[1] * granularity
+                starts.append(bin_start)
+                ends.append(min(bin_start + granularity, recording_end))
+            else:
+                starts.append(start)
+                ends.append(end)
+            sounds.append([0.0] * len(SOUND_COLUMNS))
+            counts.append([0.0, 0, 0])
+        if not bins:
+            ends[-1] = max(ends[-1], end)
+        column = SPEAKER_COLUMNS.get(segment[4])
+        if column is not None:
+            sounds[-1][sound_index[column]] += end - start
+        if first:
+            counts[-1][0] += segment[5]
+            counts[-1][1] += segment[7]
+            counts[-1][2] += segment[6]
+
+    starts = np.asarray(starts, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64).reshape(-1, 3)
+    # whole seconds, like the export
+    start_times = pd.to_datetime(np.floor(starts + utc_offset), unit="s")
+    df = pd.DataFrame({
+        itsfile_col: os.path.basename(fn),
+        starttime_col: start_times.strftime(START_TIME_FORMAT) + " (Local)",
+        duration_col: np.round(np.asarray(ends) - starts, 2)},
+        index=pd.RangeIndex(len(starts)))
+    for i, col in enumerate(SOUND_COLUMNS):
+        df[col] = np.round(np.asarray(sounds, dtype=np.float64)
+                           .reshape(-1, len(SOUND_COLUMNS))[:, i], 2)
+    df["AWC_COUNT"] = np.round(counts[:, 0], 2)
+    df["CT_COUNT"] = counts[:, 1].astype(np.int64)
+    df["CV_COUNT"] = counts[:, 2].astype(np.int64)
+    return df
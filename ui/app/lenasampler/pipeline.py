@@ -0,0 +1,256 @@
+''' Headless LENASampler: the upload, quality check, filter, sample and export
+steps without the web pages or a session, for scripted runs.
+
+    flask lenasampler run params.yaml
+
+The parameter file (YAML or JSON) lists the participants and the settings of
+the steps; relative paths are relative to the parameter file.
+
+    output_dir: out
+    output_format: zip        # or "folder": segment wavs + metadata csv
+    workers: 4                # participants exported at the same time
+    params:                   # settings of every step, see DEFAULT_PARAMS
+      target_num_segments: 12
+      random_seed: 1
+      filter_ranges: {Duration_Secs: [0, 100], Silence: [0, 3]}
+    participants:             # or csv_dir + audio_root as in batch mode
+      - export: exports/M001_export.csv
+        audio_dir: audio/M001
+        params: {its_files: [20210310_135447_010263_0.its]}
+      - export: its/M002        # a folder of .its files instead of an export
+        audio_dir: audio/M002
+
+Each participant is sampled with params["random_seed"] itself, so it gets
+the same sample and segments as the web pages give for the same settings.
+The seconds spent in every step of every participant are written to
+<output_dir>/timings.json and printed as one json line per participant.
+'''
+
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from config import Config
+from app import db
+from app.datastore import delete_dataset
+from app.lenasampler.batch import DEFAULT_PARAMS, find_participants, \
+                                  sample_participant, export_participant
+from app.lenasampler.utils import read_lena_input, ingest_records, \
+                                  load_export_rows, prepare_audio_files
+from app.lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+OUTPUT_FORMATS = ("zip", "folder")
+
+
+def load_param_file(fn):
+    ''' Read a YAML or JSON parameter file, with its paths made absolute
+    '''
+    with open(fn) as f:
+        if os.path.splitext(fn)[1].lower() in (".yaml", ".yml"):
+            import yaml
+            config = yaml.safe_load(f) or {}
+        else:
+            config = json.load(f)
+    basedir = os.path.dirname(os.path.abspath(fn))
+
+    def resolve(path):
+        return os.path.join(basedir, os.path.expanduser(path))
+
+    for key in ("output_dir", "csv_dir", "audio_root"):
+        if config.get(key):
+            config[key] = resolve(config[key])
+    for participant in config.get("participants") or []:
+        for key in ("export", "audio_dir"):
+            if participant.get(key):
+                participant[key] = resolve(participant[key])
+    return config
+
+
+def list_participants(config):
+    ''' [{"id", "idprefix", "export", "audio_dir", "params"}] of a
+        parameter file.  The idprefix that the audio files are named with is
+        the part of the export name before the first "_", as on the upload
+        page; the ID names the outputs and defaults to the idprefix.
+    '''
+    participants = []
+    if config.get("csv_dir"):
+        for pid, (csv_fn, audio_dir) in find_participants(
+                config["csv_dir"], config.get("audio_root") or "").items():
+            participants.append({"id": pid, "idprefix": pid, "export": csv_fn,
+                                 "audio_dir": audio_dir, "params": {}})
+    for participant in config.get("participants") or []:
+        if not participant.get("export") or not participant.get("audio_dir"):
+            raise ValueError("Every participant needs an export and an "\
+                             "audio_dir: %s"%participant)
+        idprefix = os.path.basename(participant["export"]).split("_")[0]
+        participants.append({"id": str(participant.get("id") or idprefix),
+                             "idprefix": idprefix,
+                             "export": participant["export"],
+                             "audio_dir": participant["audio_dir"],
+                             "params": participant.get("params") or {}})
+    ids = [participant["id"] for participant in participants]
+    duplicates = sorted(set(pid for pid in ids if ids.count(pid) > 1))
+    if duplicates:
+        raise ValueError("Participants listed more than once: %s"
+                         %", ".join(duplicates))
+    return participants
+
+
+def prepare_participant(participant, params):
+    ''' Upload, quality check, filter and sample one participant; returns
+        (dataset id, sampled row positions, timings)
+    '''
+    idprefix = participant["idprefix"]
+    timings = {}
+    if not os.path.isdir(participant["audio_dir"]):
+        raise ValueError("Audio directory %s does not exist"
+                         %participant["audio_dir"])
+    t = time.time()
+    dft, _ = read_lena_input(participant["export"])
+    dataset_id = ingest_records(dft, idprefix)
+    del dft
+    timings["ingest"] = time.time() - t
+    try:
+        sampled_rows, _, _ = sample_participant(dataset_id, idprefix,
+                                                participant["audio_dir"],
+                                                params, timings=timings)
+    except Exception:
+        delete_dataset(dataset_id)
+        raise
+    return dataset_id, sampled_rows, timings
+
+
+def export_sample(dataset_id, sampled_rows, idprefix, audio_dir, output_dir,
+                  output_format="zip", n_workers=1, name=None,
+                  itsfile_col=Config.ITS_FILENAME_COL,
+                  starttime_col=Config.START_TIME_COL,
+                  duration_col=Config.DURATION_COL):
+    ''' Export the sampled segments of one participant, as the zip archive
+        of the export page or as a folder; returns (output path, metadata)
+
+        :params name: names the output, defaults to idprefix
+    '''
+    name = name or idprefix
+    if output_format == "zip":
+        export_fn = os.path.join(output_dir,
+                                 "%s_SampledAudioSegments.zip"%name)
+        df = export_participant(dataset_id, sampled_rows, idprefix,
+                                audio_dir, export_fn)
+        return export_fn, df
+    outdir = os.path.join(output_dir, "%s_SampledAudioSegments"%name)
+    df, df_ori, start_ns, its_start_ns = load_export_rows(dataset_id,
+        sampled_rows, itsfile_col, starttime_col)
+    df = prepare_audio_files(df, df_ori, audio_dir, outdir, idprefix,
+                             itsfile_col, starttime_col, duration_col,
+                             n_workers=n_workers, start_ns=start_ns,
+                             its_start_ns=its_start_ns)
+    return outdir, df
+
+
+def _export_task(app, dataset_id, sampled_rows, participant, output_dir,
+                 output_format, n_workers):
+    t = time.time()
+    with app.app_context():
+        try:
+            path, df = export_sample(dataset_id, sampled_rows,
+                                     participant["idprefix"],
+                                     participant["audio_dir"], output_dir,
+                                     output_format, n_workers=n_workers,
+                                     name=participant["id"])
+            db.session.remove()
+            return path, df, time.time() - t
+        finally:
+            delete_dataset(dataset_id)
+
+
+def run_pipeline(config, workers=None, log=None):
+    ''' Run every participant of a parameter file (see load_param_file) in
+        this process.  Participants are prepared one after the other while
+        the exports of the ones already sampled run in `workers` threads.
+
+        :params log: optional callable receiving the summary dict of every
+                     finished participant
+        :return: summary table, one row per participant with the status,
+                 output and the seconds spent per step (*_secs columns)
+    '''
+    output_format = config.get("output_format", "zip")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output_format %s"%output_format)
+    if not config.get("output_dir"):
+        raise ValueError("The parameter file has no output_dir")
+    output_dir = config["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or config.get("workers") or 1
+    base_params = dict(DEFAULT_PARAMS, **(config.get("params") or {}))
+    participants = list_participants(config)
+    if not participants:
+        raise ValueError("The parameter file lists no participants")
+    # extraction in folder mode runs in processes of its own
+    n_workers = max(1, current_app.config["EXPORT_WORKERS"] // workers)
+    app = current_app._get_current_object()
+
+    summaries = {}
+    exports = []
+
+    def finish(summary):
+        summaries[summary["Participant"]] = summary
+        if log is not None:
+            log(summary)
+
+    def failed(summary, e):
+        traceback.print_exc()
+        summary["Status"] = "failed"
+        summary["Error"] = "%s: %s"%(type(e).__name__, e)
+        finish(summary)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for participant in participants:
+            summary = {"Participant": participant["id"],
+                       "Export": participant["export"],
+                       "Audio Directory": participant["audio_dir"],
+                       "Status": "done", "Sampled": 0, "Output": "",
+                       "Error": ""}
+            try:
+                params = dict(base_params, **participant["params"])
+                dataset_id, sampled_rows, timings \
+                    = prepare_participant(participant, params)
+            except Exception as e:
+                failed(summary, e)
+                continue
+            summary.update({"%s_secs"%k: round(v, 3)
+                            for k, v in timings.items()})
+            exports.append((summary, executor.submit(_export_task, app,
+                dataset_id, sampled_rows, participant, output_dir,
+                output_format, n_workers)))
+
+        for summary, future in exports:
+            try:
+                path, df, secs = future.result()
+            except Exception as e:
+                failed(summary, e)
+                continue
+            summary["Sampled"] = len(df)
+            summary["Output"] = os.path.basename(path)
+            summary["export_secs"] = round(secs, 3)
+            summary["total_secs"] = round(sum(v for k, v in summary.items()
+                                              if k.endswith("_secs")), 3)
+            finish(summary)
+
+    summaries = [summaries[participant["id"]] for participant in participants]
+    with open(os.path.join(output_dir, "timings.json"), "w") as f:
+        json.dump({"wall_secs": round(time.time() - start, 3),
+                   "workers": workers,
+                   "participants": [{k: v for k, v in s.items()
+                                     if k in ("Participant", "Status")
+                                     or k.endswith("_secs")}
+                                    for s in summaries]},
+                  f, indent=2)
+    summary = pd.DataFrame(summaries)
+    summary.to_csv(os.path.join(output_dir, "pipeline_summary.csv"),
+                   index=False)
+    return summary
@@ -1,24 +1,47 @@
 import os
-import uuid
-import shutil
 import tempfile
 import traceback
-import pandas as pd
-import zipfile
-from zipfile import ZipFile
 from werkzeug.utils import secure_filename
-from flask import redirect, render_template, url_for, request, session, Response
-from app import app
+from flask import redirect, render_template, url_for, request, session, \
+                  Response, stream_with_context, jsonify, abort, \
+                  current_app
+from flask_wtf import FlaskForm
+from wtforms import SubmitField, SelectField, IntegerField, TextAreaField, \
+                    FloatField
+from wtforms.validators import DataRequired, NumberRange, Optional
 from app.lenasampler import bp
-from app.lenasampler.forms import *
-from app.lenasampler.utils import *
+from app.lazy import lazy_import
+from app.jobs import submit_job, get_job_state, get_job_result, delete_job, \
+                     FINISHED_STATUSES
+from app.datastore import delete_dataset, has_table, numeric_columns, \
+                          read_table, read_table_meta, read_view, \
+                          table_length, write_table, write_view
+from app.tables import parse_table_query, query_table, table_csv_chunks, \
+                       table_page_json
+from app.lenasampler.forms import DataInput, FilterForm, SamplingColsForm, \
+                                  AudioFeaturesForm, ExportForm, BatchForm
+from app.lenasampler.audio import read_wav_header, is_pcm, \
+                                  segment_frame_range, wav_segment_size, \
+                                  read_wav_segment
+from app.lenasampler.utils import read_lena_export, read_its_files, \
+                                  list_its_files, ingest_records, \
+                                  locate_segment, quality_check_job, \
+                                  audio_features_job, load_export_rows, \
+                                  stream_audio_zip, export_audio_job
+from app.lenasampler.waveform import segment_envelope, envelope_svg
+from app.lenasampler.filtering import column_range, filter_rows
+from app.lenasampler.features import FEATURE_COLUMNS, feature_columns
+from app.lenasampler.sampling import SAMPLING_MODES, ALLOCATIONS, \
+                                     strata_choices, parse_quotas, \
+                                     draw_sample
+from app.lenasampler.batch import batch_job
+
+pd = lazy_import("pandas")
 
 
 @bp.route('/data', methods=['GET', 'POST'])
 def data():
     form = DataInput()
-    records = session.get('records', [])
-    columns = session.get('columns', [])
     filename = session.get('filename', '')
     audio_dir = session.get('audio_dir', '')
     quality_check_status = session.get('quality_check_status', 'Unknown')
@@ -33,29 +56,52 @@ def data():
                         %form.audio_dir.data)
 
         fn = form.fn.data
-        if fn:
-            filename = secure_filename(fn.filename)
-            session["filename"] = filename 
-            with tempfile.NamedTemporaryFile() as tmp:
-                fn.save(tmp.name)
-                try:
-                    dft = pd.read_csv(tmp.name) 
-                    dft = dft.reset_index()
-                    columns = list(dft.columns)
-                    records = dft.to_dict("records")
-                    session['columns'] = columns
-                    session['records'] = records
-                except Exception as e:
-                    return render_template("error.html", 
-                                            message=traceback.format_exc())
+        its_dir = form.its_dir.data
+        if fn or its_dir:
+            try:
+                if fn:
+                    filename = secure_filename(fn.filename)
+                    with tempfile.NamedTemporaryFile() as tmp:
+                        fn.save(tmp.name)
+                        dft, ingest_stats = read_lena_export(tmp.name)
+                else:
+                    if not os.path.isdir(its_dir):
+                        return render_template("error.html",
+                            message="ITS Folder %s does not exist. Please "\
+                                    "double check."%its_dir)
+                    # named by the participant, like the batch sub folders
+                    filename = os.path.basename(os.path.normpath(its_dir))
+                    dft, ingest_stats = read_its_files(
+                        list_its_files(its_dir),
+                        granularity=form.its_granularity.data,
+                        utc_offset=current_app.config["ITS_UTC_OFFSET"])
+                columns = list(dft.columns)
+                # the table lives in the dataset store, the session only
+                # keeps a handle to it
+                dataset_id = ingest_records(dft, filename.split("_")[0])
+                delete_dataset(session.get('dataset_id'))
+                session["filename"] = filename
+                session['columns'] = columns
+                session['dataset_id'] = dataset_id
+                session['ingest_stats'] = ingest_stats
+            except Exception as e:
+                return render_template("error.html", 
+                                        message=traceback.format_exc())
 
         return redirect(url_for('lenasampler.view_data'))
 
+    ingest_stats = session.get('ingest_stats')
+    table_size = table_notes = ''
+    if ingest_stats:
+        table_size = "%s rows x %s columns, %.1f MB"%(ingest_stats["rows"], 
+            ingest_stats["columns"], ingest_stats["memory"] / 2**20)
+        table_notes = "%.1f MB at most while reading"\
+                      %(ingest_stats["peak_memory"] / 2**20)
     status_df = pd.DataFrame({
         "Current Items": ["Filename", "Audio Directory", 
-                 "Pass Quality Check"],
-        "Value": [filename, audio_dir, quality_check_status],
-        "Notes": ['', '', '']
+                 "Pass Quality Check", "Table Size"],
+        "Value": [filename, audio_dir, quality_check_status, table_size],
+        "Notes": ['', '', '', table_notes]
     })
     status_df = status_df.reset_index()
     status_records = status_df.to_dict("records")
@@ -69,95 +115,321 @@ def data():
 
 @bp.route('/view_data', methods=['GET', 'POST'])
 def view_data():
-    records = session.get('records', [])
     columns = session.get('columns', [])
     return render_template("lenasampler/view_data.html",
                             columns=columns,
-                            records=records)
+                            table_url=url_for("lenasampler.table", 
+                                              view="records"))
+
+
+@bp.route('/table/<view>', methods=['GET'])
+def table(view):
+    ''' A page of the uploaded records, or of its filtered/sampled rows, as
+        json (or the whole selection as csv with format=csv)
+    '''
+    if view not in ("records", "filtered", "sampled"):
+        abort(404)
+    dataset_id = session.get('dataset_id')
+    rows = None
+    if view != "records":
+        rows = read_view(dataset_id, view)
+        if (rows is None) and (view == "sampled"):
+            rows = []
+    try:
+        query = parse_table_query(request.args)
+        if request.args.get("format") == "csv":
+            return Response(stream_with_context(table_csv_chunks(dataset_id, 
+                                "records", rows=rows, **query)), headers={
+                'Content-Type': 'text/csv',
+                'Content-Disposition': 'attachment; filename=%s.csv;'%view
+            })
+        total, filtered, page = query_table(dataset_id, "records", 
+                                            rows=rows, **query)
+    except (KeyError, ValueError) as e:
+        abort(400, str(e))
+    return jsonify(table_page_json(total, filtered, page, query["offset"]))
+
+
+def preview_urls():
+    ''' Url prefixes of the waveform thumbnail and the audio of a record,
+        the row position is appended by the table
+    '''
+    return {"waveform": url_for("lenasampler.waveform", row=0)[:-1],
+            "audio": url_for("lenasampler.segment_audio", row=0)[:-1]}
+
+
+def session_segment(row):
+    ''' (audio file, start, duration) of a record of the session's
+        dataset, 404 if there is no such record
+    '''
+    dataset_id = session.get('dataset_id')
+    if (not dataset_id) or not (0 <= row < table_length(dataset_id, 
+                                                        "records")):
+        abort(404)
+    idprefix = session.get("filename", "").split("_")[0]
+    return locate_segment(dataset_id, row, session.get('audio_dir', ''),
+                          idprefix)
+
+
+@bp.route('/waveform/<int:row>', methods=['GET'])
+def waveform(row):
+    ''' SVG thumbnail of the waveform of a record's segment
+    '''
+    audio_filepath, start, duration = session_segment(row)
+    try:
+        lows, highs = segment_envelope(audio_filepath, start, duration)
+    except (OSError, ValueError) as e:
+        abort(404, str(e))
+    return Response(envelope_svg(lows, highs), headers={
+        'Content-Type': 'image/svg+xml',
+        'Cache-Control': 'private, max-age=3600'
+    })
+
+
+def wav_segment_response(audio_filepath, start, duration):
+    ''' A segment of a PCM wav file as a wav download, honoring a Range
+        request (so audio elements can seek); built from the source file on
+        the fly, nothing is written to disk
+    '''
+    try:
+        info = read_wav_header(audio_filepath)
+    except (OSError, ValueError) as e:
+        abort(404, str(e))
+    if not is_pcm(info):
+        abort(415, "Only PCM wav files can be previewed")
+    start_frame, num_frames = segment_frame_range(info, start, duration)
+    size = wav_segment_size(info, num_frames)
+    headers = {
+        'Content-Type': 'audio/wav',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=3600'
+    }
+    first, last, status = 0, size, 200
+    if request.range is not None:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={
+                'Content-Range': 'bytes */%s'%size})
+        first, last = byte_range
+        status = 206
+        headers['Content-Range'] = 'bytes %s-%s/%s'%(first, last - 1, size)
+    headers['Content-Length'] = str(last - first)
+
+    def generate():
+        with open(audio_filepath, "rb") as src:
+            yield from read_wav_segment(src, info, start_frame, num_frames,
+                                        first, last)
+
+    return Response(generate(), status=status, headers=headers)
+
+
+@bp.route('/segment/<int:row>', methods=['GET'])
+def segment_audio(row):
+    ''' The audio of a record's segment as a wav file
+    '''
+    return wav_segment_response(*session_segment(row))
+
+
+@bp.route('/segment', methods=['GET'])
+def its_segment_audio():
+    ''' The audio of any segment of an its file of the session's dataset,
+        ?its_file=<its file name>&start=<seconds>&duration=<seconds> with
+        start relative to the beginning of the its file's recording
+    '''
+    dataset_id = session.get('dataset_id')
+    if not dataset_id:
+        abort(404)
+    its_file = request.args.get("its_file", "")
+    start = request.args.get("start", type=float)
+    duration = request.args.get("duration", type=float)
+    if (start is None) or (duration is None) or (start < 0) \
+            or (duration <= 0):
+        abort(400, "start and duration must be seconds")
+    its_files = read_table(dataset_id, "its_files")
+    wav_files = its_files.loc[its_files["its_file"] == its_file, "wav_file"]
+    if not len(wav_files):
+        abort(404, "Unknown its file %s"%its_file)
+    audio_filepath = os.path.join(session.get('audio_dir', ''),
+                                  wav_files.iloc[0])
+    return wav_segment_response(audio_filepath, start, duration)
 
 
 @bp.route('/quality_check', methods=['GET', 'POST'])
 def quality_check():
-    columns = session.get('columns', [])
-    records = session.get('records', [])
-    quality_summary_columns = session.get("quality_summary_columns", [])
-    quality_summary_records = session.get("quality_summary_records", [])
-    quality_perfile_columns = session.get("quality_perfile_columns", [])
-    quality_perfile_records = session.get("quality_perfile_records", [])
+    dataset_id = session.get('dataset_id')
+    itsfilecol = current_app.config["ITS_FILENAME_COL"]
+    durationcol = current_app.config["DURATION_COL"]
     audio_dir = session.get('audio_dir', None)
-    itsfilecol = app.config["ITS_FILENAME_COL"]
-    durationcol = app.config["DURATION_COL"]
     idprefix = session.get("filename", "").split("_")[0]
-    dft_summary, dft_per_file, matched_itsfiles, is_perfect_match \
-        = run_quality_check(records, audio_dir, itsfilecol, durationcol, 
-                            idprefix)
-    quality_summary_columns = dft_summary.columns
-    quality_summary_records = dft_summary.to_dict("records")
-    quality_perfile_columns = dft_per_file.columns
-    quality_perfile_records = dft_per_file.to_dict("records")
-    session["matched_itsfiles"] = matched_itsfiles
-    session["quality_summary_columns"] = quality_summary_columns
-    session["quality_summary_records"] = quality_summary_records
-    session["quality_perfile_columns"] = quality_perfile_columns
-    session["quality_perfile_records"] = quality_perfile_records
-    session['quality_check_status'] = is_perfect_match
+
+    # every visit runs a fresh check in the background, the page polls the
+    # job and reloads itself to show the report once it is done
+    job_id = session.get("quality_check_job")
+    job = get_job_state(job_id)
+    if job is None:
+        job_id = submit_job("LENA quality check", quality_check_job, 
+                            dataset_id, audio_dir, idprefix, 
+                            itsfilecol, durationcol)
+        session["quality_check_job"] = job_id
+        job = get_job_state(job_id)
+    if job["status"] not in FINISHED_STATUSES:
+        return render_template("lenasampler/quality_check.html",
+                                job=job,
+                                columns1=[], records1=[],
+                                columns2=[], records2=[])
+
+    session.pop("quality_check_job")
+    if job["status"] != "done":
+        delete_job(job_id)
+        return render_template("error.html", 
+            message=job["error"] or "The quality check was cancelled.")
+    result = get_job_result(job_id)
+    delete_job(job_id)
+    session["matched_itsfiles"] = result["matched_itsfiles"]
+    session['quality_check_status'] = result["is_perfect_match"]
+    dft_summary = read_table(dataset_id, "quality_summary")
+    dft_per_file = read_table(dataset_id, "quality_perfile")
 
     return render_template("lenasampler/quality_check.html",
-                            columns1=quality_summary_columns,
-                            records1=quality_summary_records,
-                            columns2=quality_perfile_columns,
-                            records2=quality_perfile_records)
+                            columns1=dft_summary.columns,
+                            records1=dft_summary.to_dict("records"),
+                            columns2=dft_per_file.columns,
+                            records2=dft_per_file.to_dict("records"))
+
+
+@bp.route('/audio_features', methods=['POST'])
+def audio_features():
+    ''' Measure the audio features of the matched recordings in the
+        background, the filter page shows the job
+    '''
+    dataset_id = session.get('dataset_id')
+    matched_itsfiles = session.get('matched_itsfiles', [])
+    if (not dataset_id) or (not matched_itsfiles):
+        return render_template("error.html",
+            message="Please run the quality check first, the audio "\
+                    "features are measured for the matched its files.")
+    if AudioFeaturesForm().validate_on_submit():
+        delete_job(session.get("audio_features_job"))
+        session["audio_features_job"] = submit_job("Measure audio features",
+            audio_features_job, dataset_id, session.get('audio_dir', ''),
+            matched_itsfiles, current_app.config["ITS_FILENAME_COL"],
+            current_app.config["DURATION_COL"],
+            current_app.config["START_TIME_COL"])
+    return redirect(url_for("lenasampler.filter"))
 
 
 @bp.route('/filter', methods=['GET', 'POST'])
 def filter():
+    dataset_id = session.get('dataset_id')
+    job_id = session.get("audio_features_job")
+    job = get_job_state(job_id)
+    if (job is not None) and (job["status"] in FINISHED_STATUSES):
+        session.pop("audio_features_job")
+        if job["status"] != "done":
+            delete_job(job_id)
+            return render_template("error.html",
+                message=job["error"] or "Measuring the audio features "\
+                                        "was cancelled.")
+        # the paged tables show the new columns too
+        session['columns'] = get_job_result(job_id)
+        delete_job(job_id)
+        job = None
     columns = session.get('columns', [])
-    records = session.get('records', [])
     matched_itsfiles = session.get('matched_itsfiles', [])
-    dft = pd.DataFrame.from_records(records)
-    records_after_filtering = session.get('records_after_filtering', records)
     selected_itsfiles = session.get('selected_itsfiles', matched_itsfiles)
     form = FilterForm(matched_itsfiles)
+    measured = feature_columns(dataset_id) if dataset_id else []
+    feature_cols = []
+    for col in FEATURE_COLUMNS:
+        minv, maxv = column_range(dataset_id, col) if col in measured \
+                     else (None, None)
+        if minv is None:  # not measured
+            del form["%s_min_value"%col]
+            del form["%s_max_value"%col]
+            continue
+        feature_cols.append(col)
+        # no default bounds: segments without features pass unless one is set
+        for bound in ["min", "max"]:
+            field = form["%s_%s_value"%(col, bound)]
+            field.label.text = "%s %s value (%s to %s)"%(col, bound,
+                                                         minv, maxv)
     if request.method == "GET":
-        for col in app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
-            minv = session.get("%s_min_value"%col, dft[col].min())
-            maxv = session.get("%s_max_value"%col, dft[col].max())
+        for col in current_app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
+            default_minv, default_maxv = column_range(dataset_id, col) \
+                                         if dataset_id else (None, None)
+            minv = session.get("%s_min_value"%col, default_minv)
+            maxv = session.get("%s_max_value"%col, default_maxv)
             setattr(getattr(form, "%s_min_value"%col), "data", minv)
             setattr(getattr(form, "%s_max_value"%col), "data", maxv)
             setattr(getattr(form, "itsfiles"), "data", selected_itsfiles)
+        for col in feature_cols:
+            form["%s_min_value"%col].data = session.get("%s_min_value"%col)
+            form["%s_max_value"%col].data = session.get("%s_max_value"%col)
 
     if form.validate_on_submit():
         # filter its files
         selected_itsfiles = form.itsfiles.data
         session["selected_itsfiles"] = selected_itsfiles
-        dft = dft[dft[app.config["ITS_FILENAME_COL"]].isin(selected_itsfiles)]
 
         # filter segments
-        for col in app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
+        ranges = {}
+        for col in current_app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
             minv = getattr(getattr(form, "%s_min_value"%col), "data")
             session["%s_min_value"%col] = minv
-            dft = dft[dft[col] >= minv]
             maxv = getattr(getattr(form, "%s_max_value"%col), "data")
             session["%s_max_value"%col] = maxv
-            dft = dft[dft[col] <= maxv]
-        records_after_filtering = dft.to_dict("records")
-        session["records_after_filtering"] = records_after_filtering
+            ranges[col] = (minv, maxv)
+        for col in feature_cols:
+            minv = form["%s_min_value"%col].data
+            session["%s_min_value"%col] = minv
+            maxv = form["%s_max_value"%col].data
+            session["%s_max_value"%col] = maxv
+            if (minv, maxv) != (None, None):
+                ranges[col] = (minv, maxv)
+        write_view(dataset_id, "filtered", 
+                   filter_rows(dataset_id, selected_itsfiles, ranges))
 
     return render_template("lenasampler/filter.html",
                            form=form,
+                           features_form=AudioFeaturesForm() \
+                                         if matched_itsfiles else None,
+                           job=job,
                            columns=columns,
-                           records=records_after_filtering)
+                           table_url=url_for("lenasampler.table", 
+                                             view="filtered"),
+                           count_url=url_for("lenasampler.filter_count"))
+
+
+@bp.route('/filter_count', methods=['GET'])
+def filter_count():
+    ''' Number of segments the filter form would keep, for a live preview
+        while the bounds are edited
+    '''
+    dataset_id = session.get('dataset_id')
+    if not dataset_id:
+        abort(404)
+    ranges = {}
+    for col in current_app.config["DEFAULT_FILTER_NUM_COLUMNS"]:
+        ranges[col] = (request.args.get("%s_min_value"%col, type=float),
+                       request.args.get("%s_max_value"%col, type=float))
+    for col in feature_columns(dataset_id):
+        bounds = (request.args.get("%s_min_value"%col, type=float),
+                  request.args.get("%s_max_value"%col, type=float))
+        if bounds != (None, None):
+            ranges[col] = bounds
+    rows = filter_rows(dataset_id, request.args.getlist("itsfiles"), ranges)
+    return jsonify({"count": len(rows), 
+                    "total": table_length(dataset_id, "records")})
 
 
 @bp.route("/sample1", methods=['GET', 'POST'])
 def sample1():
-    records = session.get('records', [])
-    dft = pd.DataFrame.from_records(records)
-    num_cols = list(dft._get_numeric_data().columns)
+    meta = read_table_meta(session.get('dataset_id'), "records")
+    num_cols = numeric_columns(meta)
     sampling_cols_form = SamplingColsForm(num_cols)
     if request.method == "GET":
-        selected_sampling_cols = session.get("sampling_criteria_cols", 
-                                        app.config["SAMPLING_CRITERIA_COLS"])
+        selected_sampling_cols = session.get("sampling_criteria_cols",
+            current_app.config["SAMPLING_CRITERIA_COLS"])
         sampling_cols_form.samplingcols.data \
             = selected_sampling_cols  
 
@@ -168,16 +440,19 @@ def sample1():
     return render_template("lenasampler/sampling.html", 
                             form=sampling_cols_form,
                             columns=[],
-                            records=[])
+                            table_url=None)
 
 
 @bp.route("/sample2", methods=['GET', 'POST'])
 def sample2():
-    records = session.get('records_after_filtering', [])
-    sampled_records = session.get('sampled_records', [])
+    dataset_id = session.get('dataset_id')
+    if not has_table(dataset_id, "records"):
+        return render_template("error.html",
+            message="Please upload the LENA export data first.")
     columns = session.get('columns', [])
-    dft = pd.DataFrame.from_records(records)
     sampling_criteria_cols = session.get("sampling_criteria_cols", [])
+    dft = read_table(dataset_id, "records", columns=sampling_criteria_cols,
+                     rows=read_view(dataset_id, "filtered"))
 
     class SamplingForm(FlaskForm):
         target_num_segments = IntegerField("Target number of segments", 
@@ -186,12 +461,37 @@ def sample2():
             default=1, validators=[DataRequired(), NumberRange(min=0)])
 
     for col in sampling_criteria_cols :
+        # audio features are measured to fractions of a dB or percent
+        field = FloatField if col in FEATURE_COLUMNS else IntegerField
         setattr(SamplingForm, "%s_min_value"%col, 
-            IntegerField("%s min value (>=, %s median is %s)"%(col, col, dft[col].median())))
+            field("%s min value (>=, %s median is %s)"%(col, col, dft[col].median())))
         setattr(SamplingForm, "%s_max_value"%col,
-            IntegerField("%s max value (<=, %s median is %s)"%(col, col, dft[col].median())))
+            field("%s max value (<=, %s median is %s)"%(col, col, dft[col].median())))
+    setattr(SamplingForm, "sampling_mode", 
+        SelectField("Sampling mode", choices=SAMPLING_MODES, 
+                    default="uniform"))
+    setattr(SamplingForm, "strata", 
+        SelectField("Strata (stratified and quota modes)", 
+                    choices=strata_choices(sampling_criteria_cols),
+                    default="its"))
+    setattr(SamplingForm, "num_bins", 
+        IntegerField("Number of quantile bins", default=4, 
+                     validators=[Optional(), NumberRange(min=1)]))
+    setattr(SamplingForm, "allocation", 
+        SelectField("Allocation across strata (stratified mode)", 
+                    choices=ALLOCATIONS, default="proportional"))
+    meta = read_table_meta(dataset_id, "records")
+    setattr(SamplingForm, "weight_col", 
+        SelectField("Weight column (weighted mode)", 
+                    choices=numeric_columns(meta),
+                    validate_choice=False))
+    setattr(SamplingForm, "quotas", 
+        TextAreaField("Quotas (quota mode), one 'stratum: count' per line, "\
+                      "strata are listed in the allocation report"))
     setattr(SamplingForm, "submit", SubmitField('Confirm'))
     form = SamplingForm()
+    sampling_options = ["sampling_mode", "strata", "num_bins", "allocation",
+                        "weight_col", "quotas"]
 
     if request.method == "GET":
         for col in sampling_criteria_cols:
@@ -203,6 +503,10 @@ def sample2():
                         session.get("random_seed", 1))
         setattr(getattr(form, "target_num_segments"), "data", 
                         session.get("target_num_segments", 12))
+        for option in sampling_options:
+            if "sampling_option_%s"%option in session:
+                setattr(getattr(form, option), "data", 
+                        session["sampling_option_%s"%option])
 
     if form.validate_on_submit():
         # filter segments
@@ -215,64 +519,153 @@ def sample2():
             maxv = getattr(getattr(form, "%s_max_value"%col), "data")
             session["sampling_%s_max_value"%col] = maxv
             dft = dft[dft[col] <= maxv]
-        dft = dft.sample(n=min(form.target_num_segments.data, len(dft)),
-                         replace=False, random_state=form.random_seed.data)
-        sampled_records = dft.to_dict("records")
-        session["sampled_records"] = sampled_records
+        for option in sampling_options:
+            session["sampling_option_%s"%option] \
+                = getattr(getattr(form, option), "data")
+        try:
+            sampled_rows, report = draw_sample(dataset_id, dft.index.values,
+                form.target_num_segments.data, form.random_seed.data,
+                mode=form.sampling_mode.data, strata=form.strata.data,
+                num_bins=form.num_bins.data or 4, 
+                allocation=form.allocation.data,
+                weight_col=form.weight_col.data,
+                quotas=parse_quotas(form.quotas.data or ""))
+        except ValueError as e:
+            return render_template("error.html", 
+                message="Could not sample with these settings: %s"%e)
+        write_view(dataset_id, "sampled", sampled_rows)
+        write_table(dataset_id, "sampling_report", report)
+
+    report = pd.DataFrame()
+    if read_view(dataset_id, "sampled") is not None:
+        report = read_table(dataset_id, "sampling_report")
 
     return render_template("lenasampler/sampling.html", 
                             form=form,
                             columns=columns,
-                            records=sampled_records)
+                            report_columns=report.columns,
+                            report_records=report.to_dict("records"),
+                            table_url=url_for("lenasampler.table", 
+                                              view="sampled"),
+                            preview_urls=preview_urls())
 
 
 @bp.route("/export_sampled_audio", methods=["GET", "POST"])
 def export_sampled_audio():
-    sampled_records = session.get('sampled_records', [])
+    dataset_id = session.get('dataset_id')
     columns = session.get('columns', [])
-    records = session.get('records', [])
-    df = pd.DataFrame.from_records(sampled_records)
-    df_ori = pd.DataFrame.from_records(records)
     audiodir = session.get('audio_dir', None)
     idprefix = session.get("filename", "").split("_")[0]
-    itsfilecol = app.config["ITS_FILENAME_COL"]
-    starttimecol = app.config["START_TIME_COL"]
-    durationcol = app.config["DURATION_COL"]
-
+    itsfilecol = current_app.config["ITS_FILENAME_COL"]
+    starttimecol = current_app.config["START_TIME_COL"]
+    durationcol = current_app.config["DURATION_COL"]
     form = ExportForm()
     if request.method == "GET":
         form.export_filename.data = "%s_SampledAudioSegments.zip"%idprefix
 
     if form.validate_on_submit():
-        outdir = "%s_SampledAudioSegments_%s"%(idprefix, uuid.uuid4())
-        df = prepare_audio_files(df, df_ori, audiodir, outdir, idprefix, 
-                                itsfilecol, starttimecol, durationcol)
-        # prepare zipfile for download
-        zipout = outdir + ".zip"
-        with ZipFile(zipout, "w", zipfile.ZIP_DEFLATED) as zipf:
-            zipdir(outdir, zipf)
-        shutil.rmtree(outdir, ignore_errors=True)
-        with open(zipout, 'rb') as f:
-            data = f.readlines()
-        os.remove(zipout)
+        sampled_rows = read_view(dataset_id, "sampled")
+        if sampled_rows is None:
+            sampled_rows = []
+        df, df_ori, start_ns, its_start_ns = load_export_rows(dataset_id, 
+            sampled_rows, itsfilecol, starttimecol)
         export_fn = form.export_filename.data
         if not export_fn:
             export_fn = "%s_SampledAudioSegments.zip"%idprefix
         if not export_fn.endswith(".zip"):
             export_fn = export_fn + ".zip"
-
-        return Response(data, headers={
+        export_fn = secure_filename(export_fn)
+
+        if form.background.data:
+            delete_job(session.get("export_job"))
+            session["export_job"] = submit_job("Export sampled audio", 
+                export_audio_job, df.copy(), df_ori, audiodir, idprefix,
+                itsfilecol, starttimecol, durationcol, export_fn,
+                start_ns=start_ns, its_start_ns=its_start_ns)
+            return redirect(url_for("lenasampler.export_sampled_audio"))
+
+        # the archive is built while it is being downloaded
+        data = stream_audio_zip(df, df_ori, audiodir, idprefix, 
+                                itsfilecol, starttimecol, durationcol,
+                                start_ns=start_ns, its_start_ns=its_start_ns)
+        return Response(stream_with_context(data), headers={
             'Content-Type': 'application/zip',
             'Content-Disposition': 'attachment; filename=%s;'%export_fn
         })
 
     return render_template("lenasampler/export.html", 
                             form=form,
+                            job=get_job_state(session.get("export_job")),
                             columns=columns,
-                            records=sampled_records)
+                            table_url=url_for("lenasampler.table", 
+                                              view="sampled"),
+                            preview_urls=preview_urls())
+
+
+@bp.route("/batch", methods=["GET", "POST"])
+def batch():
+    form = BatchForm()
+    job_id = session.get("batch_job")
+    job = get_job_state(job_id)
+
+    if form.validate_on_submit():
+        if not os.path.isdir(form.csv_dir.data):
+            return render_template("error.html",
+                message="Folder %s does not exist. Please double check."\
+                        %form.csv_dir.data)
+        if not os.path.isdir(form.audio_root.data):
+            return render_template("error.html",
+                message="Audio root folder %s does not exist. Please double "\
+                        "check."%form.audio_root.data)
+        params = {
+            "filter_ranges": {col: [
+                getattr(form, "%s_min_value"%col).data,
+                getattr(form, "%s_max_value"%col).data]
+                for col in current_app.config["DEFAULT_FILTER_NUM_COLUMNS"]},
+            "sampling_ranges": {col: [
+                getattr(form, "sampling_%s_min_value"%col).data,
+                getattr(form, "sampling_%s_max_value"%col).data]
+                for col in current_app.config["SAMPLING_CRITERIA_COLS"]},
+            "target_num_segments": form.target_num_segments.data,
+            "random_seed": form.random_seed.data,
+            "sampling_mode": form.sampling_mode.data,
+            "strata": form.strata.data,
+            "num_bins": form.num_bins.data or 4,
+            "allocation": form.allocation.data,
+            "weight_col": form.weight_col.data or None,
+        }
+        # audio features are only measured and filtered on when bounded
+        for col in FEATURE_COLUMNS:
+            bounds = [getattr(form, "%s_min_value"%col).data,
+                      getattr(form, "%s_max_value"%col).data]
+            if bounds != [None, None]:
+                params["filter_ranges"][col] = bounds
+        try:
+            params["quotas"] = parse_quotas(form.quotas.data or "")
+        except ValueError as e:
+            return render_template("error.html", 
+                message="Could not read the quotas: %s"%e)
+        delete_job(job_id)
+        session["batch_job"] = submit_job("LENASampler batch", batch_job,
+            form.csv_dir.data, form.audio_root.data, form.output_dir.data,
+            params)
+        return redirect(url_for("lenasampler.batch"))
+
+    summary = pd.DataFrame()
+    if (job is not None) and (job["status"] == "done"):
+        summary = get_job_result(job_id)
+    return render_template("lenasampler/batch.html",
+                            form=form,
+                            job=job,
+                            columns=summary.columns,
+                            records=summary.to_dict("records"))
 
 
 @bp.route("/reset_session", methods=["GET", "POST"])
 def reset_session():
+    delete_dataset(session.get('dataset_id'))
+    delete_job(session.get('export_job'))
+    delete_job(session.get('batch_job'))
+    delete_job(session.get('audio_features_job'))
     session.clear()
     return render_template("lenasampler/reset_session.html")
\ No newline at end of file
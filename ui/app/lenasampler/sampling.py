@@ -0,0 +1,186 @@
+''' Sampling engine for the sampling step.
+
+Rows are drawn without replacement, optionally split into strata (its file,
+hour of day or quantile bins of a column), optionally weighted by a numeric
+column.  Every draw is one vectorized pass: each row gets a random key
+(exponential keys divided by the weight when weighted), rows are sorted by
+(stratum, key) and the first `allocation` rows of every stratum are kept.
+The draws use a numpy Generator seeded with the random seed, so the same
+seed gives the same sample; plain uniform sampling keeps the original
+RandomState draw so earlier seeds still reproduce earlier samples.
+'''
+
+from config import Config
+from app.metrics import timed
+from app.datastore import read_table
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+SAMPLING_MODES = [("uniform", "Uniform"),
+                  ("stratified", "Stratified"),
+                  ("weighted", "Weighted by a column"),
+                  ("quota", "Quota per stratum")]
+ALLOCATIONS = [("proportional", "Proportional to stratum size"),
+               ("equal", "Equal per stratum")]
+
+
+def strata_choices(sampling_criteria_cols):
+    return [("its", "ITS file"), ("hour", "Hour of day")] \
+           + [("bins:%s"%col, "Quantile bins of %s"%col)
+              for col in sampling_criteria_cols]
+
+
+def strata_values(dataset_id, rows, by, num_bins=4,
+                  itsfile_col=Config.ITS_FILENAME_COL):
+    ''' Stratum label of every row (rows: row positions of the records)
+
+        :params by: "its", "hour" or "bins:<column>"
+    '''
+    if by == "its":
+        return read_table(dataset_id, "records", columns=[itsfile_col],
+                          rows=rows)[itsfile_col].astype(str).values
+    if by == "hour":
+        start_ns = read_table(dataset_id, "start_times",
+                              rows=rows)["start_ns"].values
+        return np.char.zfill(((start_ns // (3600 * 10**9)) % 24).astype(str),
+                             2)
+    if by.startswith("bins:"):
+        col = by[len("bins:"):]
+        values = read_table(dataset_id, "records", columns=[col],
+                            rows=rows)[col]
+        bins = pd.qcut(values, num_bins, duplicates="drop").astype(str)
+        # rows without a value are left out of every stratum
+        return bins.where(values.notnull(), None).values
+    raise ValueError("Unknown strata %s"%by)
+
+
+def parse_quotas(text):
+    ''' "stratum: count" pairs, one per line or comma separated
+    '''
+    quotas = {}
+    for item in text.replace("\n", ",").split(","):
+        if not item.strip():
+            continue
+        label, count = item.rsplit(":", 1)
+        quotas[label.strip()] = int(count)
+    return quotas
+
+
+def allocate(sizes, n, allocation="proportional"):
+    ''' Number of rows to draw from each stratum, never more than its size
+    '''
+    sizes = np.asarray(sizes, dtype=np.int64)
+    n = min(n, int(sizes.sum()))
+    if allocation == "proportional":
+        exact = n * sizes / max(sizes.sum(), 1)
+        alloc = np.floor(exact).astype(np.int64)
+        # hand out the remainder by largest fractional part
+        remainder = n - alloc.sum()
+        alloc[np.argsort(-(exact - alloc), kind="stable")[:remainder]] += 1
+        return alloc
+    if allocation == "equal":
+        # fill the smallest strata first, their leftover share goes to the
+        # larger ones
+        alloc = np.zeros(len(sizes), dtype=np.int64)
+        remaining = n
+        for i, s in enumerate(np.argsort(sizes, kind="stable")):
+            alloc[s] = min(sizes[s], remaining // (len(sizes) - i))
+            remaining -= alloc[s]
+        return alloc
+    raise ValueError("Unknown allocation %s"%allocation)
+
+
+def sample_uniform(index, n, random_seed):
+    ''' The original sampling: identical to DataFrame.sample(n,
+        random_state=random_seed), so seeds reproduce earlier exports.
+        Returns (sampled labels, allocation report) like sample_rows.
+    '''
+    index = np.asarray(index)
+    n = min(n, len(index))
+    rs = np.random.RandomState(random_seed)
+    report = pd.DataFrame({"Stratum": ["all"], "Available": [len(index)],
+                           "Target": [n], "Sampled": [n]})
+    return index[rs.choice(len(index), size=n, replace=False)], report
+
+
+def sample_rows(index, n, random_seed, strata=None, weights=None,
+                allocation="proportional", quotas=None):
+    ''' Draw rows without replacement.
+
+        :params index: labels of the candidate rows
+        :params strata: stratum label per row, None for a single stratum
+        :params weights: sampling weight per row; rows with a missing or
+                         non-positive weight are never drawn
+        :params allocation: "proportional" or "equal" split of n over strata
+        :params quotas: {stratum: count}, overrides n and allocation
+        :return: (sampled labels, per-stratum allocation report)
+    '''
+    index = np.asarray(index)
+    if strata is None:
+        strata = np.full(len(index), "all", dtype=object)
+    codes, labels = pd.factorize(np.asarray(strata), sort=True)
+    rng = np.random.default_rng(random_seed)
+    keys = rng.random(len(index))
+    available = codes >= 0
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        available &= weights > 0
+        # Efraimidis-Spirakis: the smallest Exp(1) / w keys form a
+        # weighted sample without replacement
+        with np.errstate(divide="ignore", invalid="ignore"):
+            keys = -np.log1p(-keys) / weights
+    candidates = np.flatnonzero(available)
+    codes = codes[candidates]
+    sizes = np.bincount(codes, minlength=len(labels))
+
+    if quotas is not None:
+        target = np.array([quotas.get(str(label), 0) for label in labels],
+                          dtype=np.int64)
+        alloc = np.minimum(target, sizes)
+    else:
+        alloc = allocate(sizes, n, allocation)
+        target = alloc
+
+    order = np.lexsort((keys[candidates], codes))
+    sorted_codes = codes[order]
+    starts = np.searchsorted(sorted_codes, np.arange(len(labels)))
+    rank = np.arange(len(order)) - starts[sorted_codes]
+    sampled = candidates[order[rank < alloc[sorted_codes]]]
+
+    report = pd.DataFrame({"Stratum": [str(label) for label in labels],
+                           "Available": sizes,
+                           "Target": target,
+                           "Sampled": alloc})
+    return index[sampled], report
+
+
+@timed("lenasampler.draw_sample")
+def draw_sample(dataset_id, rows, n, random_seed, mode="uniform",
+                strata="its", num_bins=4, allocation="proportional",
+                weight_col=None, quotas=None):
+    ''' Sample among the row positions rows of the records of a dataset,
+        the sampling step of both the web and the batch flow
+
+        :params mode: one of SAMPLING_MODES
+        :params strata: stratum definition for the stratified and quota
+                        modes, see strata_values
+        :return: (sampled row positions, per-stratum allocation report)
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    if mode == "uniform":
+        return sample_uniform(rows, n, random_seed)
+    if mode not in ("stratified", "weighted", "quota"):
+        raise ValueError("Unknown sampling mode %s"%mode)
+    strata_labels = None
+    weights = None
+    if mode in ("stratified", "quota"):
+        strata_labels = strata_values(dataset_id, rows, strata,
+                                      num_bins=num_bins)
+    if mode == "weighted":
+        weights = read_table(dataset_id, "records", columns=[weight_col],
+                             rows=rows)[weight_col].values
+    return sample_rows(rows, n, random_seed, strata=strata_labels,
+                       weights=weights, allocation=allocation,
+                       quotas=(quotas or {}) if mode == "quota" else None)
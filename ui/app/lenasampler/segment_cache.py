@@ -0,0 +1,139 @@
+''' On-disk cache of extracted audio segments, shared by all exports.
+
+A segment is identified by its source file (absolute path, size and mtime,
+so a replaced recording never serves stale segments), its first sample and
+its number of samples:
+
+    <SEGMENT_CACHE_DIR>/<key[:2]>/<key>.wav     key = sha1 of the above
+
+Entries are written to a temporary file and renamed into place, so exports
+running at the same time (threads or processes) never see a partial
+segment and may safely write the same one.  Using an entry refreshes its
+mtime; once the cache grows past SEGMENT_CACHE_MAX_BYTES the least recently
+used entries are deleted until it is back under 90% of it.
+'''
+
+import os
+import hashlib
+import threading
+
+# the ffmpeg path (moviepy) decodes to this rate, it numbers the samples of
+# segments of files that are not PCM wav
+DECODED_SAMPLE_RATE = 44100
+
+# estimated bytes in the cache per root, kept by every process
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+class SegmentCache(object):
+    ''' Content addressed segment files, see the module docstring.  Plain
+        settings only, so it can be handed to worker processes.
+    '''
+    def __init__(self, root, max_bytes, cache_pcm=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.cache_pcm = cache_pcm
+
+    def key(self, audio_filepath, start_sample, num_samples):
+        path = os.path.abspath(audio_filepath)
+        st = os.stat(path)
+        return hashlib.sha1(("%s|%s|%s|%s|%s"%(path, st.st_size,
+            st.st_mtime_ns, start_sample, num_samples)).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], "%s.wav"%key)
+
+    def get(self, key):
+        ''' Path of a cached segment, None if it is not cached
+        '''
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        ''' Cache the segment that write(filename) writes, return its path
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the extension tells ffmpeg the format to write
+        tmp = "%s.%s.%s.tmp.wav"%(path[:-4], os.getpid(),
+                                  threading.get_ident())
+        try:
+            write(tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._added(size)
+        return path
+
+    def fetch(self, key, write):
+        ''' (path, "hit" or "miss") of a segment, written by write(filename)
+            into the cache if it is not cached yet
+        '''
+        path = self.get(key)
+        if path is not None:
+            return path, "hit"
+        return self.put(key, write), "miss"
+
+    def entries(self):
+        ''' [(last use, size, path)] of all cached segments
+        '''
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith(".tmp.wav"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def evict(self, target_bytes):
+        ''' Delete the least recently used segments until the cache holds
+            at most target_bytes, return the bytes left
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def _added(self, size):
+        with _sizes_lock:
+            if self.root not in _sizes:
+                # other processes add to the cache too, so the estimate is
+                # reset to the real size by every sweep
+                _sizes[self.root] = sum(size for _, size, _
+                                        in self.entries())
+            else:
+                _sizes[self.root] += size
+            if _sizes[self.root] > self.max_bytes:
+                _sizes[self.root] = self.evict(int(self.max_bytes * 0.9))
+
+
+def open_segment_cache(config):
+    ''' The SegmentCache of the app settings, None if it is disabled
+    '''
+    if not config.get("SEGMENT_CACHE_MAX_BYTES"):
+        return None
+    return SegmentCache(config["SEGMENT_CACHE_DIR"],
+                        config["SEGMENT_CACHE_MAX_BYTES"],
+                        cache_pcm=config.get("SEGMENT_CACHE_PCM", False))
@@ -1,10 +1,35 @@
 import os
+import time
 import shutil
-import pandas as pd
+import tempfile
 import zipfile
-from zipfile import ZipFile
-from tqdm import tqdm
-from moviepy.editor import *
+from zipfile import ZipFile, ZipInfo
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+                               as_completed
+from datetime import datetime
+from collections import Counter
+from functools import partial
+from flask import current_app
+from config import Config
+from app import db
+from app.models import AudioMetadata
+from app.metrics import timed
+from app.datastore import create_dataset, delete_dataset, has_table, \
+                          read_table, write_table, table_columns
+from app.lenasampler.filtering import build_filter_index
+from app.lenasampler.features import add_audio_features
+from app.lenasampler.its import parse_its_file, its_granularity
+from app.lenasampler.audio_index import refresh_audio_index, \
+                                        skipped_audio_files
+from app.lenasampler.audio import read_wav_header, is_pcm, wav_duration, \
+                                  extract_wav_segments, segment_frame_range, \
+                                  copy_wav_segment, wav_segment_size
+from app.lenasampler.segment_cache import DECODED_SAMPLE_RATE, \
+                                          open_segment_cache
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
 
 
 def remove_audio_fn_prefix(fn):
@@ -13,86 +38,270 @@ def remove_audio_fn_prefix(fn):
     return "_".join(fn.split("_")[1:])
 
 
-def its_wav_match_quality_check(its_file_names, audio_dir, idprefix):
-    audio_files = [ fn for fn in os.listdir(audio_dir) \
-                    if (fn.endswith("wav") and not fn.startswith("._"))]
-    its_to_wav_files = ["%s_%s"%(idprefix, fn.replace(".its", ".wav")) \
-        for fn in its_file_names]
-    missing_files = sorted(list(set(its_to_wav_files) - set(audio_files)))
-    missing_files = [remove_audio_fn_prefix(fn.replace(".wav", ".its"))\
-                     for fn in missing_files]
-    extra_files = sorted(list(set(audio_files) - set(its_to_wav_files)))
-    matched_files = sorted(list(set(audio_files) & set(its_to_wav_files))) 
+@timed("lenasampler.list_audio_files")
+def list_audio_files(audio_dir):
+    ''' Wav files of audio_dir, from the shared directory index
+    '''
+    entries = refresh_audio_index(audio_dir)
+    return list(entries.loc[entries["status"] == "wav", "name"])
+
+
+def build_its_file_table(df, idprefix, itsfile_col, duration_col):
+    ''' One row per its file: the wav file name it should map to and the
+        summed duration of its segments.  Computed once per upload.
+    '''
+    its_durations = df.groupby(itsfile_col, sort=False)[duration_col].sum()
+    its_files = its_durations.index.to_series().astype(str)
+    return pd.DataFrame({
+        "its_file": its_files.values,
+        "wav_file": (idprefix + "_" \
+                     + its_files.str.replace(".its", ".wav", regex=False)).values,
+        "its_duration": its_durations.values})
+
+
+def match_its_wav_files(its_files, audio_files):
+    ''' Outer join of the its file table and the audio files on the wav
+        name; Type tells matched / missing wav / extra wav apart.  Rows are
+        ordered like the quality report: matched, missing, extra, each by
+        wav file name.
+    '''
+    audio = pd.DataFrame({"wav_file": sorted(set(audio_files))})
+    matches = its_files.merge(audio, on="wav_file", how="outer",
+                              indicator=True)
+    merge_status = matches.pop("_merge").astype(str)
+    matches["Type"] = merge_status.map({
+        "both": "Matched",
+        "left_only": "No matching wav file",
+        "right_only": "No matching its file"})
+    order = merge_status.map({"both": 0, "left_only": 1, "right_only": 2})
+    matches = matches.iloc[np.lexsort((matches["wav_file"].values, 
+                                       order.values))]
+    return matches.reset_index(drop=True)
+
+
+@timed("lenasampler.its_wav_match_quality_check")
+def its_wav_match_quality_check(its_file_names, audio_dir, idprefix,
+                                its_files=None):
+    ''' :params its_files: precomputed its file table, see
+                           build_its_file_table
+    '''
+    if its_files is None:
+        its_files = build_its_file_table(
+            pd.DataFrame({"its": its_file_names, "duration": 0}),
+            idprefix, "its", "duration")
+    matches = match_its_wav_files(its_files, list_audio_files(audio_dir))
+    missing_files = list(matches.loc[matches["Type"] == "No matching wav file",
+                                     "its_file"])
+    extra_files = list(matches.loc[matches["Type"] == "No matching its file",
+                                   "wav_file"])
+    matched_files = list(matches.loc[matches["Type"] == "Matched",
+                                     "wav_file"])
     if (len(missing_files) == 0) and (len(extra_files) == 0):
         is_perfect_match = True
     else:
         is_perfect_match = False
-    return missing_files, extra_files, matched_files, is_perfect_match
+    return missing_files, extra_files, matched_files, is_perfect_match, \
+           matches
 
 
-def get_audio_duration(fn):
-    ''' Measure the duration of a wav file
+def open_audio_clip(fn):
+    ''' moviepy clip of an audio file that is not PCM wav.  moviepy (and
+        what it pulls in) is slow to import and rarely needed, so it is
+        imported on first use.
     '''
-    a = AudioFileClip(fn)
-    return int(a.duration)
+    from moviepy.audio.io.AudioFileClip import AudioFileClip
+    return AudioFileClip(fn)
+
 
+@timed("lenasampler.probe_audio_file")
+def probe_audio_file(fn):
+    ''' Header information of an audio file.
 
-def check_audio_duration_match(df, audio_dir, matched_files, 
-                       missing_files, extra_files,
-                       itsfile_col, duration_col):
+        PCM wav files are measured from the header alone (exact to the
+        sample); anything else is handed to ffmpeg through moviepy, in which
+        case only the duration is known.
     '''
-        :params df: dataframe, should contain the its file name 
-                    column and duration column
+    try:
+        info = read_wav_header(fn)
+    except ValueError:
+        info = None
+    if info is not None and is_pcm(info):
+        return {"duration": wav_duration(info),
+                "sample_rate": info.sample_rate,
+                "channels": info.channels,
+                "bits_per_sample": info.bits_per_sample,
+                "format_tag": info.format_tag,
+                "data_offset": info.data_offset,
+                "data_size": info.data_size}
+    a = open_audio_clip(fn)
+    metadata = {"duration": a.duration,
+                "sample_rate": a.fps,
+                "channels": a.nchannels,
+                "bits_per_sample": None,
+                "format_tag": None if info is None else info.format_tag,
+                "data_offset": None,
+                "data_size": None}
+    a.close()
+    return metadata
+
+
+def get_audio_duration(fn, truncate=False):
+    ''' Measure the duration of a wav file
+
+        :params truncate: return whole seconds like int() does
     '''
-    records = []
-    for fn in matched_files:
-        itsfilename = fn.replace(".wav", ".its")
-        itsfilename = remove_audio_fn_prefix(itsfilename)
-        dft = df[df[itsfile_col] == itsfilename]
-        its_duration = dft[duration_col].sum()
-        audio_filepath = os.path.join(audio_dir, fn)
-        audio_duration = get_audio_duration(audio_filepath)
-        diff = audio_duration - its_duration
-        if diff == 0:
-            note = "Perfect match"
+    duration = probe_audio_file(fn)["duration"]
+    if truncate:
+        return int(duration)
+    return duration
+
+
+@timed("lenasampler.get_audio_metadata")
+def get_audio_metadata(fns, max_workers=Config.AUDIO_PROBE_WORKERS,
+                       progress=None):
+    ''' Header information for many audio files, return {fn: metadata}.
+
+        Results are cached in the AudioMetadata table keyed by absolute path
+        and validated against the file size and mtime, so unchanged files
+        cost one stat() call.  Files that are new or changed are probed
+        concurrently.
+        :params progress: optional callable(done, total)
+    '''
+    fns = list(fns)
+    if not fns:
+        return {}
+    paths = {fn: os.path.abspath(fn) for fn in fns}
+    stats = {path: os.stat(path) for path in paths.values()}
+    unique_paths = list(stats)
+    cached = {}
+    for i in range(0, len(unique_paths), 500):  # stay below sqlite's limit
+        rows = AudioMetadata.query\
+            .filter(AudioMetadata.path.in_(unique_paths[i:i+500])).all()
+        cached.update({row.path: row for row in rows})
+
+    now = datetime.utcnow()
+    metadata = {}
+    to_probe = []
+    for path in unique_paths:
+        row = cached.get(path)
+        if (row is not None) and row.matches(stats[path]):
+            row.last_used = now
+            metadata[path] = row.to_dict()
         else:
-            note = "The duration of its file and wav is not the same."
-        t_record = {"Filename": itsfilename,
-                    "Type": "Matched",
-                    "its duration (s)": its_duration,
-                    "wav duration (s)": audio_duration,
-                    "note": note}
-        records.append(t_record)
-    
-    for fn in missing_files:
-        dft = df[df[itsfile_col] == fn]
-        its_duration = dft[duration_col].sum()
-        t_record = {"Filename": fn, 
-                    "Type": "No matching wav file",
-                    "its duration (s)": its_duration,
-                    "wav duration (s)": "NA",
-                    "note": "No matching wav file found for this its file"}
-        records.append(t_record)
-    
-    for fn in extra_files:
-        audio_filepath = os.path.join(audio_dir, fn)
-        audio_duration = get_audio_duration(audio_filepath)
-        t_record = {"Filename": fn, 
-                    "Type": "No matching its file",
-                    "its duration (s)": "NA",
-                    "wav duration (s)": audio_duration,
-                    "note": "No matching its file found for this wav file"}
-        records.append(t_record)
-
-    return records
-
-
-def run_quality_check(records, audio_dir, itsfile_col, duration_col, idprefix):
-    df = pd.DataFrame(records)
-    its_file_names = df[itsfile_col].values
+            to_probe.append(path)
+
+    if to_probe:
+        probed = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for path, values in zip(to_probe, executor.map(probe_audio_file,
+                                                           to_probe)):
+                probed[path] = values
+                if progress is not None:
+                    progress(len(probed), len(to_probe))
+        for path, values in probed.items():
+            row = cached.get(path)
+            if row is None:
+                row = AudioMetadata(path=path)
+                db.session.add(row)
+            row.size = stats[path].st_size
+            row.mtime_ns = stats[path].st_mtime_ns
+            for k, v in values.items():
+                setattr(row, k, v)
+            row.last_used = now
+            metadata[path] = dict(values, path=path)
+    db.session.commit()
+    prune_audio_metadata()
+    return {fn: metadata[paths[fn]] for fn in fns}
+
+
+def prune_audio_metadata(max_entries=Config.AUDIO_METADATA_CACHE_SIZE,
+                         batch_size=1000):
+    ''' Drop cached entries of files that no longer exist, least recently
+        used first, then cap the table at max_entries rows.
+    '''
+    rows = AudioMetadata.query.order_by(AudioMetadata.last_used.asc())\
+                              .limit(batch_size).all()
+    for row in rows:
+        if not os.path.exists(row.path):
+            db.session.delete(row)
+    db.session.flush()
+    num_entries = AudioMetadata.query.count()
+    if num_entries > max_entries:
+        oldest = AudioMetadata.query.order_by(AudioMetadata.last_used.asc())\
+                    .limit(num_entries - max_entries).all()
+        for row in oldest:
+            db.session.delete(row)
+    db.session.commit()
+
+
+def get_audio_durations(fns, truncate=False, progress=None):
+    ''' Durations of many wav files, return {fn: duration}
+    '''
+    durations = {fn: metadata["duration"] for fn, metadata 
+                 in get_audio_metadata(fns, progress=progress).items()}
+    if truncate:
+        durations = {fn: int(d) for fn, d in durations.items()}
+    return durations
+
+
+@timed("lenasampler.check_audio_duration_match")
+def check_audio_duration_match(matches, audio_dir, progress=None):
+    '''
+        :params matches: its/wav match table from match_its_wav_files,
+                         its_duration holds the summed segment durations
+    '''
+    truncate = current_app.config["TRUNCATE_AUDIO_DURATION"]
+    is_matched = (matches["Type"] == "Matched").values
+    is_missing = (matches["Type"] == "No matching wav file").values
+    audio_filepaths = [os.path.join(audio_dir, fn) 
+                       for fn in matches.loc[~is_missing, "wav_file"]]
+    audio_durations = get_audio_durations(audio_filepaths, truncate=truncate,
+                                          progress=progress)
+
+    its_duration = matches["its_duration"]
+    if its_duration.dropna().mod(1).eq(0).all():
+        its_duration = its_duration.astype("Int64")
+    wav_duration = pd.Series(
+        [audio_durations[fn] for fn in audio_filepaths],
+        index=matches.index[~is_missing], dtype="float64")\
+        .reindex(matches.index)
+    if truncate:
+        wav_duration = wav_duration.astype("Int64")
+    diff = (wav_duration.astype("float64") \
+            - its_duration.astype("float64")).values
+
+    dft = pd.DataFrame({
+        "Filename": matches["its_file"].fillna(matches["wav_file"]),
+        "Type": matches["Type"],
+        "its duration (s)": its_duration.astype(object),
+        "wav duration (s)": wav_duration.astype(object)})
+    dft["note"] = np.select(
+        [is_matched & (diff == 0), is_matched, is_missing],
+        ["Perfect match",
+         "The duration of its file and wav is not the same.",
+         "No matching wav file found for this its file"],
+        default="No matching its file found for this wav file")
+    return dft.fillna("NA")
+
+
+@timed("lenasampler.run_quality_check")
+def run_quality_check(records, audio_dir, itsfile_col, duration_col, idprefix,
+                      its_files=None, progress=None):
+    '''
+        :params its_files: its file table precomputed at upload 
+                           (build_its_file_table), derived from records
+                           when not given
+        :params progress: optional callable(done, total) for audio probing
+    '''
+    if its_files is None:
+        df = pd.DataFrame(records)
+        its_files = build_its_file_table(df, idprefix, itsfile_col, 
+                                         duration_col)
     # does the its file column correspond to the audio wav file?
-    missing_files, extra_files, matched_files, is_perfect_match \
-        = its_wav_match_quality_check(its_file_names, audio_dir, idprefix)
+    missing_files, extra_files, matched_files, is_perfect_match, matches \
+        = its_wav_match_quality_check(None, audio_dir, idprefix, 
+                                      its_files=its_files)
+    skipped = skipped_audio_files(audio_dir)
     quality_records = [
         {"Item": "ITS files perfect match WAV files",
          "Value": is_perfect_match, "Notes": ''},
@@ -101,19 +310,21 @@ def run_quality_check(records, audio_dir, itsfile_col, duration_col, idprefix):
         {"Item": "WAV files without corresponding ITS files",
          "Value": ", ".join(extra_files), "Notes": ''},
         {"Item": "Matched ITS and WAV files",
-         "Value": ", ".join(matched_files), "Notes": ''}
+         "Value": ", ".join(matched_files), "Notes": ''},
+        {"Item": "Skipped files in the audio folder",
+         "Value": ", ".join(skipped["name"]), 
+         "Notes": ", ".join(sorted(set(skipped["status"])))}
     ]
     dft_summary = pd.DataFrame(quality_records)
     dft_summary = dft_summary.reset_index()
 
     # Does the length of a wav file correspond to 
     # the sum of the length of the segments?
-    duration_match_records = check_audio_duration_match(df, audio_dir, 
-        matched_files, missing_files, extra_files, itsfile_col, duration_col)
-    dft_per_file = pd.DataFrame(duration_match_records)
+    dft_per_file = check_audio_duration_match(matches, audio_dir, 
+                                              progress=progress)
     dft_per_file = dft_per_file.reset_index()
-    matched_itsfiles = [remove_audio_fn_prefix(fn.replace(".wav", ".its"))\
-                     for fn in matched_files]
+    matched_itsfiles = list(matches.loc[matches["Type"] == "Matched",
+                                        "its_file"])
 
     return dft_summary, dft_per_file, matched_itsfiles, is_perfect_match
 
@@ -124,51 +335,686 @@ def parse_time(time_str):
     return ts
 
 
+@timed("lenasampler.parse_start_times")
+def parse_start_times(time_strs, time_format=Config.START_TIME_FORMAT):
+    ''' Vectorized parse_time, return int64 epoch nanoseconds.
+
+        :params time_format: strftime format of the times once the "(...)"
+                             suffix is stripped, guessed from the first value
+                             when None
+    '''
+    time_strs = pd.Series(time_strs).astype(str)\
+                  .str.split("(", n=1).str[0].str.strip()
+    if (time_format is None) and len(time_strs):
+        time_format = pd._libs.tslibs.parsing.guess_datetime_format(
+            time_strs.iloc[0])
+    ts = pd.to_datetime(time_strs, format=time_format)
+    return ts.values.astype("datetime64[ns]").astype(np.int64)
+
+
+def its_start_times(its_files, start_ns):
+    ''' First start time (epoch ns) of every its file, in order of
+        appearance; the wav file starts at that time
+    '''
+    return pd.Series(np.asarray(start_ns))\
+             .groupby(np.asarray(its_files), sort=False).first()
+
+
+def audio_segment_filename(its_file, idprefix, start, duration, abs_ts):
+    ''' (source wav file name, segment wav file name) of a sampled segment
+    '''
+    audio_file = "%s_%s"%(idprefix, its_file.replace(".its", ".wav"))
+    segment_file = audio_file.replace(".wav", 
+        "_AbsStart_%s_RelStart_%s_Duration_%s.wav"%(abs_ts, start, duration))
+    return audio_file, segment_file
+
+
+def segment_sample_range(info, start, duration):
+    ''' (first sample, number of samples) a segment is cached under; info
+        is the wav header of its source file, None if it is not a wav file
+    '''
+    if info is not None and is_pcm(info):
+        return segment_frame_range(info, start, duration)
+    return int(round(start * DECODED_SAMPLE_RATE)), \
+           int(round(duration * DECODED_SAMPLE_RATE))
+
+
+def extract_segments_from_audio_file(audio_filepath, segments, cache=None):
+    ''' Write several segments of one audio file, opening it only once.
+
+        PCM wav files are sliced byte for byte (no decoding, bit-identical
+        samples); other formats go through moviepy/ffmpeg.  With a
+        SegmentCache, segments are copied from the cache and the missing
+        ones extracted into it first (PCM slices only if cache.cache_pcm).
+        :params segments: list of (start seconds, duration seconds, outfn)
+        :return: {outfn: "hit", "miss" or "uncached"}
+    '''
+    try:
+        info = read_wav_header(audio_filepath)
+    except ValueError:
+        info = None
+    pcm = info is not None and is_pcm(info)
+    if (cache is None) or (pcm and not cache.cache_pcm):
+        if pcm:
+            extract_wav_segments(audio_filepath, segments, info=info)
+        else:
+            a = open_audio_clip(audio_filepath)
+            for start, duration, outfn in segments:
+                segment = a.subclip(start, start+duration)
+                segment.write_audiofile(outfn)
+            a.close()
+        return {outfn: "uncached" for _, _, outfn in segments}
+
+    clips = []  # opened on the first segment that has to be decoded
+    statuses = {}
+    try:
+        for start, duration, outfn in segments:
+            def write(fn, start=start, duration=duration):
+                if pcm:
+                    extract_wav_segments(audio_filepath,
+                                         [(start, duration, fn)], info=info)
+                    return
+                if not clips:
+                    clips.append(open_audio_clip(audio_filepath))
+                clips[0].subclip(start, start+duration).write_audiofile(fn)
+            key = cache.key(audio_filepath,
+                            *segment_sample_range(info, start, duration))
+            path, statuses[outfn] = cache.fetch(key, write)
+            shutil.copyfile(path, outfn)
+    finally:
+        for clip in clips:
+            clip.close()
+    return statuses
+
+
+def extract_segments_safely(audio_filepath, segments, cache=None):
+    ''' Like extract_segments_from_audio_file but never raises, 
+        return ({outfn: error message} for the segments that failed,
+        {outfn: cache status} for the others)
+    '''
+    try:
+        return {}, extract_segments_from_audio_file(audio_filepath, segments,
+                                                    cache=cache)
+    except Exception:
+        pass
+    # find out which segments are broken
+    errors = {}
+    statuses = {}
+    for segment in segments:
+        try:
+            statuses.update(extract_segments_from_audio_file(audio_filepath,
+                [segment], cache=cache))
+        except Exception as e:
+            errors[segment[2]] = "%s: %s"%(type(e).__name__, e)
+    return errors, statuses
+
+
+@timed("lenasampler.extract_segments")
+def extract_segments(segments, n_workers=1, cache=None):
+    ''' Extract segments grouped by source file, 
+        return ({outfn: error message} for failed segments,
+        {outfn: cache status} for the others).
+
+        :params segments: {audio_filepath: [(start, duration, outfn), ...]}
+        :params n_workers: number of processes, 1 extracts in this process
+        :params cache: optional SegmentCache shared by the processes
+    '''
+    errors = {}
+    statuses = {}
+    if (n_workers <= 1) or (len(segments) <= 1):
+        for audio_filepath, file_segments in segments.items():
+            file_errors, file_statuses = extract_segments_safely(
+                audio_filepath, file_segments, cache=cache)
+            errors.update(file_errors)
+            statuses.update(file_statuses)
+        return errors, statuses
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(extract_segments_safely, audio_filepath,
+                                   file_segments, cache): file_segments
+                   for audio_filepath, file_segments in segments.items()}
+        for future in as_completed(futures):
+            try:
+                file_errors, file_statuses = future.result()
+            except Exception as e:  # the worker itself died
+                for segment in futures[future]:
+                    errors[segment[2]] = "%s: %s"%(type(e).__name__, e)
+                continue
+            errors.update(file_errors)
+            statuses.update(file_statuses)
+    return errors, statuses
+
+
 def extract_from_audio_file(its_file, audiodir, idprefix, start, duration,
                             abs_ts, outdir):
-    audio_file = "%s_%s"%(idprefix, its_file.replace(".its", ".wav"))
+    audio_file, segment_file = audio_segment_filename(its_file, idprefix, 
+                                                      start, duration, abs_ts)
     audio_filepath = os.path.join(audiodir, audio_file)
-    outfn = os.path.join(outdir, 
-        audio_file.replace(".wav", "_AbsStart_%s_RelStart_%s_Duration_%s.wav"\
-                                    %(abs_ts, start, duration)))
-    a = AudioFileClip(audio_filepath)
-    segment = a.subclip(start, start+duration)
-    segment.write_audiofile(outfn)
+    outfn = os.path.join(outdir, segment_file)
+    extract_segments_from_audio_file(audio_filepath, 
+                                     [(start, duration, outfn)])
     return outfn
 
 
-def prepare_audio_files(df, df_ori, audiodir, outdir, idprefix, 
-                        itsfilecol, starttimecol, durationcol):
-    if os.path.exists(outdir):  # remove existing outdir if there is one
-        shutil.rmtree(outdir, ignore_errors=True)
+def required_columns():
+    ''' Columns every later step needs, kept whatever the upload settings
+    '''
+    config = current_app.config
+    cols = [config["ITS_FILENAME_COL"], config["START_TIME_COL"],
+            config["DURATION_COL"]] \
+           + config["DEFAULT_FILTER_NUM_COLUMNS"] \
+           + config["SAMPLING_CRITERIA_COLS"]
+    return list(dict.fromkeys(cols))
+
+
+def downcast_column(series):
+    ''' Smallest dtype that holds the values exactly: integers go to the
+        smallest integer type, floats to float32 only when nothing is lost
+    '''
+    kind = series.dtype.kind
+    if kind in "iu":
+        return pd.to_numeric(series, downcast="integer" if kind == "i" \
+                                                        else "unsigned")
+    if kind == "f" and series.dtype.itemsize > 4:
+        downcast = series.astype(np.float32)
+        if np.array_equal(downcast.values.astype(series.dtype), 
+                          series.values, equal_nan=True):
+            return downcast
+    return series
+
+
+def _compact_chunk(chunk, max_category_ratio):
+    for col in chunk.columns:
+        if chunk[col].dtype.kind in "biuf":
+            chunk[col] = downcast_column(chunk[col])
+        elif chunk[col].dtype == object and len(chunk) \
+                and chunk[col].nunique() <= max_category_ratio * len(chunk):
+            chunk[col] = chunk[col].astype("category")
+    return chunk
+
+
+def _concat_chunks(chunks):
+    ''' Concatenate compacted chunks column by column; categoricals are
+        merged with union_categoricals so they stay categorical
+    '''
+    columns = {}
+    for col in chunks[0].columns:
+        parts = [chunk[col] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[col] = pd.Series(
+                pd.api.types.union_categoricals(parts, ignore_order=True))
+        else:
+            parts = [part.astype(object) 
+                     if isinstance(part.dtype, pd.CategoricalDtype) else part
+                     for part in parts]
+            merged = pd.concat(parts, ignore_index=True)
+            if merged.dtype.kind in "biuf":
+                merged = downcast_column(merged)
+            columns[col] = merged
+    return pd.DataFrame(columns)
+
+
+@timed("lenasampler.read_lena_export")
+def read_lena_export(fn, keep_columns=Config.LENA_CSV_KEEP_COLUMNS,
+                     dtypes=Config.LENA_CSV_DTYPES,
+                     chunk_bytes=Config.LENA_CSV_CHUNK_BYTES,
+                     max_memory=Config.LENA_CSV_MAX_MEMORY,
+                     max_category_ratio=Config.LENA_CSV_CATEGORY_RATIO):
+    ''' Read a LENA export csv in chunks into a compact DataFrame.
+
+        Numeric columns are downcast to the smallest exact dtype and
+        repetitive string columns (ITS_File_Name, ...) become categoricals,
+        chunk by chunk, so at most one chunk is held at full size.  The 
+        index column of the original upload (row number) is added first.
+
+        :params keep_columns: columns to keep besides required_columns(),
+                              None keeps every column
+        :params dtypes: explicit {column: dtype} for read_csv
+        :params chunk_bytes: memory budget of one parsed chunk
+        :params max_memory: largest table accepted, in bytes
+        :return: (df, stats) where stats has rows, columns, memory (bytes
+                 of the result) and peak_memory (bytes held at most while
+                 reading, estimated from the frames)
+    '''
+    header = pd.read_csv(fn, nrows=0).columns
+    usecols = None
+    if keep_columns is not None:
+        keep = set(keep_columns) | set(required_columns())
+        usecols = [col for col in header if col in keep]
+    reader = pd.read_csv(fn, usecols=usecols, dtype=dtypes or None,
+                         iterator=True)
+    chunks = []
+    held = 0
+    peak = 0
+    nrows = 1000
+    try:
+        while True:
+            try:
+                chunk = reader.get_chunk(nrows)
+            except StopIteration:
+                break
+            parsed = chunk.memory_usage(index=False, deep=True).sum()
+            peak = max(peak, held + parsed)
+            # size the next chunk to the memory budget
+            nrows = max(1000, int(chunk_bytes * len(chunk) / max(parsed, 1)))
+            chunk = _compact_chunk(chunk, max_category_ratio)
+            held += chunk.memory_usage(index=False, deep=True).sum()
+            if held > max_memory:
+                raise ValueError("%s needs more than %.0f MB in memory"
+                                 %(os.path.basename(fn), max_memory / 2**20))
+            chunks.append(chunk)
+    finally:
+        reader.close()
+    if not chunks:
+        df = pd.read_csv(fn, nrows=0, usecols=usecols)
+    else:
+        df = _concat_chunks(chunks)
+    del chunks
+    df.insert(0, "index", np.arange(len(df), 
+                                    dtype=np.min_scalar_type(max(len(df), 1))))
+    memory = int(df.memory_usage(index=False, deep=True).sum())
+    peak = max(peak, held + memory)
+    return df, {"rows": len(df), "columns": len(df.columns), 
+                "memory": memory, "peak_memory": int(peak)}
+
+
+@timed("lenasampler.read_its_files")
+def read_its_files(fns, granularity=Config.ITS_GRANULARITY,
+                   utc_offset=Config.ITS_UTC_OFFSET,
+                   n_workers=Config.ITS_PARSE_WORKERS,
+                   max_memory=Config.LENA_CSV_MAX_MEMORY,
+                   max_category_ratio=Config.LENA_CSV_CATEGORY_RATIO):
+    ''' Read LENA .its files into the compact DataFrame read_lena_export
+        gives for an export of them (see its.parse_its_file), in the order
+        of fns.  Each file is streamed, so only the rows are held.
+
+        :params n_workers: number of processes parsing files at once, 1
+                           parses them in this process
+        :return: (df, stats) as read_lena_export
+    '''
+    if not fns:
+        raise ValueError("No .its files to read")
+    config = current_app.config
+    parse = partial(parse_its_file, granularity=its_granularity(granularity),
+                    utc_offset=utc_offset,
+                    itsfile_col=config["ITS_FILENAME_COL"],
+                    starttime_col=config["START_TIME_COL"],
+                    duration_col=config["DURATION_COL"])
+    chunks = []
+    held = 0
+    peak = 0
+
+    def add(chunk, fn):
+        nonlocal held, peak
+        peak = max(peak, held + chunk.memory_usage(index=False, 
+                                                   deep=True).sum())
+        chunk = _compact_chunk(chunk, max_category_ratio)
+        held += chunk.memory_usage(index=False, deep=True).sum()
+        if held > max_memory:
+            raise ValueError("%s needs more than %.0f MB in memory"
+                             %(os.path.basename(fn), max_memory / 2**20))
+        chunks.append(chunk)
+
+    if (n_workers <= 1) or (len(fns) <= 1):
+        for fn in fns:
+            add(parse(fn), fn)
     else:
-        os.makedirs(outdir)
+        # parsing xml is pure python, so the files go to processes
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(fns))) \
+                as executor:
+            for fn, chunk in zip(fns, executor.map(parse, fns)):
+                add(chunk, fn)
+    df = _concat_chunks(chunks)
+    del chunks
+    df.insert(0, "index", np.arange(len(df), 
+                                    dtype=np.min_scalar_type(max(len(df), 1))))
+    memory = int(df.memory_usage(index=False, deep=True).sum())
+    peak = max(peak, held + memory)
+    return df, {"rows": len(df), "columns": len(df.columns), 
+                "memory": memory, "peak_memory": int(peak)}
+
+
+def list_its_files(its_dir):
+    ''' The .its files of a folder, by name
+    '''
+    return sorted(os.path.join(its_dir, name) for name in os.listdir(its_dir)
+                  if name.lower().endswith(".its"))
+
+
+def read_lena_input(path, its_workers=Config.ITS_PARSE_WORKERS):
+    ''' (df, stats) of a LENA export csv, or of the .its files of a folder
+    '''
+    if os.path.isdir(path):
+        return read_its_files(list_its_files(path),
+                              granularity=current_app.config["ITS_GRANULARITY"],
+                              utc_offset=current_app.config["ITS_UTC_OFFSET"],
+                              n_workers=its_workers)
+    return read_lena_export(path)
+
+
+@timed("lenasampler.ingest_records")
+def ingest_records(dft, idprefix, itsfile_col=Config.ITS_FILENAME_COL,
+                   starttime_col=Config.START_TIME_COL,
+                   duration_col=Config.DURATION_COL):
+    ''' Store a LENA export table as a new dataset together with the tables
+        and indexes the later steps use, return the dataset id
+    '''
+    dataset_id = create_dataset(dft)
+    try:
+        # start times are parsed once here, export only does integer 
+        # arithmetic on them
+        start_ns = parse_start_times(dft[starttime_col])
+        write_table(dataset_id, "start_times", 
+                    pd.DataFrame({"start_ns": start_ns}))
+        its_files = build_its_file_table(dft, idprefix, itsfile_col, 
+                                         duration_col)
+        its_files["its_start_ns"] = its_start_times(dft[itsfile_col], 
+                                                    start_ns).values
+        write_table(dataset_id, "its_files", its_files)
+        build_filter_index(dataset_id, its_files, itsfile_col=itsfile_col)
+    except Exception:
+        delete_dataset(dataset_id)
+        raise
+    return dataset_id
+
+
+@timed("lenasampler.load_export_rows")
+def load_export_rows(dataset_id, rows, itsfilecol, starttimecol):
+    ''' The sampled records and their start times, as the 
+        (df, df_ori, start_ns, its_start_ns) arguments of stream_audio_zip
+    '''
+    df = read_table(dataset_id, "records", rows=rows)
+    df = df.reset_index(drop=True)
+    if not has_table(dataset_id, "start_times"):
+        # dataset stored before start times were parsed at upload
+        df_ori = read_table(dataset_id, "records", 
+                            columns=[itsfilecol, starttimecol])
+        return df, df_ori, None, None
+    start_ns = read_table(dataset_id, "start_times", 
+                          rows=rows)["start_ns"].values
+    its_files = read_table(dataset_id, "its_files")
+    its_start_ns = pd.Series(its_files["its_start_ns"].values,
+                             index=its_files["its_file"].values)
+    return df, None, start_ns, its_start_ns
+
+
+@timed("lenasampler.plan_audio_segments")
+def plan_audio_segments(df, df_ori, audiodir, idprefix, 
+                        itsfilecol, starttimecol, durationcol,
+                        start_ns=None, its_start_ns=None):
+    ''' Work out where each sampled segment lives in its source audio.
+
+        Adds the segment_relative_start_time and segment_filename columns to
+        df and returns it together with the segments grouped by source file
+        (so each file is opened once): 
+        {audio_filepath: [(start, duration, segment_filename), ...]}
+
+        :params start_ns: start times of the df rows as epoch ns, parsed
+                          from df[starttimecol] when not given
+        :params its_start_ns: Series its file -> start of its first segment 
+                              (epoch ns), derived from df_ori when not given
+    '''
+    if start_ns is None:
+        start_ns = parse_start_times(df[starttimecol])
+    if its_start_ns is None:
+        first_rows = df_ori.drop_duplicates(itsfilecol)
+        its_start_ns = its_start_times(first_rows[itsfilecol], 
+                                       parse_start_times(first_rows[starttimecol]))
+    start_ns = np.asarray(start_ns, dtype=np.int64)
+    its_file_start_ns = its_start_ns.reindex(df[itsfilecol].values).values
+    # whole seconds since the its file start, also across midnight
+    relative_start_time = (start_ns - its_file_start_ns.astype(np.int64)) \
+                          // 10**9
+    segment_starts = pd.to_datetime(start_ns)
 
-    relative_start_time = []
     outfns = []
-    for ind, row in df.iterrows():
-        its_file = row[itsfilecol]
-        its_file_start = df_ori[df_ori[itsfilecol]==its_file][starttimecol].values[0]
-        its_file_start = parse_time(its_file_start) 
-        segment_start = row[starttimecol]
-        segment_start = parse_time(segment_start)
-        segment_relative_start = (segment_start - its_file_start).seconds
-        duration = row[durationcol]
-        relative_start_time.append(segment_relative_start) 
-        outfn = extract_from_audio_file(its_file, audiodir, idprefix, 
-                                segment_relative_start, duration,
-                                str(segment_start), outdir) 
-        outfns.append(os.path.basename(outfn))
+    segments = {}
+    for its_file, segment_relative_start, duration, segment_start in zip(
+            df[itsfilecol].values, relative_start_time.tolist(), 
+            df[durationcol].values, segment_starts):
+        audio_file, segment_file = audio_segment_filename(its_file, idprefix,
+                                        segment_relative_start, duration,
+                                        str(segment_start))
+        segments.setdefault(os.path.join(audiodir, audio_file), []).append(
+            (segment_relative_start, duration, segment_file))
+        outfns.append(segment_file)
     df["segment_relative_start_time"] = relative_start_time
     df["segment_filename"] = outfns
+    segments = {audio_filepath: sorted(file_segments) 
+                for audio_filepath, file_segments in segments.items()}
+    return df, segments
+
+
+def locate_segment(dataset_id, row, audiodir, idprefix,
+                   itsfilecol=Config.ITS_FILENAME_COL,
+                   starttimecol=Config.START_TIME_COL,
+                   durationcol=Config.DURATION_COL):
+    ''' (audio file, start, duration) of the segment at row position row
+        of the records, located the same way as on export
+    '''
+    df, df_ori, start_ns, its_start_ns = load_export_rows(dataset_id, [row],
+        itsfilecol, starttimecol)
+    if not len(df):
+        raise KeyError(row)
+    _, segments = plan_audio_segments(df, df_ori, audiodir, idprefix,
+                                      itsfilecol, starttimecol, durationcol,
+                                      start_ns=start_ns,
+                                      its_start_ns=its_start_ns)
+    (audio_filepath, [(start, duration, _)]), = segments.items()
+    return audio_filepath, start, duration
+
+
+@timed("lenasampler.prepare_audio_files")
+def prepare_audio_files(df, df_ori, audiodir, outdir, idprefix, 
+                        itsfilecol, starttimecol, durationcol,
+                        n_workers=Config.EXPORT_WORKERS,
+                        start_ns=None, its_start_ns=None, cache=None):
+    '''
+        :params start_ns, its_start_ns: see plan_audio_segments
+        :params n_workers: source files are extracted in parallel by this 
+                           many processes; failed segments are reported in
+                           the segment_error column of the metadata
+        :params cache: SegmentCache, defaults to the one of the app
+                       settings; whether each segment came from it is in the
+                       segment_cache column of the metadata
+    '''
+    if cache is None:
+        cache = open_segment_cache(current_app.config)
+    if os.path.exists(outdir):  # remove existing outdir if there is one
+        shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+
+    df, segments = plan_audio_segments(df, df_ori, audiodir, idprefix, 
+                                       itsfilecol, starttimecol, durationcol,
+                                       start_ns=start_ns, 
+                                       its_start_ns=its_start_ns)
+    segments = {audio_filepath: [(start, duration, os.path.join(outdir, fn))
+                                 for start, duration, fn in file_segments]
+                for audio_filepath, file_segments in segments.items()}
+    errors, statuses = extract_segments(segments, n_workers=n_workers,
+                                        cache=cache)
+    df["segment_error"] = [errors.get(os.path.join(outdir, fn), "") 
+                           for fn in df["segment_filename"]]
+    df["segment_cache"] = [statuses.get(os.path.join(outdir, fn), "")
+                           for fn in df["segment_filename"]]
+    log_segment_cache(idprefix, statuses)
     df.to_csv(os.path.join(outdir, "%s_SampledAudioSegmentsMetadata.csv"%idprefix))
     return df
 
 
-def zipdir(path, ziph):
-    print("\nZipping files ...")
-    # ziph is zipfile handle
-    for root, dirs, files in os.walk(path):
-        if len(files):
-            for file in tqdm(files):
-                ziph.write(os.path.join(root, file))
\ No newline at end of file
+def log_segment_cache(idprefix, statuses):
+    ''' Log how many segments of an export were taken from the segment
+        cache ("hit"), decoded into it ("miss") or cut directly ("uncached")
+    '''
+    counts = Counter(statuses.values())
+    current_app.logger.info("%s export, segment cache: %s", idprefix,
+        ", ".join("%s %s"%(n, status) for status, n in sorted(counts.items()))
+        or "no segments")
+
+
+class _ZipStream(object):
+    ''' Write-only file object for ZipFile that hands out what has been
+        written so far, so an archive can be sent while it is being built.
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _write_segment_entry(zipf, arcname, src, info, start, duration, buffer):
+    start_frame, num_frames = segment_frame_range(info, start, duration)
+    zinfo = ZipInfo(arcname, date_time=time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = wav_segment_size(info, num_frames)
+    with zipf.open(zinfo, "w") as entry:
+        copy_wav_segment(src, info, start_frame, num_frames, entry,
+                         buffer=buffer)
+
+
+@timed("lenasampler.stream_audio_zip")
+def stream_audio_zip(df, df_ori, audiodir, idprefix, 
+                     itsfilecol, starttimecol, durationcol, folder=None,
+                     start_ns=None, its_start_ns=None, cache=None):
+    ''' Generator of the bytes of a zip archive with the sampled segments
+        followed by the metadata csv.
+
+        Segments of PCM wav files are cut straight into ZIP_STORED entries
+        (deflate gains next to nothing on PCM audio), so nothing is written
+        to disk and at most one segment is buffered at a time.  The others
+        are taken from the SegmentCache (cache, defaults to the one of the
+        app settings) or decoded into it, see prepare_audio_files.
+    '''
+    if cache is None:
+        cache = open_segment_cache(current_app.config)
+    if folder is None:
+        folder = "%s_SampledAudioSegments"%idprefix
+    df, segments = plan_audio_segments(df, df_ori, audiodir, idprefix, 
+                                       itsfilecol, starttimecol, durationcol,
+                                       start_ns=start_ns, 
+                                       its_start_ns=its_start_ns)
+    # every source is checked before the first byte goes out, so a bad
+    # file ends up as a segment_error row instead of a broken archive
+    errors = {}
+    statuses = {}
+    sources = {}
+    for audio_filepath, file_segments in segments.items():
+        try:
+            info = read_wav_header(audio_filepath)
+        except ValueError:  # not a wav file, ffmpeg may still read it
+            info = None
+        except Exception as e:
+            for _, _, fn in file_segments:
+                errors[fn] = "%s: %s"%(type(e).__name__, e)
+            continue
+        # PCM slices go straight into the archive unless they are cached
+        if (info is not None) and is_pcm(info) \
+                and not (cache and cache.cache_pcm):
+            sources[audio_filepath] = info
+        else:
+            sources[audio_filepath] = None
+
+    stream = _ZipStream()
+    buffer = bytearray(1 << 20)
+    with ZipFile(stream, "w", zipfile.ZIP_STORED) as zipf:
+        for audio_filepath, file_segments in segments.items():
+            if audio_filepath not in sources:
+                continue
+            info = sources[audio_filepath]
+            src = None
+            if info is not None:
+                try:
+                    src = open(audio_filepath, "rb")
+                except OSError:
+                    info = None  # let the extract path report it
+            for start, duration, fn in file_segments:
+                arcname = "%s/%s"%(folder, fn)
+                if src is not None:
+                    _write_segment_entry(zipf, arcname, src, info, start, 
+                                         duration, buffer)
+                    statuses[fn] = "uncached"
+                else:
+                    # not PCM (or PCM to cache), let ffmpeg or the cache
+                    # cut it through a temporary file
+                    with tempfile.TemporaryDirectory() as tmpdir:
+                        outfn = os.path.join(tmpdir, fn)
+                        segment_errors, segment_statuses \
+                            = extract_segments_safely(audio_filepath,
+                                [(start, duration, outfn)], cache=cache)
+                        if outfn in segment_errors:
+                            errors[fn] = segment_errors[outfn]
+                        else:
+                            zipf.write(outfn, arcname)
+                            statuses[fn] = segment_statuses[outfn]
+                yield stream.pop()
+            if src is not None:
+                src.close()
+
+        df["segment_error"] = [errors.get(fn, "") 
+                               for fn in df["segment_filename"]]
+        df["segment_cache"] = [statuses.get(fn, "")
+                               for fn in df["segment_filename"]]
+        log_segment_cache(idprefix, statuses)
+        zipf.writestr("%s/%s_SampledAudioSegmentsMetadata.csv"\
+                      %(folder, idprefix), df.to_csv())
+    yield stream.pop()
+
+
+def quality_check_job(job, dataset_id, audio_dir, idprefix,
+                      itsfile_col, duration_col):
+    ''' Background job: run the quality check of a stored dataset and keep
+        the report tables with the dataset
+    '''
+    records = its_files = None
+    if has_table(dataset_id, "its_files"):
+        its_files = read_table(dataset_id, "its_files")
+    else:
+        records = read_table(dataset_id, "records", 
+                             columns=[itsfile_col, duration_col])
+    dft_summary, dft_per_file, matched_itsfiles, is_perfect_match \
+        = run_quality_check(records, audio_dir, itsfile_col, duration_col, 
+                            idprefix, its_files=its_files, 
+                            progress=job.progress)
+    write_table(dataset_id, "quality_summary", dft_summary)
+    write_table(dataset_id, "quality_perfile", dft_per_file)
+    return {"matched_itsfiles": matched_itsfiles,
+            "is_perfect_match": is_perfect_match}
+
+
+def audio_features_job(job, dataset_id, audio_dir, matched_itsfiles,
+                       itsfile_col, duration_col, starttime_col):
+    ''' Background job: measure the audio features of the segments of the
+        matched its files; returns the columns of the records table
+    '''
+    add_audio_features(dataset_id, audio_dir, matched_itsfiles,
+                       itsfile_col=itsfile_col, duration_col=duration_col,
+                       starttime_col=starttime_col, progress=job.progress)
+    return table_columns(dataset_id, "records")
+
+
+def export_audio_job(job, df, df_ori, audiodir, idprefix, 
+                     itsfilecol, starttimecol, durationcol, export_fn,
+                     start_ns=None, its_start_ns=None):
+    ''' Background job: write the zip archive of stream_audio_zip to the
+        job directory, one progress step per segment
+    '''
+    total = len(df) + 1
+    with open(job.result_path(export_fn), "wb") as f:
+        chunks = stream_audio_zip(df, df_ori, audiodir, idprefix, 
+                                  itsfilecol, starttimecol, durationcol,
+                                  start_ns=start_ns, 
+                                  its_start_ns=its_start_ns)
+        for i, chunk in enumerate(chunks):
+            f.write(chunk)
+            job.progress(i, total)
+    return {"filename": export_fn}
@@ -0,0 +1,189 @@
+''' Waveform thumbnails of audio segments from cached min/max envelopes.
+
+The envelope of a wav file is the minimum and maximum sample of every block
+of frames, at a few block sizes (zoom levels).  It is computed once per file
+by streaming the samples through a memory mapped numpy view, chunk by
+chunk, and cached on disk next to the file's size and mtime:
+
+    <ENVELOPE_DIR>/<sha1 of the path>/<mtime_ns>_<size>_<frames>.npy
+
+one int16 array of (blocks, 2) per level, scaled to the full range.  A
+thumbnail of any segment then reads only the few blocks it covers from the
+coarsest level that still has a block per pixel.
+'''
+
+import os
+import hashlib
+import threading
+from flask import current_app
+from config import Config
+from app.lenasampler.audio import read_wav_header, is_pcm, wav_num_frames, \
+                                  segment_frame_range, WAVE_FORMAT_IEEE_FLOAT
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _file_lock(key):
+    with _locks_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def sample_reader(fn, info):
+    ''' Memory mapped frames of a PCM wav file and a function turning a
+        slice of them into float32 samples in [-1, 1], channels mixed down
+        to (min, max) pairs later; None if the sample format is not handled
+    '''
+    num_frames = wav_num_frames(info)
+    bits = info.bits_per_sample
+    bytes_per_sample = info.block_align // info.channels
+    if info.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        dtype = {4: "<f4", 8: "<f8"}.get(bytes_per_sample)
+        if dtype is None:
+            return None
+        frames = np.memmap(fn, dtype=dtype, mode="r",
+                           offset=info.data_offset,
+                           shape=(num_frames, info.channels))
+        return frames, lambda chunk: chunk.astype(np.float32)
+    if bytes_per_sample == 3:
+        frames = np.memmap(fn, dtype=np.uint8, mode="r",
+                           offset=info.data_offset,
+                           shape=(num_frames, info.channels, 3))
+
+        def to_float(chunk):
+            chunk = chunk.astype(np.int32)
+            values = chunk[..., 0] | (chunk[..., 1] << 8) | (chunk[..., 2] << 16)
+            values = np.where(values >= 1 << 23, values - (1 << 24), values)
+            return values.astype(np.float32) / (1 << 23)
+        return frames, to_float
+    dtype = {1: np.uint8, 2: "<i2", 4: "<i4"}.get(bytes_per_sample)
+    if dtype is None:
+        return None
+    frames = np.memmap(fn, dtype=dtype, mode="r", offset=info.data_offset,
+                       shape=(num_frames, info.channels))
+    if bytes_per_sample == 1:
+        # 8 bit wav is unsigned
+        return frames, lambda chunk: (chunk.astype(np.float32) - 128) / 128
+    scale = float(1 << (8 * bytes_per_sample - 1))
+    return frames, lambda chunk: chunk.astype(np.float32) / scale
+
+
+def _block_min_max(samples, block):
+    ''' (min, max) of every block of frames, the last block may be short
+    '''
+    n = len(samples)
+    full = n - n % block
+    lo = samples[:full].reshape(-1, block).min(axis=1)
+    hi = samples[:full].reshape(-1, block).max(axis=1)
+    if full < n:
+        lo = np.append(lo, samples[full:].min())
+        hi = np.append(hi, samples[full:].max())
+    return lo, hi
+
+
+def compute_envelopes(fn, info=None, levels=Config.ENVELOPE_LEVELS,
+                      chunk_frames=Config.ENVELOPE_CHUNK_FRAMES):
+    ''' {frames per block: int16 array (blocks, 2)} of a wav file, streamed
+        through a memory map chunk by chunk
+    '''
+    if info is None:
+        info = read_wav_header(fn)
+    reader = sample_reader(fn, info) if is_pcm(info) else None
+    if reader is None:
+        raise ValueError("%s is not in a PCM format the waveform preview "\
+                         "reads"%fn)
+    frames, to_float = reader
+    levels = sorted(levels)
+    finest = levels[0]
+    # whole blocks per chunk, so no block spans two chunks
+    chunk_frames = max(chunk_frames // finest, 1) * finest
+    lows, highs = [], []
+    for start in range(0, len(frames), chunk_frames):
+        samples = to_float(frames[start:start + chunk_frames])
+        lo, hi = _block_min_max(samples.min(axis=1), finest)
+        lows.append(lo)
+        highs.append(_block_min_max(samples.max(axis=1), finest)[1])
+    del frames
+    lo = np.concatenate(lows) if lows else np.zeros(0, np.float32)
+    hi = np.concatenate(highs) if highs else np.zeros(0, np.float32)
+    envelopes = {}
+    for level in levels:
+        ratio = level // finest
+        level_lo = _block_min_max(lo, ratio)[0] if len(lo) else lo
+        level_hi = _block_min_max(hi, ratio)[1] if len(hi) else hi
+        envelopes[level] = np.round(np.clip(np.stack([level_lo, level_hi],
+                                                     axis=1), -1, 1)
+                                    * 32767).astype(np.int16)
+    return envelopes
+
+
+def load_envelopes(fn, levels=Config.ENVELOPE_LEVELS, root=None):
+    ''' Cached envelopes of a wav file (memory mapped), computed on first
+        use and again whenever the file's size or mtime changes; root
+        defaults to the ENVELOPE_DIR of the current app
+    '''
+    if root is None:
+        root = current_app.config["ENVELOPE_DIR"]
+    path = os.path.abspath(fn)
+    st = os.stat(path)
+    folder = os.path.join(root, hashlib.sha1(path.encode()).hexdigest())
+    version = "%s_%s"%(st.st_mtime_ns, st.st_size)
+
+    def level_path(level):
+        return os.path.join(folder, "%s_%s.npy"%(version, level))
+
+    with _file_lock(folder):
+        if not all(os.path.exists(level_path(level)) for level in levels):
+            envelopes = compute_envelopes(path, levels=levels)
+            os.makedirs(folder, exist_ok=True)
+            for level, envelope in envelopes.items():
+                tmp = "%s.%s.tmp"%(level_path(level), os.getpid())
+                with open(tmp, "wb") as f:
+                    np.save(f, envelope)
+                os.replace(tmp, level_path(level))
+            # envelopes of earlier versions of the file
+            for name in os.listdir(folder):
+                if not name.startswith(version + "_"):
+                    os.remove(os.path.join(folder, name))
+    return {level: np.load(level_path(level), mmap_mode="r")
+            for level in levels}
+
+
+def segment_envelope(fn, start, duration, width=160,
+                     levels=Config.ENVELOPE_LEVELS):
+    ''' (min, max) float arrays of at most width columns over a segment
+        given in seconds
+    '''
+    info = read_wav_header(fn)
+    start_frame, num_frames = segment_frame_range(info, start, duration)
+    envelopes = load_envelopes(fn, levels=levels)
+    frames_per_column = max(num_frames / width, 1)
+    # the coarsest level with at least one block per column
+    level = max([level for level in levels if level <= frames_per_column]
+                or [min(levels)])
+    first = start_frame // level
+    last = -(-(start_frame + num_frames) // level)
+    blocks = np.asarray(envelopes[level][first:last], dtype=np.float32) \
+             / 32767
+    if len(blocks) > width:
+        edges = np.linspace(0, len(blocks), width + 1).astype(int)[:-1]
+        return np.minimum.reduceat(blocks[:, 0], edges), \
+               np.maximum.reduceat(blocks[:, 1], edges)
+    return blocks[:, 0], blocks[:, 1]
+
+
+def envelope_svg(lows, highs, width=160, height=32, color="#3b6ea5"):
+    ''' SVG image of an envelope, one vertical line per column
+    '''
+    mid = height / 2
+    step = width / max(len(lows), 1)
+    path = " ".join("M%.1f %.1fV%.1f"%((i + 0.5) * step, mid - hi * mid,
+                                       mid - lo * mid + 0.5)
+                    for i, (lo, hi) in enumerate(zip(lows, highs)))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s" '
+            'viewBox="0 0 %s %s"><path d="%s" stroke="%s" '
+            'stroke-width="%.2f" fill="none"/></svg>'
+            %(width, height, width, height, path, color, max(step, 1)))
@@ -0,0 +1,231 @@
+''' Request and step timing, exported in the Prometheus text format.
+
+Every request is timed from the moment its session is loaded until its
+response is ready.  Functions decorated with @timed("name") (the slow steps
+of lenasampler and eyegazecleaner) record how long they took, and so do
+session loading/saving and template rendering.  Each response carries a
+Server-Timing header with the time spent per step during that request, and
+all timings feed histograms served at /metrics:
+
+    lilac_request_duration_seconds{route, method, status}
+    lilac_stage_duration_seconds{stage}
+    lilac_session_size_bytes{route}
+
+The session size is only known with the blob session backend, which
+measures what it writes; other backends are not serialized again for it.
+Metrics are kept per process; with several worker processes each one
+reports its own.
+'''
+
+import time
+import inspect
+import threading
+from functools import wraps
+from flask import g, has_app_context, request, \
+                  template_rendered, before_render_template
+from flask.sessions import SessionInterface
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                    5, 10, 30, 60, 300)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram(object):
+    ''' Cumulative histogram per label set, thread safe
+    '''
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts = self.series.get(label_values)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.series[label_values] \
+                       = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def exposition(self):
+        lines = ["# HELP %s %s"%(self.name, self.help),
+                 "# TYPE %s histogram"%self.name]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, counts in series:
+            labels = ",".join('%s="%s"'%(label, _escape(value)) for label,
+                              value in zip(self.labels, label_values))
+            sep = "," if labels else ""
+            for bound, count in zip(list(self.buckets) + ["+Inf"],
+                                    counts[:-1]):
+                lines.append('%s_bucket{%s%sle="%s"} %s'%(self.name, labels,
+                                                          sep, bound, count))
+            lines.append("%s_sum{%s} %s"%(self.name, labels, counts[-1]))
+            lines.append("%s_count{%s} %s"%(self.name, labels, counts[-2]))
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n")\
+                     .replace('"', '\\"')
+
+
+REQUEST_DURATION = Histogram("lilac_request_duration_seconds",
+    "Time from loading the session to the response, per route",
+    ("route", "method", "status"), DURATION_BUCKETS)
+STAGE_DURATION = Histogram("lilac_stage_duration_seconds",
+    "Time spent in a named step, requests and background jobs alike",
+    ("stage",), DURATION_BUCKETS)
+SESSION_SIZE = Histogram("lilac_session_size_bytes",
+    "Size of the pickled session saved at the end of a request, per route",
+    ("route",), SIZE_BUCKETS)
+HISTOGRAMS = [REQUEST_DURATION, STAGE_DURATION, SESSION_SIZE]
+
+
+def record_stage(name, secs):
+    ''' Add secs to the stage histogram and, inside a request, to its
+        Server-Timing breakdown
+    '''
+    STAGE_DURATION.observe(secs, name)
+    if has_app_context():
+        stages = g.setdefault("metrics_stages", {})
+        stages[name] = stages.get(name, 0) + secs
+
+
+def timed(name):
+    ''' Decorator recording the time spent in a function as stage name; for
+        generator functions the time spent producing the items is counted
+    '''
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                secs = 0
+                t = time.perf_counter()
+                try:
+                    items = func(*args, **kwargs)
+                    while True:
+                        try:
+                            item = next(items)
+                        except StopIteration as stop:
+                            return stop.value
+                        secs += time.perf_counter() - t
+                        yield item
+                        t = time.perf_counter()
+                finally:
+                    record_stage(name, secs + time.perf_counter() - t)
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_stage(name, time.perf_counter() - t)
+        return wrapper
+    return decorator
+
+
+def _route():
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def _server_timing(stages):
+    return ", ".join("%s;dur=%.1f"%(name, secs * 1000)
+                     for name, secs in stages.items())
+
+
+class TimedSessionInterface(SessionInterface):
+    ''' Wraps the session interface to time loading and saving the session
+        and to measure the size of the saved session
+    '''
+    def __init__(self, interface):
+        self.interface = interface
+
+    def __getattr__(self, name):
+        return getattr(self.interface, name)
+
+    def open_session(self, app, request):
+        t = time.perf_counter()
+        g.metrics_start = t
+        session = self.interface.open_session(app, request)
+        record_stage("session_load", time.perf_counter() - t)
+        return session
+
+    def is_null_session(self, obj):
+        return self.interface.is_null_session(obj)
+
+    def make_null_session(self, app):
+        return self.interface.make_null_session(app)
+
+    def save_session(self, app, session, response):
+        t = time.perf_counter()
+        self.interface.save_session(app, session, response)
+        secs = time.perf_counter() - t
+        record_stage("session_save", secs)
+        # the session is saved after the after_request hooks
+        timing = "%s;dur=%.1f"%("session_save", secs * 1000)
+        # only set when the session was written in this request
+        size = getattr(session, "saved_size", None)
+        if size is not None:
+            SESSION_SIZE.observe(size, _route())
+            timing += ', session;desc="%s bytes"'%size
+        if response.headers.get("Server-Timing"):
+            timing = response.headers["Server-Timing"] + ", " + timing
+        response.headers["Server-Timing"] = timing
+
+
+def start_request():
+    if "metrics_start" not in g:
+        g.metrics_start = time.perf_counter()
+
+
+def finish_request(response):
+    ''' Record the request duration and set the Server-Timing header of
+        the steps timed so far
+    '''
+    if "metrics_start" not in g:
+        return response
+    secs = time.perf_counter() - g.metrics_start
+    REQUEST_DURATION.observe(secs, _route(), request.method,
+                             str(response.status_code))
+    response.headers["Server-Timing"] = _server_timing(
+        dict(g.get("metrics_stages", {}), total=secs))
+    return response
+
+
+def _render_started(sender, template, context, **extra):
+    g.metrics_render_start = time.perf_counter()
+
+
+def _render_finished(sender, template, context, **extra):
+    if "metrics_render_start" in g:
+        record_stage("render_template",
+                     time.perf_counter() - g.pop("metrics_render_start"))
+
+
+def init_metrics(app):
+    ''' Install the request hooks on app, see the module docstring
+    '''
+    app.session_interface = TimedSessionInterface(app.session_interface)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+
+
+def exposition():
+    ''' All metrics in the Prometheus text format
+    '''
+    return "\n".join(histogram.exposition() for histogram in HISTOGRAMS) \
+           + "\n"
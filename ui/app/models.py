@@ -0,0 +1,69 @@
+from datetime import datetime
+from app import db
+
+
+class AudioMetadata(db.Model):
+    ''' Header information of a probed audio file.
+
+        A row is only valid while the file on disk keeps the same size and
+        mtime; stale rows are re-probed and overwritten.
+    '''
+    path = db.Column(db.String, primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    duration = db.Column(db.Float)
+    sample_rate = db.Column(db.Integer)
+    channels = db.Column(db.Integer)
+    bits_per_sample = db.Column(db.Integer)
+    format_tag = db.Column(db.Integer)
+    data_offset = db.Column(db.BigInteger)
+    data_size = db.Column(db.BigInteger)
+    last_used = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def matches(self, stat):
+        return (self.size == stat.st_size) and (self.mtime_ns == stat.st_mtime_ns)
+
+    def to_dict(self):
+        return {"path": self.path,
+                "duration": self.duration,
+                "sample_rate": self.sample_rate,
+                "channels": self.channels,
+                "bits_per_sample": self.bits_per_sample,
+                "format_tag": self.format_tag,
+                "data_offset": self.data_offset,
+                "data_size": self.data_size}
+
+
+class AudioDirectory(db.Model):
+    ''' A scanned audio directory.  Its entries are trusted as long as the
+        directory mtime is unchanged (files were neither added, removed nor
+        renamed) and the scan happened clearly after that mtime.
+    '''
+    path = db.Column(db.String, primary_key=True)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    scanned_ns = db.Column(db.BigInteger, nullable=False)
+
+
+class AudioDirectoryEntry(db.Model):
+    ''' One directory entry of a scanned audio directory.
+
+        status is "wav" for audio files used by LENASampler, otherwise the
+        reason the entry is skipped ("appledouble", "not_wav", "directory",
+        "unreadable").  Wav files are mapped to the its file and ID prefix
+        their name encodes (M001_20210311_135447_010263_2.wav).
+    '''
+    directory = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, primary_key=True)
+    size = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+    status = db.Column(db.String, nullable=False)
+    its_file = db.Column(db.String)
+    idprefix = db.Column(db.String)
+
+    def to_dict(self):
+        return {"name": self.name,
+                "size": self.size,
+                "mtime_ns": self.mtime_ns,
+                "status": self.status,
+                "its_file": self.its_file,
+                "idprefix": self.idprefix}
@@ -1,17 +1,66 @@
 import json
 import traceback
-from flask import redirect, render_template, url_for
+import os
+from flask import Blueprint, redirect, render_template, url_for, jsonify, \
+                  send_file, abort, Response, current_app
 from werkzeug.exceptions import HTTPException
-from app import app
+from app.jobs import get_job_state, get_job_result_file, cancel_job, \
+                     is_job_owner
+from app.metrics import exposition
 
+bp = Blueprint('main', __name__)
 
-@app.route("/")
-@app.route('/index')
+
+@bp.route("/")
+@bp.route('/index')
 def index():
     return redirect(url_for('lenasampler.data')) 
 
 
-@app.errorhandler(HTTPException)
+def owned_job_state(job_id):
+    ''' State of a job of the current session, 404 for any other job
+    '''
+    state = get_job_state(job_id)
+    if (state is None) or not is_job_owner(state):
+        abort(404)
+    return state
+
+
+@bp.route("/jobs/<job_id>")
+def job_status(job_id):
+    state = owned_job_state(job_id)
+    if get_job_result_file(job_id):
+        state["result_url"] = url_for("main.job_result", job_id=job_id)
+    return jsonify(state)
+
+
+@bp.route("/jobs/<job_id>/cancel", methods=["POST"])
+def job_cancel(job_id):
+    owned_job_state(job_id)
+    if not cancel_job(job_id):
+        abort(404)
+    return jsonify(get_job_state(job_id))
+
+
+@bp.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    owned_job_state(job_id)
+    path = get_job_result_file(job_id)
+    if path is None or not os.path.exists(path):
+        abort(404)
+    return send_file(path, as_attachment=True, 
+                     download_name=os.path.basename(path))
+
+
+@bp.route("/metrics")
+def metrics():
+    if not current_app.config["METRICS_ENABLED"]:
+        abort(404)
+    return Response(exposition(), 
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@bp.app_errorhandler(HTTPException)
 def handle_exception(e):
     """Return JSON instead of HTML for HTTP errors."""
     # start with the correct headers and status code from the error
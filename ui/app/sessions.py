@@ -0,0 +1,388 @@
+''' Server side sessions that keep large values out of the session file.
+
+The cookie only holds a random session id.  The session itself is a small
+pickled "head" in <SESSION_DIR>/heads/<sid> with the scalar values inline;
+every value that pickles to more than SESSION_INLINE_MAX_BYTES (tables of
+records, summaries, comparisons) is written once to a content addressed blob
+store, <SESSION_DIR>/blobs/<sha256[:2]>/<sha256>, and the head keeps a
+reference to it.  Blobs are read only when a request uses the value, and
+written only when a request assigns it, so a request costs the same however
+many files a user has loaded.  A request that neither reads nor assigns a
+value writes nothing; with SESSION_REFRESH_EACH_REQUEST it only touches the
+head to push back its expiry.
+
+    session[key] = records      # assign again after changing a value in
+                                # place, like with the cookie session
+
+Limits, all in config.py:
+    SESSION_MAX_BYTES        blob bytes one session may reference; the least
+                             recently used values are dropped beyond it
+    SESSION_STORE_MAX_BYTES  bytes of the whole blob store; the least
+                             recently used blobs are deleted beyond it
+A dropped value reads as missing, like a key that was never set.  Heads
+expire PERMANENT_SESSION_LIFETIME after they were last written or touched,
+and blobs no live head refers to are deleted by a periodic sweep.
+'''
+
+import os
+import re
+import time
+import pickle
+import hashlib
+import secrets
+import threading
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+SID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,128}$")
+_MISSING = object()
+
+
+class BlobRef(object):
+    ''' Reference to a value in the blob store
+    '''
+    __slots__ = ("digest", "size")
+
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+
+    def __getstate__(self):
+        return (self.digest, self.size)
+
+    def __setstate__(self, state):
+        self.digest, self.size = state
+
+
+class BlobStore(object):
+    ''' Content addressed store of pickled values
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data):
+        ''' Store pickled bytes, return the BlobRef; storing the same bytes
+            again only refreshes their last use
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "%s.%s.%s.tmp"%(path, os.getpid(), threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return BlobRef(digest, len(data))
+
+    def get(self, ref):
+        ''' The value of a BlobRef, _MISSING if it was evicted
+        '''
+        path = self.path(ref.digest)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _MISSING
+        return value
+
+    def entries(self):
+        ''' [(digest, size, last use)] of all blobs
+        '''
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.name, st.st_size, st.st_mtime))
+        return entries
+
+    def delete(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+class BlobSession(CallbackDict, SessionMixin):
+    ''' Session whose large values are BlobRefs until they are used
+    '''
+    def __init__(self, initial=None, sid=None, store=None, last_used=None,
+                 new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        # blob references as opened, to save unchanged values as they were
+        self.refs = {key: value for key, value in dict.items(self)
+                     if isinstance(value, BlobRef)}
+        self.sid = sid
+        self.store = store
+        self.new = new
+        self.modified = False
+        # key -> time it was last read or assigned
+        self.last_used = dict(last_used or {})
+        self.assigned = set()
+        self.used = set()
+        self.saved_size = None
+
+    def _resolve(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, BlobRef):
+            value = self.store.get(value)
+            if value is _MISSING:
+                # evicted from the store
+                dict.__delitem__(self, key)
+                self.modified = True
+                raise KeyError(key)
+            dict.__setitem__(self, key, value)
+        self.used.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._resolve(key)
+
+    def __setitem__(self, key, value):
+        self.assigned.add(key)
+        CallbackDict.__setitem__(self, key, value)
+
+    def get(self, key, default=None):
+        try:
+            return self._resolve(key)
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self._resolve(key)
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, default=_MISSING):
+        try:
+            value = self._resolve(key)
+        except KeyError:
+            if default is _MISSING:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def values(self):
+        return [self[key] for key in list(self.keys())]
+
+    def items(self):
+        return [(key, self[key]) for key in list(self.keys())]
+
+    def raw_items(self):
+        return dict.items(self)
+
+
+class BlobSessionInterface(SessionInterface):
+    ''' See the module docstring
+    '''
+    def __init__(self, root, inline_max_bytes, session_max_bytes,
+                 store_max_bytes, sweep_interval):
+        self.heads = os.path.join(root, "heads")
+        self.store = BlobStore(os.path.join(root, "blobs"))
+        self.inline_max_bytes = inline_max_bytes
+        self.session_max_bytes = session_max_bytes
+        self.store_max_bytes = store_max_bytes
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.written_since_sweep = 0
+        self.sweep_lock = threading.Lock()
+        os.makedirs(self.heads, exist_ok=True)
+
+    def head_path(self, sid):
+        return os.path.join(self.heads, sid)
+
+    def read_head(self, sid, lifetime):
+        ''' The head of a session, None if there is none or it is more than
+            lifetime seconds old
+        '''
+        try:
+            with open(self.head_path(sid), "rb") as f:
+                if os.fstat(f.fileno()).st_mtime + lifetime <= time.time():
+                    return None
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SID_PATTERN.match(sid):
+            head = self.read_head(sid, 
+                app.permanent_session_lifetime.total_seconds())
+            if head is not None:
+                return BlobSession(head["values"], sid=sid, store=self.store,
+                                   last_used=head["last_used"])
+        session = BlobSession(sid=secrets.token_urlsafe(32),
+                              store=self.store, new=True)
+        session.permanent = app.config.get("SESSION_PERMANENT", True)
+        return session
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified or not session.new:
+                self.delete_head(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not (session.modified or session.used or session.assigned):
+            # nothing to write, at most the expiry to refresh
+            if self.should_set_cookie(app, session):
+                self.touch_head(session.sid)
+                self.set_cookie(app, session, response)
+            return
+
+        now = time.time()
+        values = {}
+        for key, value in session.raw_items():
+            if isinstance(value, BlobRef):
+                pass
+            elif (key in session.refs) and (key not in session.assigned):
+                # read but not assigned, the stored blob is still current
+                value = session.refs[key]
+            else:
+                value = self.pack(value)
+            values[key] = value
+        last_used = {key: session.last_used.get(key, now)
+                     for key in values}
+        for key in session.used | session.assigned:
+            if key in last_used:
+                last_used[key] = now
+        self.evict(values, last_used, keep=session.used | session.assigned)
+
+        head_size = self.write_head(session.sid, {"values": values,
+                                                  "last_used": last_used})
+        session.saved_size = head_size + sum(ref.size for ref
+            in values.values() if isinstance(ref, BlobRef))
+        self.set_cookie(app, session, response)
+        self.maybe_sweep(app.permanent_session_lifetime.total_seconds())
+
+    def set_cookie(self, app, session, response):
+        response.set_cookie(self.get_cookie_name(app), session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app),
+                            path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def pack(self, value):
+        ''' The value itself when it pickles small, else its BlobRef
+        '''
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) <= self.inline_max_bytes:
+            return value
+        self.written_since_sweep += len(data)
+        return self.store.put(data)
+
+    def evict(self, values, last_used, keep=()):
+        ''' Drop the least recently used blob values of a session while it
+            is over SESSION_MAX_BYTES; values used in this request are kept
+        '''
+        refs = [(last_used[key], key) for key, value in values.items()
+                if isinstance(value, BlobRef) and key not in keep]
+        total = sum(value.size for value in values.values()
+                    if isinstance(value, BlobRef))
+        for _, key in sorted(refs):
+            if total <= self.session_max_bytes:
+                break
+            total -= values.pop(key).size
+            last_used.pop(key)
+
+    def write_head(self, sid, head):
+        ''' Atomically write a session head, return its size in bytes
+        '''
+        data = pickle.dumps(head, pickle.HIGHEST_PROTOCOL)
+        path = self.head_path(sid)
+        tmp = "%s.%s.%s.tmp"%(path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def touch_head(self, sid):
+        try:
+            os.utime(self.head_path(sid))
+        except FileNotFoundError:
+            pass
+
+    def delete_head(self, sid):
+        try:
+            os.remove(self.head_path(sid))
+        except FileNotFoundError:
+            pass
+
+    def maybe_sweep(self, lifetime):
+        now = time.time()
+        if (now - self.last_sweep < self.sweep_interval) \
+                and (self.written_since_sweep < self.store_max_bytes / 10):
+            return
+        if not self.sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_sweep = now
+            self.written_since_sweep = 0
+            sweep(self, lifetime, grace=min(lifetime, self.sweep_interval))
+        finally:
+            self.sweep_lock.release()
+
+
+def sweep(interface, lifetime, grace=600):
+    ''' Delete heads older than lifetime seconds, blobs no head refers to (older than grace
+        seconds, so blobs of heads being written are kept) and then the
+        least recently used blobs while the store is over
+        SESSION_STORE_MAX_BYTES
+    '''
+    now = time.time()
+    referenced = set()
+    for entry in os.scandir(interface.heads):
+        if entry.name.endswith(".tmp"):
+            if now - entry.stat().st_mtime > grace:
+                os.remove(entry.path)
+            continue
+        head = interface.read_head(entry.name, lifetime)
+        if head is None:
+            interface.delete_head(entry.name)
+            continue
+        referenced.update(value.digest for value in head["values"].values()
+                          if isinstance(value, BlobRef))
+    blobs = []
+    for digest, size, last_use in interface.store.entries():
+        if (digest not in referenced) and (now - last_use > grace):
+            interface.store.delete(digest)
+        else:
+            blobs.append((last_use, digest, size))
+    total = sum(size for _, _, size in blobs)
+    for _, digest, size in sorted(blobs):
+        if total <= interface.store_max_bytes:
+            break
+        interface.store.delete(digest)
+        total -= size
+
+
+def init_blob_sessions(app):
+    app.session_interface = BlobSessionInterface(
+        app.config["SESSION_DIR"],
+        inline_max_bytes=app.config["SESSION_INLINE_MAX_BYTES"],
+        session_max_bytes=app.config["SESSION_MAX_BYTES"],
+        store_max_bytes=app.config["SESSION_STORE_MAX_BYTES"],
+        sweep_interval=app.config["SESSION_SWEEP_INTERVAL"])
@@ -0,0 +1,161 @@
+''' Paged, sorted and filtered access to tables for the JSON table views.
+
+Pages only ever materialize the rows that are sent back, so the cost of a
+request depends on the page size rather than on the size of the table.
+Query string parameters understood by parse_table_query:
+
+    offset=0&limit=100            rows [offset, offset + limit)
+    columns=a,b,c                 column projection (default: all)
+    sort=a  /  sort=-a            sort by a column, "-" for descending
+    search=text                   rows where any projected column contains text
+    filter=col:op:value           repeatable, op is one of FILTER_OPS
+'''
+
+from flask import current_app
+from config import Config
+from app.datastore import has_table, read_table_meta, read_table
+from app.lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+
+FILTER_OPS = ("eq", "ne", "lt", "le", "gt", "ge", "contains")
+
+
+def parse_table_query(args, max_limit=Config.TABLE_MAX_PAGE_SIZE):
+    ''' Turn request args into keyword arguments of query_table
+    '''
+    offset = max(args.get("offset", 0, type=int), 0)
+    limit = args.get("limit", current_app.config["TABLE_PAGE_SIZE"], type=int)
+    limit = min(max(limit, 0), max_limit)
+    columns = args.get("columns")
+    columns = [c for c in columns.split(",") if c] if columns else None
+    sort = args.get("sort") or None
+    ascending = True
+    if sort and sort.startswith("-"):
+        sort = sort[1:]
+        ascending = False
+    filters = []
+    for spec in args.getlist("filter"):
+        col, op, value = spec.split(":", 2)
+        if op not in FILTER_OPS:
+            raise ValueError("Unknown filter operator %s"%op)
+        filters.append((col, op, value))
+    return {"offset": offset, "limit": limit, "columns": columns,
+            "sort": sort, "ascending": ascending, "filters": filters,
+            "search": args.get("search") or None}
+
+
+def _filter_mask(values, op, value):
+    values = pd.Series(values)
+    if op == "contains":
+        return values.astype(str).str.contains(value, case=False,
+                                               regex=False).values
+    if pd.api.types.is_numeric_dtype(values):
+        value = float(value)
+    else:
+        values = values.astype(str)
+    return {"eq": values == value, "ne": values != value,
+            "lt": values < value, "le": values <= value,
+            "gt": values > value, "ge": values >= value}[op].values
+
+
+def _sorted_positions(values, ascending):
+    ''' Stable argsort, missing values last
+    '''
+    return pd.Series(values).reset_index(drop=True)\
+             .sort_values(ascending=ascending, kind="mergesort",
+                          na_position="last").index.values
+
+
+def _select(get_column, positions, all_columns, search_columns, sort,
+            ascending, filters, search):
+    ''' Positions that pass, get_column(col, positions) returns the
+        values of col at positions.  Only the columns that are filtered,
+        searched or sorted on are read for all rows.
+    '''
+    for col in [col for col, _, _ in filters] + [sort]:
+        if col and col not in all_columns:
+            raise KeyError("Unknown column %s"%col)
+    for col, op, value in filters:
+        positions = positions[_filter_mask(get_column(col, positions),
+                                           op, value)]
+    if search:
+        mask = np.zeros(len(positions), dtype=bool)
+        for col in search_columns:
+            mask |= _filter_mask(get_column(col, positions),
+                                 "contains", search)
+        positions = positions[mask]
+    if sort:
+        positions = positions[_sorted_positions(get_column(sort, positions),
+                                                ascending)]
+    return positions
+
+
+def select_table_rows(dataset_id, table, rows=None, columns=None, sort=None,
+                      ascending=True, filters=(), search=None,
+                      root=None):
+    ''' Row positions of a stored table (optionally restricted to the rows
+        of a view) that pass the filters, in sorted order
+    '''
+    meta = read_table_meta(dataset_id, table, root)
+    if rows is None:
+        rows = np.arange(meta["length"])
+    rows = np.asarray(rows, dtype=np.int64)
+
+    def get_column(col, positions):
+        return read_table(dataset_id, table, columns=[col], rows=positions,
+                          root=root)[col].values
+
+    return _select(get_column, rows, meta["columns"],
+                   columns or meta["columns"], sort, ascending, filters,
+                   search)
+
+
+def query_table(dataset_id, table, rows=None, columns=None, offset=0,
+                limit=Config.TABLE_PAGE_SIZE, sort=None,
+                ascending=True, filters=(), search=None,
+                root=None):
+    ''' Query a stored table (optionally restricted to the row positions of
+        a view), return (total rows, rows after filtering, page DataFrame)
+    '''
+    if not has_table(dataset_id, table, root):
+        return 0, 0, pd.DataFrame()
+    total = len(rows) if rows is not None \
+            else read_table_meta(dataset_id, table, root)["length"]
+    positions = select_table_rows(dataset_id, table, rows, columns, sort,
+                                  ascending, filters, search, root=root)
+    page = read_table(dataset_id, table, columns=columns,
+                      rows=positions[offset:offset + limit], root=root)
+    return total, len(positions), page
+
+
+def table_csv_chunks(dataset_id, table, rows=None, columns=None, sort=None,
+                     ascending=True, filters=(), search=None,
+                     chunk_size=Config.TABLE_MAX_PAGE_SIZE,
+                     root=None, **kwargs):
+    ''' Stream the selected rows of a stored table as csv text, chunk by
+        chunk, so downloading a large table never holds it in memory
+    '''
+    if not has_table(dataset_id, table, root):
+        return
+    positions = select_table_rows(dataset_id, table, rows, columns, sort,
+                                  ascending, filters, search, root=root)
+    for i in range(0, max(len(positions), 1), chunk_size):
+        chunk = read_table(dataset_id, table, columns=columns,
+                           rows=positions[i:i + chunk_size], root=root)
+        yield chunk.to_csv(index=False, header=(i == 0))
+
+
+def table_page_json(total, filtered, page, offset):
+    ''' JSON body of a page; cells are converted to plain python values
+    '''
+    page = page.astype(object).where(page.notnull(), None)
+    return {"total": int(total),
+            "filtered": int(filtered),
+            "offset": int(offset),
+            "columns": [str(c) for c in page.columns],
+            "rows": [[v.item() if isinstance(v, np.generic) else v
+                      for v in row]
+                     for row in page.itertuples(index=False, name=None)]}
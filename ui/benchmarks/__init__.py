@@ -0,0 +1,3 @@
+''' Performance benchmarks of the LENASampler and EyeGazeCleaner steps on
+synthetic data, see benchmarks/run.py.
+'''
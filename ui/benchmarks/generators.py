@@ -0,0 +1,129 @@
+''' Deterministic generators of synthetic input data: the same arguments
+always give the same files.
+
+    make_lena_dataset   LENAExport csv + one PCM wav per its file, the wav
+                        lengths matching the segment durations
+    make_eyegaze_csv    coding file in the csv, millisecond layout
+    make_eyegaze_xlsx   coding file in the xlsx, frame layout (no header)
+
+The layouts follow assets/eyegazecleaner.
+'''
+
+import os
+import struct
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+LOOK_CODES = ["L", "R", "C"]
+
+
+def write_pcm_wav(fn, num_frames, sample_rate=16000, seed=0, sparse=False,
+                  chunk_frames=1 << 20):
+    ''' 16 bit mono PCM wav of num_frames frames of noise; sparse writes
+        only the header and leaves the data as a hole (silence) so large
+        files cost no disk time
+    '''
+    data_size = num_frames * 2
+    header = b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE" \
+           + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate,
+                                   sample_rate * 2, 2, 16) \
+           + b"data" + struct.pack("<I", data_size)
+    rng = np.random.default_rng(seed)
+    with open(fn, "wb") as f:
+        f.write(header)
+        if sparse:
+            f.truncate(len(header) + data_size)
+            return fn
+        for start in range(0, num_frames, chunk_frames):
+            n = min(chunk_frames, num_frames - start)
+            f.write((rng.standard_normal(n) * 3000).astype("<i2").tobytes())
+    return fn
+
+
+def make_lena_dataset(root, idprefix="M001", num_its_files=3,
+                      segments_per_file=100, segment_secs=30,
+                      sample_rate=16000, seed=0, sparse_audio=False):
+    ''' Write <root>/<idprefix>_export.csv and <root>/audio/<idprefix>_*.wav,
+        return (export csv path, audio folder)
+    '''
+    rng = np.random.default_rng(seed)
+    audio_dir = os.path.join(root, "audio")
+    os.makedirs(audio_dir, exist_ok=True)
+    frames = []
+    for i in range(num_its_files):
+        start = datetime(2021, 3, 1, 9, 0, 0) + pd.Timedelta(days=i)
+        its_file = "%s_%06d_%06d.its"%(start.strftime("%Y%m%d"),
+                                       start.hour * 10000, i)
+        n = segments_per_file
+        start_times = pd.date_range(start, periods=n,
+                                    freq="%ds"%segment_secs)
+        frames.append(pd.DataFrame({
+            "ITS_File_Name": its_file,
+            "StartTime": start_times.strftime("%m/%d/%Y %H:%M:%S") 
+                         + " (Local)",
+            "Duration_Secs": segment_secs,
+            "Meaningful": rng.uniform(0, segment_secs, n).round(2),
+            "Distant": rng.uniform(0, segment_secs / 2, n).round(2),
+            "TV": rng.uniform(0, segment_secs / 4, n).round(2),
+            "Noise": rng.uniform(0, segment_secs / 4, n).round(2),
+            "Silence": rng.uniform(0, segment_secs, n).round(2),
+            "AWC_COUNT": rng.poisson(segment_secs * 2, n),
+            "CT_COUNT": rng.poisson(segment_secs / 10, n),
+            "CV_COUNT": rng.poisson(segment_secs / 5, n),
+        }))
+        write_pcm_wav(os.path.join(audio_dir, "%s_%s"%(idprefix, 
+                          its_file.replace(".its", ".wav"))),
+                      n * segment_secs * sample_rate, sample_rate,
+                      seed=seed + i, sparse=sparse_audio)
+    export_fn = os.path.join(root, "%s_export.csv"%idprefix)
+    pd.concat(frames, ignore_index=True).to_csv(export_fn, index=False)
+    return export_fn, audio_dir
+
+
+def eyegaze_codes(num_trials=20, looks_per_trial=8, seed=0):
+    ''' Coding of a session in milliseconds: code, onset, offset per row;
+        trials start with B and end with S, which have no offset (0)
+    '''
+    rng = np.random.default_rng(seed)
+    rows = []
+    t = 1000
+    for _ in range(num_trials):
+        rows.append(("B", t, 0))
+        t += int(rng.integers(100, 300))
+        for _ in range(looks_per_trial):
+            duration = int(rng.integers(100, 3000))
+            rows.append((LOOK_CODES[rng.integers(len(LOOK_CODES))], t,
+                         t + duration))
+            t += duration + int(rng.integers(20, 200))
+        rows.append(("S", t, 0))
+        t += int(rng.integers(500, 2000))
+    return pd.DataFrame(rows, columns=["code", "onset", "offset"])
+
+
+def make_eyegaze_csv(fn, num_trials=20, looks_per_trial=8, seed=0,
+                     subject="M001"):
+    ''' Coding file in the millisecond csv layout
+    '''
+    codes = eyegaze_codes(num_trials, looks_per_trial, seed)
+    pd.DataFrame({"%s.ordinal"%subject: np.arange(len(codes)),
+                  "%s.onset"%subject: codes["onset"],
+                  "%s.offset"%subject: codes["offset"],
+                  "%s.code01"%subject: codes["code"],
+                  "": ""}).to_csv(fn, index=False)
+    return fn
+
+
+def make_eyegaze_xlsx(fn, num_trials=20, looks_per_trial=8, seed=0,
+                      fps=30):
+    ''' Coding file in the frame xlsx layout: code, onset, offset columns,
+        no header, empty offset for B and S
+    '''
+    codes = eyegaze_codes(num_trials, looks_per_trial, seed)
+    frames = pd.DataFrame({
+        "code": codes["code"],
+        "onset": (codes["onset"] * fps / 1000).round().astype(int),
+        "offset": (codes["offset"] * fps / 1000).round()})
+    frames.loc[codes["offset"] == 0, "offset"] = np.nan
+    frames.to_excel(fn, header=False, index=False)
+    return fn
@@ -0,0 +1,272 @@
+''' Time the main LENASampler and EyeGazeCleaner steps on synthetic data of
+a few sizes and write the timings as json.
+
+    cd ui
+    python -m benchmarks.run --scales small,medium -o results.json
+    python -m benchmarks.run --baseline results.json -o new.json
+
+Every benchmark is run --repeat times after its inputs are generated;
+first_secs is the cold run (empty caches), min_secs and median_secs are
+over all runs.  With --baseline the ratio to the earlier results is added
+and printed, so two commits can be compared on the same machine.  The app
+uses a scratch data folder and database inside --workdir, the real ones
+are not touched.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from statistics import median
+
+SCALES = {
+    # its files, segments per its file, segment seconds, eye-gaze trials
+    "small": {"num_its_files": 3, "segments_per_file": 100,
+              "segment_secs": 10, "num_trials": 20},
+    "medium": {"num_its_files": 10, "segments_per_file": 2000,
+               "segment_secs": 30, "num_trials": 200},
+    "large": {"num_its_files": 30, "segments_per_file": 20000,
+              "segment_secs": 30, "num_trials": 2000},
+}
+# wav files of more frames are written as sparse files (silence)
+SPARSE_AUDIO_FRAMES = 10**8
+SAMPLE_RATE = 16000
+NUM_SAMPLED = 50
+
+
+def timed(func, repeat, setup=None):
+    ''' Seconds of each of repeat calls of func(); setup() runs untimed
+        before every call
+    '''
+    secs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        func()
+        secs.append(time.perf_counter() - t)
+    return secs
+
+
+def environment():
+    import numpy as np
+    import pandas as pd
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL)\
+            .decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__}
+
+
+def lena_benchmarks(workdir, scale, repeat):
+    ''' {benchmark name: [seconds per run]} of the LENASampler steps
+    '''
+    from flask import current_app
+    from app.datastore import delete_dataset, read_table
+    from app.lenasampler import filtering
+    from app.lenasampler.sampling import draw_sample
+    from app.lenasampler.utils import read_lena_export, ingest_records, \
+                                      run_quality_check, load_export_rows, \
+                                      prepare_audio_files
+    from benchmarks.generators import make_lena_dataset
+
+    params = SCALES[scale]
+    num_frames = params["num_its_files"] * params["segments_per_file"] \
+                 * params["segment_secs"] * SAMPLE_RATE
+    export_fn, audio_dir = make_lena_dataset(os.path.join(workdir, "lena"),
+        num_its_files=params["num_its_files"],
+        segments_per_file=params["segments_per_file"],
+        segment_secs=params["segment_secs"], sample_rate=SAMPLE_RATE,
+        sparse_audio=num_frames > SPARSE_AUDIO_FRAMES)
+    itsfile_col = current_app.config["ITS_FILENAME_COL"]
+    starttime_col = current_app.config["START_TIME_COL"]
+    duration_col = current_app.config["DURATION_COL"]
+    results = {}
+    datasets = []
+
+    def ingest():
+        dft, _ = read_lena_export(export_fn)
+        datasets.append(ingest_records(dft, "M001"))
+    results["lenasampler.ingest"] = timed(ingest, repeat)
+    dataset_id = datasets.pop()
+    for other in datasets:
+        delete_dataset(other)
+
+    its_files = read_table(dataset_id, "its_files")
+    matched = []
+
+    def quality_check():
+        matched[:] = run_quality_check(None, audio_dir, itsfile_col,
+                                       duration_col, "M001",
+                                       its_files=its_files)[2]
+    results["lenasampler.run_quality_check"] = timed(quality_check, repeat)
+
+    ranges = {"Duration_Secs": (0, params["segment_secs"]),
+              "Silence": (0, params["segment_secs"] / 2)}
+    rows = []
+
+    def filter_segments():
+        rows[:] = [filtering.filter_rows(dataset_id, matched, ranges)]
+    results["lenasampler.filter_rows"] = timed(filter_segments, repeat,
+        setup=lambda: filtering.filter_cache().clear())
+    rows = rows[0]
+
+    sampled = []
+    for mode, strata in [("uniform", "its"), ("stratified", "hour"),
+                         ("weighted", "its")]:
+        def sample():
+            sampled[:] = [draw_sample(dataset_id, rows, NUM_SAMPLED, 1,
+                                      mode=mode, strata=strata,
+                                      weight_col="AWC_COUNT")[0]]
+        results["lenasampler.draw_sample.%s"%mode] = timed(sample, repeat)
+
+    outdir = os.path.join(workdir, "segments")
+
+    def export():
+        df, df_ori, start_ns, its_start_ns = load_export_rows(dataset_id,
+            sampled[0], itsfile_col, starttime_col)
+        prepare_audio_files(df, df_ori, audio_dir, outdir, "M001",
+                            itsfile_col, starttime_col, duration_col,
+                            start_ns=start_ns, its_start_ns=its_start_ns)
+    results["lenasampler.prepare_audio_files"] = timed(export, repeat)
+    delete_dataset(dataset_id)
+    return results
+
+
+def eyegaze_benchmarks(workdir, scale, repeat):
+    ''' {benchmark name: [seconds per run]} of the EyeGazeCleaner steps
+    '''
+    from app.eyegazecleaner.utils import read_data, get_trial_summary, \
+                                         run_trial_summary_comparison_two
+    from benchmarks.generators import make_eyegaze_csv, make_eyegaze_xlsx
+
+    num_trials = SCALES[scale]["num_trials"]
+    folder = os.path.join(workdir, "eyegaze")
+    os.makedirs(folder, exist_ok=True)
+    csv_fn = make_eyegaze_csv(os.path.join(folder, "coder1.csv"),
+                              num_trials, seed=1)
+    xlsx_fn = make_eyegaze_xlsx(os.path.join(folder, "coder2.xlsx"),
+                                num_trials, seed=1)
+    results = {}
+    data = {}
+
+    def read_csv():
+        data["csv"] = read_data("coder1.csv", csv_fn, "milisecond",
+                                "milisecond")[0]
+
+    def read_xlsx():
+        data["xlsx"] = read_data("coder2.xlsx", xlsx_fn, "frame", "frame")[0]
+    results["eyegazecleaner.read_data.csv"] = timed(read_csv, repeat)
+    results["eyegazecleaner.read_data.xlsx"] = timed(read_xlsx, repeat)
+
+    summaries = {}
+
+    def summary():
+        summaries["csv"] = get_trial_summary(data["csv"].copy())
+    results["eyegazecleaner.get_trial_summary"] = timed(summary, repeat)
+    summaries["xlsx"] = get_trial_summary(data["xlsx"].copy())
+
+    records1 = summaries["csv"].to_dict("records")
+    records2 = summaries["xlsx"].to_dict("records")
+    results["eyegazecleaner.run_trial_summary_comparison_two"] = timed(
+        lambda: run_trial_summary_comparison_two(records1, "milisecond",
+                                                 records2, "frame"), repeat)
+    return results
+
+
+SUITES = {"lenasampler": lena_benchmarks,
+          "eyegazecleaner": eyegaze_benchmarks}
+
+
+def compare(results, baseline):
+    ''' Add the median ratio to a baseline result file to the results
+    '''
+    earlier = {(r["name"], r["scale"]): r for r in baseline["results"]}
+    for r in results:
+        old = earlier.get((r["name"], r["scale"]))
+        if old and old["median_secs"]:
+            r["baseline_median_secs"] = old["median_secs"]
+            r["ratio"] = round(r["median_secs"] / old["median_secs"], 3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scales", default="small,medium",
+                        help="comma separated, of %s"%", ".join(SCALES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--suites", default=",".join(SUITES),
+                        help="comma separated, of %s"%", ".join(SUITES))
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=None,
+                        help="earlier result file to compare with")
+    parser.add_argument("--workdir", default=None,
+                        help="folder for the generated data, kept if given")
+    args = parser.parse_args(argv)
+    scales = [s.strip() for s in args.scales.split(",") if s.strip()]
+    unknown = [s for s in scales if s not in SCALES]
+    if unknown:
+        parser.error("unknown scales %s"%", ".join(unknown))
+    suites = [s.strip() for s in args.suites.split(",") if s.strip()]
+    unknown = [s for s in suites if s not in SUITES]
+    if unknown:
+        parser.error("unknown suites %s"%", ".join(unknown))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="lilac_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    # the settings read these when they are first imported
+    os.environ["LILAC_DATA_DIR"] = os.path.join(workdir, "data")
+    os.environ["DATABASE_URL"] = "sqlite:///%s"%os.path.join(workdir,
+                                                              "bench.db")
+    from flask_migrate import upgrade
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        upgrade()
+
+    results = []
+    try:
+        for scale in scales:
+            scale_dir = os.path.join(workdir, scale)
+            with app.app_context():
+                for suite in suites:
+                    for name, secs in SUITES[suite](scale_dir, scale,
+                                                    args.repeat).items():
+                        results.append({"name": name, "scale": scale,
+                            "params": SCALES[scale], "runs": len(secs),
+                            "first_secs": round(secs[0], 6),
+                            "min_secs": round(min(secs), 6),
+                            "median_secs": round(median(secs), 6)})
+                        print("%-55s %-7s %10.4fs"%(name, scale,
+                                                    median(secs)))
+            shutil.rmtree(scale_dir, ignore_errors=True)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+        for r in results:
+            if "ratio" in r:
+                print("%-55s %-7s x%.2f"%(r["name"], r["scale"], r["ratio"]))
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f,
+                  indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+''' Time a cold start of the app, importing the package and creating the
+app in fresh interpreters, and check it against a budget.
+
+    cd ui
+    python -m benchmarks.startup --budget 1.5 -o startup.json
+
+Fails (exit status 1) when the median seconds to import and create the app
+are over --budget, or when a start imports one of LAZY_MODULES, the slow
+libraries that must only be imported by the functions using them.  The
+files are in the OS cache after the first run, so this measures the import
+work itself rather than the disk.
+'''
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+# seconds to import app and run create_app()
+DEFAULT_BUDGET = 1.5
+LAZY_MODULES = ("pandas", "numpy", "moviepy", "matplotlib", "IPython",
+                "tqdm", "app.lenasampler.pipeline")
+
+_PROBE = '''
+import sys, json, time
+t = time.perf_counter()
+import app
+t1 = time.perf_counter()
+app.create_app()
+t2 = time.perf_counter()
+print(json.dumps({"import_secs": t1 - t, "create_app_secs": t2 - t1,
+                  "lazy_imported": [m for m in %r if m in sys.modules]}))
+'''%(LAZY_MODULES,)
+
+
+def cold_start(workdir):
+    ''' {"import_secs", "create_app_secs", "lazy_imported"} of one start in
+        a new interpreter, with its data and database in workdir
+    '''
+    env = dict(os.environ, LILAC_DATA_DIR=os.path.join(workdir, "data"),
+               DATABASE_URL="sqlite:///%s"%os.path.join(workdir,
+                                                         "startup.db"))
+    out = subprocess.check_output([sys.executable, "-c", _PROBE], env=env,
+                                  cwd=os.path.dirname(os.path.dirname(
+                                      os.path.abspath(__file__))),
+                                  stderr=subprocess.DEVNULL)
+    return json.loads(out.decode().strip().split("\n")[-1])
+
+
+def slowest_imports(workdir, top=10):
+    ''' [(cumulative seconds, package)] of the packages imported by a
+        start, from python -X importtime
+    '''
+    env = dict(os.environ, LILAC_DATA_DIR=os.path.join(workdir, "data"),
+               DATABASE_URL="sqlite:///%s"%os.path.join(workdir,
+                                                         "startup.db"))
+    err = subprocess.run([sys.executable, "-X", "importtime",
+                          "-c", "import app; app.create_app()"], env=env,
+                         cwd=os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))),
+                         stderr=subprocess.PIPE, check=True).stderr.decode()
+    imports = []
+    for line in err.split("\n"):
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # the cumulative time of a package includes its sub modules
+        name = name.strip()
+        if cumulative.strip().isdigit() and "." not in name:
+            imports.append((int(cumulative) / 1e6, name))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="most median seconds to import and create "\
+                             "the app")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", default=None)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="lilac_startup_")
+    try:
+        # the first start compiles the byte code, it is not timed
+        cold_start(workdir)
+        starts = [cold_start(workdir) for _ in range(args.repeat)]
+        imports = slowest_imports(workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    totals = [s["import_secs"] + s["create_app_secs"] for s in starts]
+    lazy_imported = sorted(set(m for s in starts for m in s["lazy_imported"]))
+    result = {"budget_secs": args.budget,
+              "median_secs": round(median(totals), 4),
+              "median_import_secs": round(median(s["import_secs"]
+                                                 for s in starts), 4),
+              "median_create_app_secs": round(median(s["create_app_secs"]
+                                                     for s in starts), 4),
+              "lazy_imported": lazy_imported,
+              "slowest_imports": [{"module": name, "secs": round(secs, 4)}
+                                  for secs, name in imports]}
+    print("import app      %8.4fs"%result["median_import_secs"])
+    print("create_app()    %8.4fs"%result["median_create_app_secs"])
+    print("total           %8.4fs  (budget %.2fs)"%(result["median_secs"],
+                                                   args.budget))
+    for item in result["slowest_imports"]:
+        print("  %-40s %8.4fs"%(item["module"], item["secs"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failed = False
+    if lazy_imported:
+        print("imported at startup: %s"%", ".join(lazy_imported))
+        failed = True
+    if result["median_secs"] > args.budget:
+        print("over the startup budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
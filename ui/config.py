@@ -8,16 +8,93 @@ class Config(object):
     SECRET_KEY = 'you-would-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
-    SESSION_TYPE = "filesystem"
+    # "blob" keeps large session values in a content addressed store (see
+    # app/sessions.py), any other value is a Flask-Session backend
+    SESSION_TYPE = "blob"
     #SESSION_PERMANENT = False
     PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
 
+    # on-disk storage for uploaded tables, caches and job results
+    DATA_DIR = os.environ.get('LILAC_DATA_DIR') or \
+        os.path.join(basedir, 'data')
+    DATASET_DIR = os.path.join(DATA_DIR, 'datasets')
+    JOB_DIR = os.path.join(DATA_DIR, 'jobs')
+    # blob sessions: values pickling to more bytes than this go to the blob
+    # store, the most blob bytes one session and the whole store may hold
+    # (least recently used values are dropped beyond), and how often in
+    # seconds expired sessions and unreferenced blobs are swept
+    SESSION_DIR = os.path.join(DATA_DIR, 'sessions')
+    SESSION_INLINE_MAX_BYTES = 1024
+    SESSION_MAX_BYTES = 512 * 2**20
+    SESSION_STORE_MAX_BYTES = 8 * 2**30
+    SESSION_SWEEP_INTERVAL = 600
+    # background jobs (quality check, export, batch input) run concurrently
+    JOB_WORKERS = 2
+    # rows per page of the JSON table views, and the most a client may ask
+    TABLE_PAGE_SIZE = 100
+    TABLE_MAX_PAGE_SIZE = 5000
+    # request/step timing: Server-Timing headers and /metrics
+    METRICS_ENABLED = True
+
     # lenasampler settings
     ITS_FILENAME_COL = "ITS_File_Name"
     START_TIME_COL = "StartTime"
+    # strftime format of START_TIME_COL without its "(...)" suffix,
+    # None guesses it from the first row
+    START_TIME_FORMAT = None
     DURATION_COL = "Duration_Secs"
     DEFAULT_FILTER_NUM_COLUMNS = ["Duration_Secs", "Silence"]
     SAMPLING_CRITERIA_COLS = ["CT_COUNT"]
+    # memoized filter results kept per worker process
+    FILTER_CACHE_SIZE = 256
+    AUDIO_PROBE_WORKERS = 8
+    AUDIO_METADATA_CACHE_SIZE = 100000
+    # processes used to extract sampled segments, 1 disables the pool
+    EXPORT_WORKERS = os.cpu_count() or 1
+    # extracted segments kept for later exports, by source file and sample
+    # range; the least recently used are deleted beyond
+    # SEGMENT_CACHE_MAX_BYTES (0 disables the cache).  Slices of PCM wav
+    # files cost no more to cut than to copy from the cache, so they are
+    # only cached with SEGMENT_CACHE_PCM (recordings on slow storage)
+    SEGMENT_CACHE_DIR = os.path.join(DATA_DIR, 'segments')
+    SEGMENT_CACHE_MAX_BYTES = 4 * 2**30
+    SEGMENT_CACHE_PCM = False
+    # compare whole seconds of wav duration against the its durations
+    TRUNCATE_AUDIO_DURATION = True
+    # waveform previews: cached min/max envelopes of the wav files, at these
+    # frames per block, computed from chunks of ENVELOPE_CHUNK_FRAMES frames
+    ENVELOPE_DIR = os.path.join(DATA_DIR, 'envelopes')
+    ENVELOPE_LEVELS = [256, 4096, 65536]
+    ENVELOPE_CHUNK_FRAMES = 2**20
+    # audio features of the segments (app/lenasampler/features.py), measured
+    # on request from the filter page, or by a batch using them, from cached
+    # statistics of windows of FEATURE_WINDOW_SECS: samples at or above
+    # FEATURE_CLIP_LEVEL (of full scale) count as clipped, windows below
+    # FEATURE_SILENCE_DBFS as silent
+    FEATURE_DIR = os.path.join(DATA_DIR, 'features')
+    FEATURE_WINDOW_SECS = 0.05
+    FEATURE_CHUNK_FRAMES = 2**20
+    FEATURE_CLIP_LEVEL = 0.999
+    FEATURE_SILENCE_DBFS = -50
+    FEATURE_WORKERS = 4
+    # reading of uploaded LENA exports: columns kept besides the ones the
+    # steps above need (None keeps all), explicit read_csv dtypes, memory
+    # budget of one parsed chunk, largest accepted table, and the
+    # largest distinct/rows ratio of string columns stored as categoricals
+    LENA_CSV_KEEP_COLUMNS = None
+    LENA_CSV_DTYPES = {}
+    LENA_CSV_CHUNK_BYTES = 64 * 2**20
+    LENA_CSV_MAX_MEMORY = 2 * 2**30
+    LENA_CSV_CATEGORY_RATIO = 0.5
+    # reading .its files instead of an export (app/lenasampler/its.py): rows
+    # per "segment", per "conversation" block or per bin of this many
+    # seconds, the processes parsing files at once, and the local time
+    # offset from UTC in seconds, None reads it from the file
+    ITS_GRANULARITY = 300
+    ITS_PARSE_WORKERS = os.cpu_count() or 1
+    ITS_UTC_OFFSET = None
+    # processes running the participants of a batch
+    BATCH_WORKERS = os.cpu_count() or 1
 
     # eyegazecleaner settings
     CODE_COL = "code"
@@ -0,0 +1,91 @@
+''' Fixtures of the tests: an app keeping all its data in a temporary folder,
+small PCM wav files written with the wave module and LENA exports matching
+them.
+
+    cd LENASampler/ui
+    python -m pytest tests
+'''
+
+import os
+import wave
+import numpy as np
+import pandas as pd
+import pytest
+from flask_migrate import upgrade
+from app import create_app
+
+
+def write_wav(fn, seconds, sample_rate=8000, channels=1, sampwidth=2,
+              seed=0):
+    ''' A wav file of random sample bytes, returns its path
+    '''
+    num_frames = int(seconds * sample_rate)
+    rng = np.random.RandomState(seed)
+    with wave.open(str(fn), "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sampwidth)
+        w.setframerate(sample_rate)
+        w.writeframes(rng.bytes(num_frames * channels * sampwidth))
+    return str(fn)
+
+
+def write_lena_export(folder, pid, num_files=2, num_segments=6, seconds=5):
+    ''' <folder>/<pid>_export.csv with num_segments rows of seconds each
+        per its file, and the matching recordings in <folder>/audio/<pid>;
+        returns (csv path, audio folder)
+    '''
+    audio_dir = os.path.join(str(folder), "audio", pid)
+    os.makedirs(audio_dir)
+    rng = np.random.RandomState(len(pid))
+    rows = []
+    for i in range(num_files):
+        its_file = "2021031%d_135447_010263_%d.its"%(i, i)
+        start = pd.Timestamp(2021, 3, 11 + i, 23, 59, 50)
+        for j in range(num_segments):
+            rows.append({
+                "ITS_File_Name": its_file,
+                "StartTime": (start + pd.Timedelta(seconds=j * seconds))
+                             .strftime("%m/%d/%Y %H:%M:%S") + " (Local)",
+                "Duration_Secs": seconds,
+                "Silence": int(rng.randint(0, 5)),
+                "CT_COUNT": int(rng.randint(0, 30)),
+                "AWC_COUNT": int(rng.randint(0, 300))})
+        write_wav(os.path.join(audio_dir, "%s_%s"%(pid, its_file.replace(
+            ".its", ".wav"))), num_segments * seconds, seed=i)
+    csv_fn = os.path.join(str(folder), "%s_export.csv"%pid)
+    pd.DataFrame(rows).to_csv(csv_fn, index=False)
+    return csv_fn, audio_dir
+
+
+def make_app(tmp_path, **settings):
+    ''' An app keeping its data and database under tmp_path, with the
+        settings given
+    '''
+    data_dir = str(tmp_path / "data")
+    return create_app(dict({
+        "TESTING": True,
+        "WTF_CSRF_ENABLED": False,
+        "METRICS_ENABLED": False,
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///%s"%(tmp_path / "test.db"),
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "DATA_DIR": data_dir,
+        "DATASET_DIR": os.path.join(data_dir, "datasets"),
+        "JOB_DIR": os.path.join(data_dir, "jobs"),
+        "SESSION_DIR": os.path.join(data_dir, "sessions"),
+        "SEGMENT_CACHE_DIR": os.path.join(data_dir, "segments"),
+        "ENVELOPE_DIR": os.path.join(data_dir, "envelopes"),
+        "FEATURE_DIR": os.path.join(data_dir, "features"),
+    }, **settings))
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        upgrade()
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
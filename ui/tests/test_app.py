@@ -0,0 +1,35 @@
+import os
+import sys
+import subprocess
+import pandas as pd
+from config import Config
+from app.datastore import create_dataset, dataset_path
+from conftest import make_app
+
+
+def test_dict_settings_override_the_defaults(tmp_path):
+    app = make_app(tmp_path, JOB_WORKERS=3)
+    assert app.config["JOB_WORKERS"] == 3
+    assert app.config["EXPORT_WORKERS"] == Config.EXPORT_WORKERS
+    # creating the app leaves the database to the migrations
+    assert not os.path.exists(str(tmp_path / "test.db"))
+
+
+def test_data_goes_to_the_folders_of_the_app(tmp_path, app):
+    other = make_app(tmp_path / "other")
+    dataset_id = create_dataset(pd.DataFrame({"x": [1, 2]}))
+    assert dataset_path(dataset_id).startswith(app.config["DATASET_DIR"])
+    with other.app_context():
+        assert dataset_path(dataset_id).startswith(
+            other.config["DATASET_DIR"])
+
+
+def test_creating_the_app_does_not_import_pandas(tmp_path):
+    code = "import sys, app; app.create_app(); "\
+           "print(sorted(m for m in ('pandas', 'numpy') if m in sys.modules))"
+    env = dict(os.environ, LILAC_DATA_DIR=str(tmp_path / "data"),
+               DATABASE_URL="sqlite:///%s"%(tmp_path / "app.db"))
+    out = subprocess.check_output([sys.executable, "-c", code], env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stderr=subprocess.DEVNULL)
+    assert out.decode().strip() == "[]"
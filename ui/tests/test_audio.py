@@ -0,0 +1,52 @@
+import io
+import wave
+import pytest
+from app.lenasampler.audio import read_wav_header, segment_frame_range, \
+                                  copy_wav_segment, read_wav_segment, \
+                                  wav_segment_size
+from conftest import write_wav
+
+
+@pytest.mark.parametrize("channels, sampwidth", [(1, 2), (2, 2), (1, 3),
+                                                 (2, 1)])
+@pytest.mark.parametrize("start, duration", [(0, 1), (0.5, 0.25), (1.2, 0.3),
+                                             (2.75, 1)])
+def test_segment_is_bit_identical_to_wave(tmp_path, channels, sampwidth,
+                                          start, duration):
+    fn = write_wav(tmp_path / "a.wav", 3, channels=channels,
+                   sampwidth=sampwidth)
+    info = read_wav_header(fn)
+    start_frame, num_frames = segment_frame_range(info, start, duration)
+    out = io.BytesIO()
+    with open(fn, "rb") as src:
+        copy_wav_segment(src, info, start_frame, num_frames, out)
+    with wave.open(fn) as w:
+        params = w.getparams()
+        w.setpos(start_frame)
+        expected = w.readframes(num_frames)
+
+    out.seek(0)
+    with wave.open(out) as w:
+        assert w.getparams()[:3] == params[:3]
+        assert w.getnframes() == num_frames
+        assert w.readframes(num_frames) == expected
+
+    # the streamed response body is the same file
+    with open(fn, "rb") as src:
+        streamed = b"".join(read_wav_segment(src, info, start_frame,
+                                             num_frames))
+    assert streamed == out.getvalue()
+    assert len(streamed) == wav_segment_size(info, num_frames)
+
+
+def test_segment_byte_ranges(tmp_path):
+    fn = write_wav(tmp_path / "a.wav", 2)
+    info = read_wav_header(fn)
+    start_frame, num_frames = segment_frame_range(info, 0.5, 1)
+    with open(fn, "rb") as src:
+        whole = b"".join(read_wav_segment(src, info, start_frame, num_frames))
+        for first, last in [(0, 10), (20, 60), (44, 45), (100, len(whole)),
+                            (len(whole) - 3, len(whole) + 10)]:
+            part = b"".join(read_wav_segment(src, info, start_frame,
+                                             num_frames, first, last))
+            assert part == whole[first:last]
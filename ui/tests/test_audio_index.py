@@ -0,0 +1,63 @@
+import os
+import time
+import pytest
+from app.models import AudioDirectoryEntry
+from app.lenasampler import audio_index
+from app.lenasampler.audio_index import refresh_audio_index, \
+                                        skipped_audio_files
+from conftest import write_wav
+
+
+@pytest.fixture
+def audio_dir(tmp_path):
+    path = tmp_path / "audio"
+    path.mkdir()
+    write_wav(path / "M001_20210311_135447_010263_2.wav", 1)
+    (path / "._M001_20210311_135447_010263_2.wav").write_bytes(b"x")
+    (path / "notes.txt").write_text("notes")
+    (path / "old").mkdir()
+    return str(path)
+
+
+def age(path, seconds=60):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_entries(app, audio_dir):
+    entries = refresh_audio_index(audio_dir)
+    wav, = entries[entries["status"] == "wav"].itertuples()
+    assert (wav.its_file, wav.idprefix) \
+        == ("20210311_135447_010263_2.its", "M001")
+    assert skipped_audio_files(audio_dir).values.tolist() == [
+        ["._M001_20210311_135447_010263_2.wav", "appledouble"],
+        ["notes.txt", "not_wav"], ["old", "directory"]]
+
+
+def test_unchanged_directory_is_not_listed_again(app, audio_dir,
+                                                 monkeypatch):
+    age(audio_dir)
+    first = refresh_audio_index(audio_dir)
+    scanned = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        scanned.append(path)
+        return scandir(path)
+    monkeypatch.setattr(audio_index.os, "scandir", counting_scandir)
+
+    assert refresh_audio_index(audio_dir) is first
+    # a new process only has the database copy
+    audio_index._recent.clear()
+    assert refresh_audio_index(audio_dir).equals(first)
+    assert scanned == []
+
+    os.remove(os.path.join(audio_dir, "notes.txt"))
+    write_wav(os.path.join(audio_dir, "M001_b.wav"), 1)
+    age(audio_dir, 30)
+    entries = refresh_audio_index(audio_dir)
+    assert len(scanned) == 1
+    assert entries["name"].tolist() == [
+        "._M001_20210311_135447_010263_2.wav",
+        "M001_20210311_135447_010263_2.wav", "M001_b.wav", "old"]
+    assert AudioDirectoryEntry.query.count() == 4
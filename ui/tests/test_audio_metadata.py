@@ -0,0 +1,46 @@
+import os
+from app.models import AudioMetadata
+from app.lenasampler import utils
+from app.lenasampler.utils import get_audio_metadata, prune_audio_metadata
+from conftest import write_wav
+
+
+def counting_probe(monkeypatch):
+    probed = []
+    probe = utils.probe_audio_file
+
+    def counting(fn):
+        probed.append(os.path.basename(fn))
+        return probe(fn)
+    monkeypatch.setattr(utils, "probe_audio_file", counting)
+    return probed
+
+
+def test_unchanged_files_are_not_probed_again(app, tmp_path, monkeypatch):
+    probed = counting_probe(monkeypatch)
+    a = write_wav(tmp_path / "a.wav", 2)
+    b = write_wav(tmp_path / "b.wav", 3, sample_rate=16000)
+    metadata = get_audio_metadata([a, b, a], max_workers=2)
+    assert metadata[a]["duration"] == 2
+    assert (metadata[b]["duration"], metadata[b]["sample_rate"]) \
+        == (3, 16000)
+    assert sorted(probed) == ["a.wav", "b.wav"]
+
+    del probed[:]
+    assert get_audio_metadata([a, b]) == metadata
+    assert probed == []
+
+    # a changed file is probed again
+    write_wav(tmp_path / "b.wav", 1)
+    assert get_audio_metadata([b])[b]["duration"] == 1
+    assert probed == ["b.wav"]
+
+
+def test_prune(app, tmp_path):
+    fns = [write_wav(tmp_path / ("%s.wav"%i), 1) for i in range(4)]
+    for fn in fns:
+        get_audio_metadata([fn])
+    os.remove(fns[0])
+    prune_audio_metadata(max_entries=2)
+    assert sorted(row.path for row in AudioMetadata.query.all()) \
+        == [os.path.abspath(fn) for fn in fns[2:]]
@@ -0,0 +1,45 @@
+import os
+import zipfile
+import pandas as pd
+from app.jobs import submit_job
+from app.lenasampler.batch import batch_job, find_participants, \
+                                  participant_seed
+from conftest import write_lena_export
+from test_jobs import wait_for
+
+
+def test_participant_seeds():
+    seeds = [participant_seed(1, pid) for pid in ["M001", "M002"]]
+    assert seeds[0] != seeds[1]
+    assert participant_seed(1, "M001") == seeds[0]
+    assert participant_seed(2, "M001") != seeds[0]
+
+
+def test_batch(app, tmp_path):
+    for pid in ["M001", "M002", "M003"]:
+        write_lena_export(tmp_path, pid)
+    # no recordings for M003
+    os.rename(tmp_path / "audio" / "M003", tmp_path / "M003_audio")
+    assert sorted(find_participants(str(tmp_path), str(tmp_path / "audio"))) \
+        == ["M001", "M002", "M003"]
+
+    output_dir = str(tmp_path / "out")
+    job_id = submit_job("Batch", batch_job, str(tmp_path),
+                        str(tmp_path / "audio"), output_dir,
+                        {"target_num_segments": 4,
+                         "sampling_mode": "stratified",
+                         "allocation": "equal"}, n_workers=2)
+    state = wait_for(job_id)
+    assert state["status"] == "done", state["error"]
+
+    summary = pd.read_csv(os.path.join(output_dir, "batch_summary.csv"))
+    assert summary["Status"].tolist() == ["done", "done", "failed"]
+    assert summary["Sampled"].tolist() == [4, 4, 0]
+    manifest = pd.read_csv(os.path.join(output_dir, "batch_manifest.csv"))
+    assert manifest.groupby("Participant")["ITS_File_Name"].nunique()\
+        .to_dict() == {"M001": 2, "M002": 2}
+    for pid in ["M001", "M002"]:
+        with zipfile.ZipFile(os.path.join(output_dir,
+                "%s_SampledAudioSegments.zip"%pid)) as zipf:
+            assert zipf.testzip() is None
+            assert len(zipf.namelist()) == 5
@@ -0,0 +1,68 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from app.datastore import create_dataset, dataset_path, read_table, \
+                          read_table_meta, read_column, add_columns, \
+                          numeric_columns
+
+
+def test_round_trip(app):
+    df = pd.DataFrame({
+        "count": [1, 2, 3, 4],
+        "rate": [0.5, np.nan, 1.5, 2.0],
+        "flag": [True, False, True, True],
+        "when": pd.to_datetime(["2021-03-12"] * 4),
+        "code": pd.Categorical(["a", "b", "a", "c"]),
+        "note": ["x", None, "é ünïcode", ""]})
+    dataset_id = create_dataset(df)
+    pd.testing.assert_frame_equal(read_table(dataset_id, "records"), df,
+                                  check_categorical=False)
+
+    rows = read_table(dataset_id, "records", columns=["note", "count"],
+                      rows=[3, 1, 2])
+    assert rows.index.tolist() == [3, 1, 2]
+    assert rows["note"].tolist()[::2] == ["", "é ünïcode"]
+    assert pd.isnull(rows["note"].iloc[1])
+    assert rows["count"].tolist() == [4, 2, 3]
+
+
+def test_text_is_not_padded_to_the_longest_value(app):
+    df = pd.DataFrame({"path": ["a"] * 999 + ["x" * 10000]})
+    dataset_id = create_dataset(df)
+    table_dir = os.path.join(dataset_path(dataset_id), "records")
+    size = sum(os.path.getsize(os.path.join(table_dir, fn))
+               for fn in os.listdir(table_dir))
+    assert size < 30000
+    assert read_column(dataset_id, "records", "path")[-1] == "x" * 10000
+
+    empty = create_dataset(pd.DataFrame({"path": ["", ""]}))
+    assert read_table(empty, "records")["path"].tolist() == ["", ""]
+
+
+def test_numeric_columns_from_the_meta(app):
+    df = pd.DataFrame({"count": [1, 2], "note": ["a", "b"],
+                       "flag": [True, False], "rate": [0.5, 1.0],
+                       "when": pd.to_datetime(["2021-03-12"] * 2),
+                       "code": pd.Categorical(["a", "b"])})
+    dataset_id = create_dataset(df)
+    meta = read_table_meta(dataset_id, "records")
+    assert numeric_columns(meta) == ["count", "flag", "rate"]
+    assert numeric_columns(meta) == list(df._get_numeric_data().columns)
+
+    add_columns(dataset_id, "records", pd.DataFrame({"count": ["1", "2"],
+                                                     "more": [3, 4]}))
+    meta = read_table_meta(dataset_id, "records")
+    assert numeric_columns(meta) == ["flag", "rate", "more"]
+    assert read_column(dataset_id, "records", "count").tolist() == ["1", "2"]
+
+    # tables stored without the dtypes get them from the .npy headers
+    meta_path = os.path.join(dataset_path(dataset_id), "records",
+                             "meta.json")
+    with open(meta_path) as f:
+        stored = json.load(f)
+    del stored["dtypes"]
+    with open(meta_path, "w") as f:
+        json.dump(stored, f)
+    assert numeric_columns(read_table_meta(dataset_id, "records")) \
+        == ["flag", "rate", "more"]
@@ -0,0 +1,114 @@
+import io
+import os
+import wave
+import zipfile
+import pandas as pd
+from app.lenasampler.audio import read_wav_header, segment_frame_range, \
+                                  wav_segment_size
+from app.lenasampler.utils import plan_audio_segments, parse_start_times, \
+                                  its_start_times, stream_audio_zip, \
+                                  extract_segments
+from conftest import write_wav
+
+ITS, START, DURATION = "ITS_File_Name", "StartTime", "Duration_Secs"
+
+
+def export_rows():
+    return pd.DataFrame({
+        ITS: ["a.its"] * 4 + ["b.its"] * 2,
+        START: ["03/11/2021 23:59:50 (Local)", "03/11/2021 23:59:55 (Local)",
+                "03/12/2021 00:00:00 (Local)", "03/12/2021 00:00:05 (Local)",
+                "03/12/2021 10:00:00 (Local)", "03/12/2021 10:00:05 (Local)"],
+        DURATION: [5] * 6})
+
+
+def test_relative_start_wraps_midnight():
+    df_ori = export_rows()
+    df = df_ori.iloc[[1, 3, 5]].copy()
+    df, segments = plan_audio_segments(df, df_ori, "audio", "M001",
+                                       ITS, START, DURATION)
+    assert df["segment_relative_start_time"].tolist() == [5, 15, 5]
+    assert sorted(segments) == [os.path.join("audio", "M001_a.wav"),
+                                os.path.join("audio", "M001_b.wav")]
+    starts = [(start, duration) for start, duration, _
+              in segments[os.path.join("audio", "M001_a.wav")]]
+    assert starts == [(5, 5), (15, 5)]
+    assert df["segment_filename"].iloc[1] == \
+        "M001_a_AbsStart_2021-03-12 00:00:05_RelStart_15_Duration_5.wav"
+
+
+def test_precomputed_start_times_give_the_same_plan():
+    df_ori = export_rows()
+    start_ns = parse_start_times(df_ori[START])
+    its_start_ns = its_start_times(df_ori[ITS], start_ns)
+    rows = [1, 3, 5]
+    planned, segments = plan_audio_segments(df_ori.iloc[rows].copy(), df_ori,
+                                            "audio", "M001", ITS, START,
+                                            DURATION)
+    given, given_segments = plan_audio_segments(df_ori.iloc[rows].copy(),
+                                                None, "audio", "M001", ITS,
+                                                START, DURATION,
+                                                start_ns=start_ns[rows],
+                                                its_start_ns=its_start_ns)
+    assert given.equals(planned)
+    assert given_segments == segments
+
+
+def read_zip(chunks):
+    return zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+
+
+def test_zip_entries_declare_the_padded_size(app, tmp_path):
+    # 8-bit mono at an odd rate: one second of data is an odd byte count
+    fn = write_wav(tmp_path / "M001_a.wav", 3, sample_rate=8001, sampwidth=1)
+    df_ori = export_rows().iloc[:2]
+    df_ori[START] = ["03/11/2021 23:59:50 (Local)",
+                     "03/11/2021 23:59:51 (Local)"]
+    df_ori[DURATION] = [1, 1]
+    with read_zip(stream_audio_zip(df_ori.copy(), df_ori, str(tmp_path),
+            "M001", ITS, START, DURATION, cache=False)) as zipf:
+        assert zipf.testzip() is None
+        entry, = [i for i in zipf.infolist() if "_RelStart_1_" in i.filename]
+        info = read_wav_header(fn)
+        size = wav_segment_size(info, segment_frame_range(info, 1, 1)[1])
+        assert size % 2 == 0
+        assert entry.file_size == size
+        with wave.open(zipf.open(entry)) as w:
+            assert w.getnframes() == 8001
+
+
+def test_bad_sources_are_segment_errors(app, tmp_path):
+    write_wav(tmp_path / "M001_a.wav", 20)
+    with open(tmp_path / "M001_b.wav", "wb") as f:
+        f.write(b"RIFF\x00\x00\x00\x00WAVEjunk")
+    df_ori = export_rows()
+    with read_zip(stream_audio_zip(df_ori.copy(), df_ori, str(tmp_path),
+            "M001", ITS, START, DURATION, cache=False)) as zipf:
+        assert zipf.testzip() is None
+        names = zipf.namelist()
+        metadata = pd.read_csv(zipf.open(names[-1]))
+    assert len(names) == 5
+    errors = metadata["segment_error"].fillna("")
+    assert (errors[:4] == "").all()
+    assert (errors[4:] != "").all()
+
+
+def test_parallel_extraction_matches_serial(tmp_path):
+    sources = [write_wav(tmp_path / ("%s.wav"%i), 4, seed=i)
+               for i in range(3)]
+    missing = str(tmp_path / "missing.wav")
+    results = []
+    for n_workers in [1, 3]:
+        outdir = tmp_path / ("out%s"%n_workers)
+        outdir.mkdir()
+        segments = {fn: [(start, 1, str(outdir / ("%s_%s.wav"%(i, start))))
+                         for start in [0, 2.5]]
+                    for i, fn in enumerate(sources + [missing])}
+        errors, statuses = extract_segments(segments, n_workers=n_workers)
+        assert sorted(os.path.basename(fn) for fn in errors) \
+            == ["3_0.wav", "3_2.5.wav"]
+        assert set(statuses.values()) == {"uncached"}
+        results.append({fn: open(outdir / fn, "rb").read()
+                        for fn in sorted(os.listdir(outdir))})
+    assert len(results[0]) == 6
+    assert results[0] == results[1]
@@ -0,0 +1,64 @@
+import wave
+import numpy as np
+import pandas as pd
+from app.datastore import read_table, read_table_meta, numeric_columns
+from app.lenasampler.features import FEATURE_COLUMNS, segment_features, \
+                                     add_audio_features, feature_columns
+from app.lenasampler.filtering import filter_rows
+from app.lenasampler.utils import read_lena_export, ingest_records
+from conftest import write_lena_export
+
+
+def write_levels(fn, sample_rate=8000):
+    ''' 1 s of silence, 1 s of a full scale square wave and 1 s of a sine
+        at half scale, 16 bit mono
+    '''
+    t = np.arange(sample_rate) / sample_rate
+    samples = np.concatenate([np.zeros(sample_rate),
+                              np.where(np.arange(sample_rate) % 2, 1, -1),
+                              0.5 * np.sin(2 * np.pi * 100 * t)])
+    with wave.open(str(fn), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(np.round(samples * 32767).astype("<i2").tobytes())
+    return str(fn)
+
+
+def test_segment_features(tmp_path):
+    fn = write_levels(tmp_path / "a.wav")
+    features = segment_features(fn, [0, 1, 2, 0.5, 5], [1, 1, 1, 1, 1],
+                                root=str(tmp_path / "features"))
+    assert features.columns.tolist() == FEATURE_COLUMNS
+    silence, square, sine, half, outside = features.values.tolist()
+    assert silence == [-100, -100, 0, 100]
+    assert square == [0, 0, 100, 0]
+    # a sine wave's RMS is 3 dB below its peak
+    assert abs(sine[0] - (20 * np.log10(0.5) - 3.01)) < 0.05
+    assert abs(sine[1] - 20 * np.log10(0.5)) < 0.01
+    assert sine[2:] == [0, 0]
+    assert (half[2], half[3]) == (50, 50)
+    assert np.isnan(outside).all()
+
+
+def test_features_become_columns_of_the_records(app, tmp_path):
+    csv_fn, audio_dir = write_lena_export(tmp_path, "M001")
+    dft, _ = read_lena_export(csv_fn)
+    dataset_id = ingest_records(dft, "M001")
+    its_files = sorted(dft["ITS_File_Name"].unique())
+    statuses = add_audio_features(dataset_id, audio_dir, its_files[:1])
+    assert statuses == {its_files[0]: "ok"}
+    assert feature_columns(dataset_id) == FEATURE_COLUMNS
+    assert set(FEATURE_COLUMNS) <= set(numeric_columns(
+        read_table_meta(dataset_id, "records")))
+
+    records = read_table(dataset_id, "records")
+    measured = records["ITS_File_Name"] == its_files[0]
+    assert records.loc[measured, FEATURE_COLUMNS].notnull().all().all()
+    assert records.loc[~measured, FEATURE_COLUMNS].isnull().all().all()
+    # random full scale samples
+    rows = filter_rows(dataset_id, None, {"RMS_dBFS": (-10, 0)})
+    assert rows.tolist() == np.flatnonzero(measured).tolist()
+    pd.testing.assert_frame_equal(
+        read_table(dataset_id, "records", rows=rows)[FEATURE_COLUMNS],
+        records.loc[measured, FEATURE_COLUMNS])
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.datastore import add_columns, delete_dataset
+from app.lenasampler.filtering import filter_rows, filter_cache, \
+                                      rebuild_column_index
+from app.lenasampler.utils import ingest_records
+
+
+def export_table(n=200, seed=0):
+    rng = np.random.RandomState(seed)
+    its_files = ["a.its", "b.its", "c.its"]
+    return pd.DataFrame({
+        "ITS_File_Name": np.repeat(its_files, n // 3 + 1)[:n],
+        "StartTime": ["03/12/2021 00:00:%02d (Local)"%(i % 60)
+                      for i in range(n)],
+        "Duration_Secs": rng.randint(1, 30, n).astype(float),
+        "Silence": rng.randint(0, 10, n).astype(float),
+        "CT_COUNT": rng.randint(0, 5, n)})
+
+
+@pytest.fixture
+def dataset(app):
+    dft = export_table()
+    return ingest_records(dft, "M001"), dft
+
+
+@pytest.mark.parametrize("its_files, ranges", [
+    (None, {}),
+    (["a.its", "c.its"], {}),
+    (None, {"Duration_Secs": (5, 20)}),
+    (["b.its"], {"Duration_Secs": (5, None), "Silence": (None, 3)}),
+    (["a.its"], {"CT_COUNT": (2, 2)}),
+    ([], {"Silence": (0, 9)})])
+def test_filter_rows_matches_pandas(dataset, its_files, ranges):
+    dataset_id, dft = dataset
+    mask = np.ones(len(dft), dtype=bool)
+    if its_files is not None:
+        mask &= dft["ITS_File_Name"].isin(its_files).values
+    for col, (minv, maxv) in ranges.items():
+        if minv is not None:
+            mask &= (dft[col] >= minv).values
+        if maxv is not None:
+            mask &= (dft[col] <= maxv).values
+    rows = filter_rows(dataset_id, its_files, ranges)
+    assert rows.tolist() == np.flatnonzero(mask).tolist()
+
+
+def test_results_follow_column_updates(dataset):
+    dataset_id, dft = dataset
+    ranges = {"CT_COUNT": (3, None)}
+    # the first use indexes the column, a new version of the dataset
+    filter_rows(dataset_id, None, ranges)
+    before = filter_rows(dataset_id, None, ranges)
+    assert filter_rows(dataset_id, None, ranges) is before
+
+    add_columns(dataset_id, "records",
+                pd.DataFrame({"CT_COUNT": dft["CT_COUNT"] + 10}))
+    rebuild_column_index(dataset_id, ["CT_COUNT"])
+    assert len(filter_rows(dataset_id, None, ranges)) == len(dft)
+
+    add_columns(dataset_id, "records",
+                pd.DataFrame({"RMS_dBFS": -np.arange(len(dft), dtype=float)}))
+    assert filter_rows(dataset_id, None,
+                       {"RMS_dBFS": (-4, None)}).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_cache_size_and_delete(app, dataset):
+    dataset_id, dft = dataset
+    app.extensions.pop("dataset_caches", None)
+    app.config["FILTER_CACHE_SIZE"] = 2
+    for maxv in [1, 2, 3]:
+        filter_rows(dataset_id, None, {"Silence": (None, maxv)})
+    cache = filter_cache()
+    assert cache.maxsize == 2
+    assert len(cache.entries) == 2
+
+    other_id = ingest_records(export_table(seed=1), "M002")
+    filter_rows(other_id, None, {"Silence": (None, 1)})
+    delete_dataset(dataset_id)
+    assert [key[0] for key in cache.entries] == [other_id]
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.lenasampler.utils import read_lena_export, downcast_column
+
+
+@pytest.fixture
+def export_csv(tmp_path):
+    n = 5000
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame({
+        "ITS_File_Name": ["2021031%d_135447_010263_%d.its"%(i % 3, i % 3)
+                          for i in range(n)],
+        "StartTime": ["03/12/2021 00:00:%02d (Local)"%(i % 60)
+                      for i in range(n)],
+        "Duration_Secs": rng.randint(1, 300, n),
+        "Silence": np.round(rng.rand(n) * 10, 2),
+        "CT_COUNT": rng.randint(0, 30, n),
+        "AWC_COUNT": rng.randint(0, 70000, n),
+        "Note": ["row %s"%i for i in range(n)]})
+    fn = str(tmp_path / "M001_export.csv")
+    df.to_csv(fn, index=False)
+    return fn
+
+
+def test_chunks_give_the_values_of_read_csv(export_csv):
+    expected = pd.read_csv(export_csv)
+    df, stats = read_lena_export(export_csv, chunk_bytes=20000)
+    assert df.columns.tolist() == ["index"] + expected.columns.tolist()
+    assert df["index"].tolist() == list(range(len(expected)))
+    pd.testing.assert_frame_equal(df.drop(columns="index").astype(object),
+                                  expected.astype(object))
+    assert isinstance(df["ITS_File_Name"].dtype, pd.CategoricalDtype)
+    assert df["Note"].dtype == object
+    assert df["CT_COUNT"].dtype == np.int8
+    assert df["AWC_COUNT"].dtype == np.int32
+    assert stats["rows"] == len(expected)
+    assert stats["memory"] < expected.memory_usage(index=False,
+                                                   deep=True).sum()
+    assert stats["peak_memory"] >= stats["memory"]
+
+
+def test_keep_columns_and_memory_limit(app, export_csv):
+    df, _ = read_lena_export(export_csv, keep_columns=["Silence"])
+    assert "Note" not in df.columns
+    assert {"ITS_File_Name", "StartTime", "Duration_Secs", "Silence",
+            "CT_COUNT"} <= set(df.columns)
+    with pytest.raises(ValueError):
+        read_lena_export(export_csv, max_memory=10000)
+
+
+def test_floats_are_only_downcast_when_exact():
+    assert downcast_column(pd.Series([0.5, 1.25, np.nan])).dtype \
+        == np.float32
+    assert downcast_column(pd.Series([0.1, 1.0])).dtype == np.float64
+    assert downcast_column(pd.Series([1, 300])).dtype == np.int16
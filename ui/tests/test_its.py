@@ -0,0 +1,75 @@
+import pytest
+from app.lenasampler.its import parse_its_file, SOUND_COLUMNS
+
+# the recording starts at 23:59:30 local time (UTC-5) and lasts 130
+# seconds, so one minute bins are [0, 60), [60, 120), [120, 130) into it
+ITS_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<ITS fileName="a">
+<ExportData><TransferTime LocalTime="2021-03-11T18:00:00"
+    UTCTime="2021-03-11T23:00:00" TimeZone="EST"/></ExportData>
+<ProcessingUnit><Bar num="1" startClockTime="2021-03-12T04:59:30Z">
+<Recording num="1" startClockTime="2021-03-12T04:59:30Z" startTime="PT0.00S"
+    endTime="PT130.00S">
+<Conversation num="1" turnTaking="3">
+<Segment spkr="FAN" startTime="PT0.00S" endTime="PT20.00S"
+    femaleAdultWordCnt="4.50"/>
+<Segment spkr="CHN" startTime="PT20.00S" endTime="PT45.00S"
+    childUttCnt="2"/>
+</Conversation>
+<Pause num="2">
+<Segment spkr="TVN" startTime="PT45.00S" endTime="PT100.00S"/>
+<Segment spkr="SIL" startTime="PT100.00S" endTime="PT130.00S"/>
+</Pause>
+</Recording></Bar></ProcessingUnit>
+</ITS>
+'''
+
+
+@pytest.fixture
+def its_file(tmp_path):
+    fn = tmp_path / "20210311_120000_000000_0.its"
+    fn.write_text(ITS_XML)
+    return str(fn)
+
+
+def test_minute_bins(its_file):
+    df = parse_its_file(its_file, granularity=60)
+    assert df["StartTime"].tolist() == ["03/11/2021 23:59:30 (Local)",
+                                        "03/12/2021 00:00:30 (Local)",
+                                        "03/12/2021 00:01:30 (Local)"]
+    assert df["Duration_Secs"].tolist() == [60, 60, 10]
+    assert df["Meaningful"].tolist() == [45, 0, 0]
+    assert df["TV"].tolist() == [15, 40, 0]
+    assert df["Silence"].tolist() == [0, 20, 10]
+    # counts go to the bin the segment (or its conversation) starts in
+    assert df["AWC_COUNT"].tolist() == [4.5, 0, 0]
+    assert df["CT_COUNT"].tolist() == [3, 0, 0]
+    assert df["CV_COUNT"].tolist() == [2, 0, 0]
+    assert (df[SOUND_COLUMNS].sum(axis=1) == df["Duration_Secs"]).all()
+
+
+@pytest.mark.parametrize("granularity", ["segment", "conversation", 7, 60,
+                                         300])
+def test_totals_do_not_depend_on_granularity(its_file, granularity):
+    df = parse_its_file(its_file, granularity=granularity)
+    totals = df[SOUND_COLUMNS + ["Duration_Secs", "AWC_COUNT", "CT_COUNT",
+                                 "CV_COUNT"]].sum()
+    assert totals.to_dict() == {"Meaningful": 45, "Distant": 0, "TV": 55,
+                                "Noise": 0, "Silence": 30,
+                                "Duration_Secs": 130, "AWC_COUNT": 4.5,
+                                "CT_COUNT": 3, "CV_COUNT": 2}
+    assert (df["ITS_File_Name"] == "20210311_120000_000000_0.its").all()
+
+
+def test_rows_per_granularity(its_file):
+    assert len(parse_its_file(its_file, granularity="segment")) == 4
+    assert len(parse_its_file(its_file, granularity="conversation")) == 2
+    # the same clock bins with the offset given instead of read
+    utc = parse_its_file(its_file, granularity=60, utc_offset=0)
+    assert utc["StartTime"].iloc[0] == "03/12/2021 04:59:30 (Local)"
+
+
+def test_bins_are_clipped_to_the_recording_end(its_file):
+    df = parse_its_file(its_file, granularity=7)
+    assert df["Duration_Secs"].tolist() == [7] * 18 + [4]
+    assert df["StartTime"].iloc[-1] == "03/12/2021 00:01:36 (Local)"
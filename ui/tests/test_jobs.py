@@ -0,0 +1,80 @@
+import time
+import threading
+import pytest
+from flask import jsonify
+from app.jobs import submit_job, get_job_state, get_job_result, cancel_job
+
+
+def wait_for(job_id, statuses=("done", "failed", "cancelled")):
+    for _ in range(500):
+        state = get_job_state(job_id)
+        if state["status"] in statuses:
+            return state
+        time.sleep(0.01)
+    raise AssertionError("job %s still %s"%(job_id, state["status"]))
+
+
+def count_job(job, n):
+    for i in range(n):
+        job.progress(i, n)
+    with open(job.result_path("result.txt"), "w") as f:
+        f.write("counted %s"%n)
+    return n * 2
+
+
+def failing_job(job):
+    raise ValueError("bad input")
+
+
+def test_result_and_failure(app):
+    job_id = submit_job("Count", count_job, 5)
+    state = wait_for(job_id)
+    assert (state["status"], state["done"], state["total"]) == ("done", 5, 5)
+    assert get_job_result(job_id) == 10
+
+    state = wait_for(submit_job("Fail", failing_job))
+    assert state["status"] == "failed"
+    assert "ValueError: bad input" in state["error"]
+
+
+def test_cancel(app):
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_job(job):
+        started.set()
+        release.wait(5)
+        job.progress(1, 2)
+        return "not cancelled"
+
+    job_id = submit_job("Block", blocking_job)
+    assert started.wait(5)
+    assert cancel_job(job_id)
+    release.set()
+    assert wait_for(job_id)["status"] == "cancelled"
+    assert not cancel_job("unknown")
+
+
+@pytest.fixture
+def job_clients(app):
+    @app.route("/start_job")
+    def start_job():
+        return jsonify(job_id=submit_job("Count", count_job, 3))
+
+    return app.test_client(), app.test_client()
+
+
+def test_job_views_only_serve_the_owner(job_clients):
+    owner, other = job_clients
+    job_id = owner.get("/start_job").json["job_id"]
+    wait_for(job_id)
+
+    state = owner.get("/jobs/%s"%job_id).json
+    assert state["status"] == "done"
+    assert owner.get(state["result_url"]).data == b"counted 3"
+
+    for url in ["/jobs/%s", "/jobs/%s/result"]:
+        assert other.get(url%job_id).status_code == 404
+    assert other.post("/jobs/%s/cancel"%job_id).status_code == 404
+    assert other.get("/jobs/unknown").status_code == 404
+    assert owner.post("/jobs/%s/cancel"%job_id).status_code == 200
@@ -0,0 +1,66 @@
+import re
+from flask import session
+from app.metrics import SESSION_SIZE, STAGE_DURATION, timed
+from conftest import make_app
+
+
+def metrics_app(tmp_path, **settings):
+    app = make_app(tmp_path, METRICS_ENABLED=True, **settings)
+
+    @timed("test.step")
+    def step():
+        return 1
+
+    @app.route("/assign")
+    def assign():
+        session["value"] = step()
+        return "ok"
+
+    @app.route("/noop")
+    def noop():
+        return "ok"
+    return app
+
+
+def size_count(route):
+    counts = SESSION_SIZE.series.get((route,))
+    return 0 if counts is None else counts[-2]
+
+
+def test_server_timing_and_exposition(tmp_path):
+    client = metrics_app(tmp_path).test_client()
+    before = size_count("/assign")
+    timing = client.get("/assign").headers["Server-Timing"]
+    assert re.search(r"test\.step;dur=[0-9.]+", timing)
+    assert re.search(r"total;dur=[0-9.]+", timing)
+    assert re.search(r'session;desc="[0-9]+ bytes"', timing)
+    assert size_count("/assign") == before + 1
+    assert STAGE_DURATION.series[("test.step",)][-2] >= 1
+
+    text = client.get("/metrics").data.decode()
+    assert 'lilac_request_duration_seconds_count{route="/assign",'\
+           'method="GET",status="200"}' in text
+    assert 'lilac_stage_duration_seconds_count{stage="test.step"}' in text
+
+
+def test_session_size_only_when_the_backend_reports_it(tmp_path):
+    client = metrics_app(tmp_path).test_client()
+    client.get("/assign")
+    before = size_count("/noop")
+    timing = client.get("/noop").headers["Server-Timing"]
+    # the blob session did not write anything
+    assert "session;desc" not in timing
+    assert size_count("/noop") == before
+
+    (tmp_path / "fs").mkdir()
+    client = metrics_app(tmp_path / "fs", SESSION_TYPE="filesystem",
+        SESSION_FILE_DIR=str(tmp_path / "fs_sessions")).test_client()
+    before = size_count("/assign")
+    timing = client.get("/assign").headers["Server-Timing"]
+    assert "session_save;dur=" in timing
+    assert "session;desc" not in timing
+    assert size_count("/assign") == before
+
+
+def test_metrics_disabled(client):
+    assert client.get("/metrics").status_code == 404
@@ -0,0 +1,67 @@
+import os
+import json
+import zipfile
+import pandas as pd
+from app.lenasampler.pipeline import load_param_file, run_pipeline
+from conftest import write_lena_export
+
+
+def write_params(tmp_path, **config):
+    fn = tmp_path / "params.json"
+    fn.write_text(json.dumps(dict({
+        "output_dir": "out",
+        "params": {"target_num_segments": 3},
+        "participants": [
+            {"export": "M001_export.csv", "audio_dir": "audio/M001"},
+            {"export": "M002_export.csv", "audio_dir": "audio/M002",
+             "id": "second", "params": {"target_num_segments": 5}}]},
+        **config)))
+    return str(fn)
+
+
+def test_cli_run(app, tmp_path):
+    for pid in ["M001", "M002"]:
+        write_lena_export(tmp_path, pid)
+    result = app.test_cli_runner().invoke(args=["lenasampler", "run",
+        write_params(tmp_path), "--workers", "2"])
+    assert result.exit_code == 0, result.output
+    lines = [json.loads(line) for line in result.output.splitlines()
+             if line.startswith("{")]
+    assert sorted((line["Participant"], line["Sampled"]) for line in lines) \
+        == [("M001", 3), ("second", 5)]
+
+    out = tmp_path / "out"
+    with zipfile.ZipFile(out / "second_SampledAudioSegments.zip") as zipf:
+        assert zipf.testzip() is None
+        names = zipf.namelist()
+    # the audio files are still named with the idprefix of the export
+    assert len(names) == 6
+    assert all(os.path.basename(name).startswith("M002_") for name in names)
+    timings = json.loads((out / "timings.json").read_text())
+    assert [p["Participant"] for p in timings["participants"]] \
+        == ["M001", "second"]
+
+
+def test_folder_output_and_failures(app, tmp_path):
+    write_lena_export(tmp_path, "M001")
+    write_lena_export(tmp_path, "M002")
+    config = load_param_file(write_params(tmp_path,
+                                          output_format="folder"))
+    config["participants"][1]["audio_dir"] = str(tmp_path / "missing")
+    summary = run_pipeline(config)
+    assert summary["Status"].tolist() == ["done", "failed"]
+    assert "does not exist" in summary["Error"].iloc[1]
+    outdir = tmp_path / "out" / "M001_SampledAudioSegments"
+    metadata = pd.read_csv(outdir / "M001_SampledAudioSegmentsMetadata.csv")
+    assert len(metadata) == 3
+    assert sorted(os.listdir(outdir))[:-1] \
+        == sorted(metadata["segment_filename"])
+
+    result = app.test_cli_runner().invoke(args=["lenasampler", "run",
+        write_params(tmp_path), "--output-dir", str(tmp_path / "cli")])
+    assert result.exit_code == 0, result.output
+    os.rename(tmp_path / "audio" / "M002", tmp_path / "gone")
+    result = app.test_cli_runner().invoke(args=["lenasampler", "run",
+        write_params(tmp_path), "--output-dir", str(tmp_path / "cli")])
+    assert result.exit_code == 1
+    assert "1 of 2 participants done" in result.output
@@ -0,0 +1,74 @@
+import io
+import pandas as pd
+import pytest
+from app.lenasampler.audio import read_wav_header, segment_frame_range, \
+                                  copy_wav_segment
+from app.lenasampler.utils import ingest_records
+from conftest import write_wav
+
+
+@pytest.fixture
+def segment_client(app, client, tmp_path):
+    ''' (client with an uploaded export in its session, expected wav of the
+        segment of record 1)
+    '''
+    audio_dir = tmp_path / "audio"
+    audio_dir.mkdir()
+    fn = write_wav(audio_dir / "M001_a.wav", 8)
+    dft = pd.DataFrame({
+        "ITS_File_Name": ["a.its"] * 3,
+        "StartTime": ["03/11/2021 23:59:55 (Local)",
+                      "03/12/2021 00:00:00 (Local)",
+                      "03/12/2021 00:00:01 (Local)"],
+        "Duration_Secs": [5, 1, 1],
+        "Silence": [0, 0, 0],
+        "CT_COUNT": [1, 2, 3],
+        "AWC_COUNT": [4, 5, 6]})
+    dataset_id = ingest_records(dft, "M001")
+    with client.session_transaction() as session:
+        session["dataset_id"] = dataset_id
+        session["audio_dir"] = str(audio_dir)
+        session["filename"] = "M001_export.csv"
+
+    info = read_wav_header(fn)
+    expected = io.BytesIO()
+    with open(fn, "rb") as src:
+        copy_wav_segment(src, info, *segment_frame_range(info, 5, 1),
+                         expected)
+    return client, expected.getvalue()
+
+
+def test_segment_whole(segment_client):
+    client, expected = segment_client
+    r = client.get("/lenasampler/segment/1")
+    assert r.status_code == 200
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.headers["Content-Length"] == str(len(expected))
+    assert r.data == expected
+
+
+@pytest.mark.parametrize("header, first, last", [
+    ("bytes=0-43", 0, 44), ("bytes=10-99", 10, 100), ("bytes=-20", -20, None),
+    ("bytes=100-", 100, None)])
+def test_segment_range(segment_client, header, first, last):
+    client, expected = segment_client
+    r = client.get("/lenasampler/segment/1", headers={"Range": header})
+    assert r.status_code == 206
+    body = expected[first:last]
+    assert r.data == body
+    start = first % len(expected)
+    assert r.headers["Content-Range"] == "bytes %s-%s/%s"\
+        %(start, start + len(body) - 1, len(expected))
+
+
+def test_segment_unsatisfiable_range(segment_client):
+    client, expected = segment_client
+    r = client.get("/lenasampler/segment/1",
+                   headers={"Range": "bytes=%s-"%len(expected)})
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == "bytes */%s"%len(expected)
+
+
+def test_segment_unknown_row(segment_client):
+    client, _ = segment_client
+    assert client.get("/lenasampler/segment/3").status_code == 404
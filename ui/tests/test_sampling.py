@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.lenasampler.sampling import sample_uniform, sample_rows, allocate, \
+                                     parse_quotas
+
+
+@pytest.mark.parametrize("n, seed", [(1, 0), (12, 1), (50, 7), (100, 3),
+                                     (500, 42)])
+def test_sample_uniform_matches_dataframe_sample(n, seed):
+    df = pd.DataFrame({"x": np.arange(100)}, index=np.arange(100) * 3 + 5)
+    sampled, report = sample_uniform(df.index.values, n, seed)
+    expected = df.sample(min(n, len(df)), random_state=seed).index.values
+    assert sampled.tolist() == expected.tolist()
+    assert report["Sampled"].tolist() == [min(n, len(df))]
+
+
+@pytest.mark.parametrize("sizes, n, allocation, expected", [
+    ([50, 30, 20], 10, "proportional", [5, 3, 2]),
+    ([10, 10, 10], 10, "proportional", [4, 3, 3]),
+    ([2, 30, 8], 12, "equal", [2, 5, 5]),
+    ([2, 3, 1], 100, "equal", [2, 3, 1]),
+    ([5, 0, 5], 4, "equal", [2, 0, 2]),
+])
+def test_allocate(sizes, n, allocation, expected):
+    alloc = allocate(sizes, n, allocation)
+    assert alloc.tolist() == expected
+    assert alloc.sum() == min(n, sum(sizes))
+
+
+def test_stratified_sample_follows_the_allocation():
+    index = np.arange(100) + 1000
+    strata = np.array(["a"] * 60 + ["b"] * 30 + ["c"] * 10)
+    sampled, report = sample_rows(index, 20, 3, strata=strata)
+    assert report["Sampled"].tolist() == [12, 6, 2]
+    assert len(set(sampled)) == 20
+    assert pd.Series(strata[sampled - 1000]).value_counts().to_dict() \
+        == {"a": 12, "b": 6, "c": 2}
+    # the same seed draws the same rows
+    assert sample_rows(index, 20, 3, strata=strata)[0].tolist() \
+        == sampled.tolist()
+
+
+def test_quotas_are_capped_by_the_stratum_size():
+    strata = np.array(["a"] * 6 + ["b"] * 3 + [None])
+    quotas = parse_quotas("a: 2\nb: 5, c: 4")
+    assert quotas == {"a": 2, "b": 5, "c": 4}
+    sampled, report = sample_rows(np.arange(10), 0, 1, strata=strata,
+                                  quotas=quotas)
+    assert report.set_index("Stratum")[["Available", "Target", "Sampled"]] \
+        .values.tolist() == [[6, 2, 2], [3, 5, 3]]
+    assert sorted(strata[sampled]) == ["a", "a", "b", "b", "b"]
+
+
+def test_weighted_sample_skips_rows_without_weight():
+    weights = np.array([1.0, 0, np.nan, 5.0, -1, 2.0])
+    sampled, _ = sample_rows(np.arange(6), 6, 0, weights=weights)
+    assert sorted(sampled.tolist()) == [0, 3, 5]
@@ -0,0 +1,103 @@
+import io
+import os
+import zipfile
+import pandas as pd
+import pytest
+from app.lenasampler.segment_cache import SegmentCache
+from app.lenasampler.utils import prepare_audio_files, stream_audio_zip
+from conftest import write_wav
+
+
+def write_bytes(n):
+    def write(fn):
+        with open(fn, "wb") as f:
+            f.write(b"x" * n)
+    return write
+
+
+def test_put_is_atomic(tmp_path):
+    cache = SegmentCache(str(tmp_path / "cache"), 10**6)
+    key = "ab" + "0" * 38
+    path = cache.path(key)
+
+    def failing_write(fn):
+        with open(fn, "wb") as f:
+            f.write(b"partial")
+        # nothing is visible under the key while it is being written
+        assert not os.path.exists(path)
+        raise IOError("disk full")
+
+    with pytest.raises(IOError):
+        cache.put(key, failing_write)
+    assert cache.get(key) is None
+    assert os.listdir(os.path.dirname(path)) == []
+
+    assert cache.fetch(key, write_bytes(10)) == (path, "miss")
+    assert cache.fetch(key, failing_write) == (path, "hit")
+    assert open(path, "rb").read() == b"x" * 10
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = SegmentCache(str(tmp_path / "cache"), 350)
+    keys = ["%02d" % i + "0" * 38 for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        cache.put(key, write_bytes(100))
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    # using the oldest entry makes the second one the least recently used
+    assert cache.get(keys[0]) is not None
+
+    cache.put(keys[3], write_bytes(100))
+    assert cache.get(keys[1]) is None
+    remaining = [key for key in keys if cache.get(key) is not None]
+    assert remaining == [keys[0], keys[2], keys[3]]
+    assert sum(size for _, size, _ in cache.entries()) <= 350 * 0.9
+
+
+@pytest.fixture
+def export_rows(tmp_path):
+    audio_dir = tmp_path / "audio"
+    audio_dir.mkdir()
+    write_wav(audio_dir / "M001_a.wav", 4)
+    df = pd.DataFrame({
+        "ITS_File_Name": ["a.its"] * 2 + ["b.its"],
+        "StartTime": ["03/12/2021 00:00:00 (Local)",
+                      "03/12/2021 00:00:02 (Local)",
+                      "03/12/2021 10:00:00 (Local)"],
+        "Duration_Secs": [1, 1, 1]})
+    return str(audio_dir), df
+
+
+def test_cache_use_is_in_the_export_metadata(app, tmp_path, export_rows):
+    audio_dir, df = export_rows
+    cache = SegmentCache(str(tmp_path / "cache"), 10**6, cache_pcm=True)
+    args = (audio_dir, str(tmp_path / "out"), "M001", "ITS_File_Name",
+            "StartTime", "Duration_Secs")
+    first = prepare_audio_files(df.copy(), df, *args, n_workers=1,
+                                cache=cache)
+    assert first["segment_cache"].tolist() == ["miss", "miss", ""]
+    assert first["segment_error"].iloc[2] != ""
+    second = prepare_audio_files(df.copy(), df, *args, n_workers=1,
+                                 cache=cache)
+    assert second["segment_cache"].tolist() == ["hit", "hit", ""]
+    metadata = pd.read_csv(os.path.join(str(tmp_path / "out"),
+                           "M001_SampledAudioSegmentsMetadata.csv"))
+    assert metadata["segment_cache"].fillna("").tolist() \
+        == ["hit", "hit", ""]
+
+    uncached = prepare_audio_files(df.copy(), df, *args, n_workers=1,
+        cache=SegmentCache(str(tmp_path / "cache"), 10**6))
+    assert uncached["segment_cache"].tolist() == ["uncached", "uncached", ""]
+
+
+def test_cache_use_is_in_the_streamed_metadata(app, tmp_path,
+                                                export_rows):
+    audio_dir, df = export_rows
+    cache = SegmentCache(str(tmp_path / "cache"), 10**6, cache_pcm=True)
+    for expected in ["miss", "hit"]:
+        data = b"".join(stream_audio_zip(df.copy(), df, audio_dir, "M001",
+            "ITS_File_Name", "StartTime", "Duration_Secs", cache=cache))
+        with zipfile.ZipFile(io.BytesIO(data)) as zipf:
+            metadata = pd.read_csv(zipf.open("M001_SampledAudioSegments/"
+                                   "M001_SampledAudioSegmentsMetadata.csv"))
+        assert metadata["segment_cache"].fillna("").tolist() \
+            == [expected, expected, ""]
@@ -0,0 +1,93 @@
+import os
+import time
+import pickle
+from flask import session
+from app.sessions import BlobRef
+
+
+def add_session_views(app):
+    @app.route("/set/<key>/<int:n>")
+    def set_value(key, n):
+        session[key] = list(range(n))
+        return "ok"
+
+    @app.route("/get/<key>")
+    def get_value(key):
+        value = session.get(key)
+        return "missing" if value is None else str(sum(value))
+
+    @app.route("/noop")
+    def noop():
+        return "ok"
+
+
+def head_of(app, client):
+    sid, = [cookie.value for cookie in client.cookie_jar
+            if cookie.name == app.config["SESSION_COOKIE_NAME"]]
+    interface = app.session_interface
+    return interface, sid, interface.read_head(sid, 3600)
+
+
+def test_round_trip(app, client):
+    add_session_views(app)
+    client.get("/set/small/3")
+    client.get("/set/large/5000")
+    interface, sid, head = head_of(app, client)
+    # the small value is inline, the large one a reference to a blob
+    assert head["values"]["small"] == [0, 1, 2]
+    ref = head["values"]["large"]
+    assert isinstance(ref, BlobRef)
+    assert os.path.exists(interface.store.path(ref.digest))
+
+    assert client.get("/get/large").data == str(sum(range(5000))).encode()
+    assert client.get("/get/small").data == b"3"
+    assert client.get("/get/other").data == b"missing"
+    # the blob read back is saved as the same reference
+    _, _, head = head_of(app, client)
+    assert head["values"]["large"].digest == ref.digest
+
+
+def test_unused_session_is_not_written(app, client):
+    add_session_views(app)
+    app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+    client.get("/set/large/5000")
+    interface, sid, _ = head_of(app, client)
+    path = interface.head_path(sid)
+    os.utime(path, (1000, time.time() - 60))
+    mtime = os.stat(path).st_mtime
+
+    r = client.get("/noop")
+    assert "Set-Cookie" not in r.headers
+    assert os.stat(path).st_mtime == mtime
+
+    # refreshing only pushes the expiry back
+    app.config["SESSION_REFRESH_EACH_REQUEST"] = True
+    with open(path, "rb") as f:
+        data = f.read()
+    r = client.get("/noop")
+    assert "Set-Cookie" in r.headers
+    assert os.stat(path).st_mtime > mtime
+    with open(path, "rb") as f:
+        assert f.read() == data
+
+
+def test_least_recently_used_values_are_dropped(app, client):
+    add_session_views(app)
+    size = len(pickle.dumps(list(range(5000)), pickle.HIGHEST_PROTOCOL))
+    app.session_interface.session_max_bytes = 2.5 * size
+    for key in ["a", "b", "c"]:
+        client.get("/set/%s/5000"%key)
+        time.sleep(0.01)
+    assert client.get("/get/a").data == b"missing"
+    assert client.get("/get/b").data != b"missing"
+    assert client.get("/get/c").data != b"missing"
+
+
+def test_expired_head_is_a_new_session(app, client):
+    add_session_views(app)
+    client.get("/set/small/3")
+    interface, sid, _ = head_of(app, client)
+    lifetime = app.permanent_session_lifetime.total_seconds()
+    old = time.time() - lifetime - 1
+    os.utime(interface.head_path(sid), (old, old))
+    assert client.get("/get/small").data == b"missing"
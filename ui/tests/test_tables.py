@@ -0,0 +1,74 @@
+import io
+import numpy as np
+import pandas as pd
+import pytest
+from app.datastore import create_dataset, dataset_exists
+from app.tables import query_table, table_csv_chunks
+
+
+@pytest.fixture
+def table(app):
+    df = pd.DataFrame({"code": list("BSRLC") * 20,
+                       "onset": np.arange(100) * 10,
+                       "note": ["row %s"%i for i in range(100)]})
+    return create_dataset(df), df
+
+
+def test_pages_sort_filter_search(table):
+    dataset_id, df = table
+    total, filtered, page = query_table(dataset_id, "records", offset=10,
+                                        limit=5)
+    assert (total, filtered) == (100, 100)
+    assert page["onset"].tolist() == [100, 110, 120, 130, 140]
+
+    total, filtered, page = query_table(dataset_id, "records", limit=3,
+        sort="onset", ascending=False, filters=[("code", "eq", "S")])
+    assert (total, filtered) == (100, 20)
+    assert page["onset"].tolist() == [960, 910, 860]
+
+    _, filtered, page = query_table(dataset_id, "records", search="ROW 4",
+                                    columns=["note"])
+    assert filtered == 11
+    assert list(page.columns) == ["note"]
+
+    _, filtered, page = query_table(dataset_id, "records", rows=[3, 50, 7],
+                                    filters=[("onset", "ge", "40")])
+    assert (filtered, page["onset"].tolist()) == (2, [500, 70])
+
+
+def test_unknown_column(table):
+    dataset_id, _ = table
+    with pytest.raises(KeyError):
+        query_table(dataset_id, "records", sort="missing")
+
+
+def test_csv_chunks(table):
+    dataset_id, df = table
+    text = "".join(table_csv_chunks(dataset_id, "records", chunk_size=7,
+                                    filters=[("code", "ne", "B")]))
+    expected = df[df["code"] != "B"]
+    assert pd.read_csv(io.StringIO(text)).equals(
+        expected.reset_index(drop=True))
+
+
+def test_eyegaze_file_pages(app, client):
+    records = [{"code": c, "onset": i * 10, "offset": i * 10 + 5}
+               for i, c in enumerate("BSRLC" * 30)]
+    with client.session_transaction() as session:
+        session["f1_records"] = records
+    page = client.get("/eyegazecleaner/table/f1/records"
+                      "?offset=20&limit=2&filter=code:eq:R").json
+    assert (page["total"], page["filtered"]) == (150, 30)
+    assert page["rows"] == [["R", 1020, 1025], ["R", 1070, 1075]]
+    with client.session_transaction() as session:
+        dataset_id = session["f1_dataset_id"]
+        # later pages read the stored table, not the session records
+        session["f1_records"] = []
+    page = client.get("/eyegazecleaner/table/f1/records?limit=1").json
+    assert page["total"] == 150
+    csv = client.get("/eyegazecleaner/table/f1/records?format=csv").data
+    assert len(csv.decode().strip().split("\n")) == 151
+
+    client.get("/eyegazecleaner/reset_session")
+    assert not dataset_exists(dataset_id)
+    assert client.get("/eyegazecleaner/table/f1/records").json["total"] == 0
@@ -0,0 +1,74 @@
+import os
+import wave
+import numpy as np
+import pytest
+from app.lenasampler import waveform
+from app.lenasampler.waveform import compute_envelopes, load_envelopes, \
+                                     segment_envelope
+from conftest import write_wav
+
+
+def wave_samples(fn):
+    ''' float samples (frames, channels) read with the wave module
+    '''
+    with wave.open(fn) as w:
+        width, channels = w.getsampwidth(), w.getnchannels()
+        data = np.frombuffer(w.readframes(w.getnframes()), dtype=np.uint8)
+    data = data.reshape(-1, channels, width).astype(np.int64)
+    values = sum(data[..., i] << (8 * i) for i in range(width))
+    if width == 1:
+        return (values - 128) / 128.
+    bits = 8 * width
+    values = np.where(values >= 1 << (bits - 1), values - (1 << bits), values)
+    return values / float(1 << (bits - 1))
+
+
+@pytest.mark.parametrize("channels, sampwidth", [(1, 2), (2, 2), (1, 1),
+                                                 (2, 3)])
+def test_envelopes_are_block_min_max(tmp_path, channels, sampwidth):
+    fn = write_wav(tmp_path / "a.wav", 1.3, channels=channels,
+                   sampwidth=sampwidth)
+    # chunks of 1000 frames: blocks are never split across chunks
+    envelopes = compute_envelopes(fn, levels=[64, 512], chunk_frames=1000)
+    samples = wave_samples(fn)
+    for level, envelope in envelopes.items():
+        blocks = -(-len(samples) // level)
+        assert envelope.shape == (blocks, 2)
+        for i in [0, blocks // 2, blocks - 1]:
+            block = samples[i * level:(i + 1) * level]
+            expected = np.round(np.array([block.min(), block.max()]) * 32767)
+            assert np.abs(envelope[i] - expected).max() <= 1
+
+
+def test_envelopes_are_cached_per_file_version(app, tmp_path, monkeypatch):
+    fn = write_wav(tmp_path / "a.wav", 2)
+    computed = []
+    compute = waveform.compute_envelopes
+
+    def counting(path, **kwargs):
+        computed.append(path)
+        return compute(path, **kwargs)
+    monkeypatch.setattr(waveform, "compute_envelopes", counting)
+
+    first = load_envelopes(fn, levels=[256, 4096])
+    load_envelopes(fn, levels=[256, 4096])
+    assert len(computed) == 1
+    folder = os.path.join(app.config["ENVELOPE_DIR"],
+                          os.listdir(app.config["ENVELOPE_DIR"])[0])
+    assert len(os.listdir(folder)) == 2
+
+    write_wav(fn, 3, seed=1)
+    second = load_envelopes(fn, levels=[256, 4096])
+    assert len(computed) == 2
+    assert len(second[256]) > len(first[256])
+    # the envelopes of the earlier version are gone
+    assert len(os.listdir(folder)) == 2
+
+
+def test_segment_envelope_width(app, tmp_path):
+    fn = write_wav(tmp_path / "a.wav", 10)
+    lows, highs = segment_envelope(fn, 2, 5, width=100)
+    assert len(lows) == len(highs) == 100
+    assert (lows <= highs).all()
+    # random full scale samples
+    assert lows.min() < -0.9 and highs.max() > 0.9